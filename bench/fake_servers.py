@@ -0,0 +1,325 @@
+import asyncio
+import base64
+import http.server
+import json
+import os
+import random
+import re
+import ssl
+import subprocess
+import threading
+import time
+
+# in-process stand-ins for the mail servers and the bot api, just enough protocol for the bot's clients
+
+def make_cert(directory: str) -> tuple[str, str]:
+    # self-signed for 127.0.0.1, the bot side trusts it through SSL_CERT_FILE
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                    '-days', '1', '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1'],
+                   check=True, capture_output=True)
+    return cert, key
+
+def server_ssl_context(cert: str, key: str) -> ssl.SSLContext:
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+class MailFactory(object):
+    # synthetic mails: a text body of body_size bytes, an html alternative for some,
+    # attachments of attachment_size bytes for an attachment_ratio share of them
+    def __init__(self, body_size=2000, html_ratio=0.5, attachment_ratio=0.2, attachment_size=200 * 1024, seed=1):
+        self.body_size = body_size
+        self.html_ratio = html_ratio
+        self.attachment_ratio = attachment_ratio
+        self.attachment_size = attachment_size
+        self.random = random.Random(seed)
+        self.seq = 0
+
+    def _words(self, size: int) -> str:
+        words = []
+        while size > 0:
+            word = self.random.choice(('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'mail', 'bench', 'telegram'))
+            words.append(word + ('\r\n' if self.random.random() < 0.1 else ' '))
+            size -= len(words[-1])
+        return ''.join(words)
+
+    def make(self, to_addr: str) -> tuple[int, bytes]:
+        # returns (sequence number, raw mail), the subject carries bench-<seq> so deliveries can be matched
+        self.seq += 1
+        seq = self.seq
+        headers = (f'From: sender{seq % 50}@example.org\r\nTo: {to_addr}\r\nSubject: bench-{seq}\r\n'
+                   f'Date: Thu, 01 Jan 2026 00:00:00 +0000\r\nMessage-ID: <bench-{seq}@example.org>\r\nMIME-Version: 1.0\r\n')
+        text = self._words(self.body_size)
+        withHtml = self.random.random() < self.html_ratio
+        withAttachment = self.random.random() < self.attachment_ratio
+        if not withHtml and not withAttachment:
+            return seq, (headers + 'Content-Type: text/plain; charset=utf-8\r\n\r\n' + text + '\r\n').encode()
+        parts = [f'Content-Type: text/plain; charset=utf-8\r\n\r\n{text}\r\n']
+        if withHtml:
+            cells = ''.join(f'<tr><td style="padding:4px">{w}</td><td><a href="https://example.org/{i}">link</a></td></tr>'
+                            for i, w in enumerate(text.split()[:200]))
+            parts.append(f'Content-Type: text/html; charset=utf-8\r\n\r\n<html><body><table>{cells}</table></body></html>\r\n')
+        if withAttachment:
+            data = base64.encodebytes(self.random.randbytes(self.attachment_size)).replace(b'\n', b'\r\n').decode()
+            parts.append('Content-Type: application/octet-stream; name="data.bin"\r\nContent-Disposition: attachment; filename="data.bin"\r\n'
+                         f'Content-Transfer-Encoding: base64\r\n\r\n{data}')
+        body = ''.join(f'--BENCH\r\n{part}' for part in parts) + '--BENCH--\r\n'
+        return seq, (headers + 'Content-Type: multipart/mixed; boundary="BENCH"\r\n\r\n' + body).encode()
+
+class Mailbox(object):
+    def __init__(self):
+        self.mails: dict[int, bytes] = {} # uid -> raw mail
+        self.uidvalidity = 1
+        self.uidnext = 1
+        self.waiters: list[asyncio.Event] = []
+
+    def add(self, raw: bytes):
+        self.mails[self.uidnext] = raw
+        self.uidnext += 1
+        for waiter in self.waiters:
+            waiter.set()
+
+def _sequence_set(spec: bytes) -> list[int]:
+    numbers = []
+    for piece in spec.split(b','):
+        if b':' in piece:
+            start, end = piece.split(b':')
+            numbers += range(int(start), int(end) + 1)
+        else:
+            numbers.append(int(piece))
+    return numbers
+
+class MailServers(object):
+    # IMAP and POP3 (TLS) over a dict of mailboxes, SMTP (plain) that accepts everything.
+    # counters: commands handled per protocol, mails accepted by SMTP
+    def __init__(self, mailboxes: dict[str, Mailbox], cert: str, key: str):
+        self.mailboxes = mailboxes
+        self.ssl = server_ssl_context(cert, key)
+        self.counters = {'imap_commands': 0, 'pop3_commands': 0, 'smtp_mails': 0}
+
+    async def start(self) -> dict[str, int]:
+        imap = await asyncio.start_server(self._imap, '127.0.0.1', 0, ssl=self.ssl)
+        pop3 = await asyncio.start_server(self._pop3, '127.0.0.1', 0, ssl=self.ssl)
+        smtp = await asyncio.start_server(self._smtp, '127.0.0.1', 0)
+        return {name: server.sockets[0].getsockname()[1] for name, server in (('imap', imap), ('pop3', pop3), ('smtp', smtp))}
+
+    async def _imap(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def send(line: bytes):
+            writer.write(line + b'\r\n')
+        send(b'* OK bench imap ready')
+        box: Mailbox | None = None
+        try:
+            while line := await reader.readline():
+                self.counters['imap_commands'] += 1
+                tag, command, *args = line.rstrip(b'\r\n').split(b' ', 2) + [b'']
+                command = command.upper()
+                args = args[0].split(b' ') if args[0] else []
+                if command == b'UID':
+                    command, args = b'UID ' + args[0].upper(), args[1:]
+                if command == b'CAPABILITY':
+                    send(b'* CAPABILITY IMAP4rev1 IDLE')
+                elif command == b'LOGIN':
+                    box = self.mailboxes.get(args[0].strip(b'"').decode())
+                    if box is None:
+                        send(tag + b' NO unknown user')
+                        continue
+                elif command == b'STATUS':
+                    send(b'* STATUS "INBOX" (MESSAGES %d UIDNEXT %d UIDVALIDITY %d)' % (len(box.mails), box.uidnext, box.uidvalidity)) # type: ignore[union-attr]
+                elif command in (b'EXAMINE', b'SELECT'):
+                    send(b'* %d EXISTS' % len(box.mails)) # type: ignore[union-attr]
+                elif command == b'UID SEARCH':
+                    first = int(args[1].split(b':')[0])
+                    uids = [uid for uid in box.mails if uid >= first] or list(box.mails)[-1:] # type: ignore[union-attr]
+                    send(b'* SEARCH ' + b' '.join(b'%d' % uid for uid in uids))
+                elif command in (b'UID FETCH', b'FETCH'):
+                    self._imap_fetch(writer, box, command == b'UID FETCH', args[0], b' '.join(args[1:]).upper()) # type: ignore[arg-type]
+                elif command == b'IDLE':
+                    send(b'+ idling')
+                    await writer.drain()
+                    await self._imap_idle(reader, writer, box) # type: ignore[arg-type]
+                elif command == b'LOGOUT':
+                    send(b'* BYE')
+                    send(tag + b' OK')
+                    await writer.drain()
+                    break
+                elif command not in (b'NOOP', b'CLOSE'):
+                    send(tag + b' BAD unknown command')
+                    continue
+                send(tag + b' OK')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _imap_fetch(self, writer: asyncio.StreamWriter, box: Mailbox, byUid: bool, spec: bytes, items: bytes):
+        uids = sorted(box.mails)
+        for number in _sequence_set(spec):
+            if byUid:
+                if number not in box.mails:
+                    continue
+                uid, seq = number, uids.index(number) + 1
+            else:
+                if number > len(uids):
+                    continue
+                uid, seq = uids[number - 1], number
+            raw = box.mails[uid]
+            literals = []
+            for section in re.findall(rb'BODY\.PEEK\[([^\]]*)\]', items):
+                header = raw.split(b'\r\n\r\n', 1)[0]
+                if section.startswith(b'HEADER.FIELDS'):
+                    wanted = re.findall(rb'[\w-]+', section[len(b'HEADER.FIELDS'):].upper())
+                    data = b''.join(line + b'\r\n' for line in header.split(b'\r\n') if line.split(b':')[0].upper() in wanted) + b'\r\n'
+                else:
+                    data = header + b'\r\n\r\n'
+                literals.append(b' BODY[%s] {%d}\r\n%s' % (section, len(data), data))
+            if b'RFC822' in items:
+                literals.append(b' RFC822 {%d}\r\n%s' % (len(raw), raw))
+            writer.write(b'* %d FETCH (UID %d' % (seq, uid) + b''.join(literals) + b')\r\n')
+
+    async def _imap_idle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, box: Mailbox):
+        known = len(box.mails)
+        newMail = asyncio.Event()
+        box.waiters.append(newMail)
+        done = asyncio.ensure_future(reader.readline())
+        try:
+            while not done.done():
+                waiter = asyncio.ensure_future(newMail.wait())
+                await asyncio.wait({done, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+                if newMail.is_set():
+                    newMail.clear()
+                    if len(box.mails) != known:
+                        known = len(box.mails)
+                        writer.write(b'* %d EXISTS\r\n' % known)
+                        await writer.drain()
+        finally:
+            box.waiters.remove(newMail)
+
+    async def _pop3(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def send(line: bytes):
+            writer.write(line + b'\r\n')
+        def send_lines(lines):
+            for line in lines:
+                send(b'.' + line if line.startswith(b'.') else line)
+            send(b'.')
+        send(b'+OK bench pop3 ready')
+        await writer.drain()
+        box: Mailbox | None = None
+        uids: list[int] = []
+        try:
+            while line := await reader.readline():
+                self.counters['pop3_commands'] += 1
+                command, *args = line.rstrip(b'\r\n').split(b' ')
+                command = command.upper()
+                if command == b'USER':
+                    box = self.mailboxes.get(args[0].decode())
+                    send(b'+OK' if box else b'-ERR unknown user')
+                elif command == b'PASS':
+                    uids = sorted(box.mails) # type: ignore[union-attr] # maildrop is locked at login
+                    send(b'+OK')
+                elif command == b'STAT':
+                    send(b'+OK %d %d' % (len(uids), sum(len(box.mails[uid]) for uid in uids))) # type: ignore[union-attr]
+                elif command == b'UIDL':
+                    send(b'+OK')
+                    send_lines([b'%d bench-%d' % (i + 1, uid) for i, uid in enumerate(uids)])
+                elif command == b'LIST':
+                    send(b'+OK')
+                    send_lines([b'%d %d' % (i + 1, len(box.mails[uid])) for i, uid in enumerate(uids)]) # type: ignore[union-attr]
+                elif command in (b'RETR', b'TOP'):
+                    raw = box.mails[uids[int(args[0]) - 1]] # type: ignore[union-attr]
+                    if command == b'TOP':
+                        header, body = raw.split(b'\r\n\r\n', 1)
+                        raw = header + b'\r\n\r\n' + b'\r\n'.join(body.split(b'\r\n')[:int(args[1])])
+                    send(b'+OK')
+                    send_lines(raw.split(b'\r\n'))
+                elif command == b'NOOP':
+                    send(b'+OK')
+                elif command == b'QUIT':
+                    send(b'+OK bye')
+                    await writer.drain()
+                    break
+                else:
+                    send(b'-ERR unknown command')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _smtp(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def send(line: bytes):
+            writer.write(line + b'\r\n')
+        send(b'220 bench smtp ready')
+        await writer.drain()
+        try:
+            while line := await reader.readline():
+                command = line[:4].upper()
+                if command in (b'EHLO', b'HELO'):
+                    send(b'250-bench')
+                    send(b'250 AUTH PLAIN')
+                elif command == b'AUTH':
+                    send(b'235 ok')
+                elif command == b'DATA':
+                    send(b'354 go ahead')
+                    await writer.drain()
+                    while (await reader.readline()) not in (b'.\r\n', b''):
+                        pass
+                    self.counters['smtp_mails'] += 1
+                    send(b'250 queued')
+                elif command == b'QUIT':
+                    send(b'221 bye')
+                    await writer.drain()
+                    break
+                else:
+                    send(b'250 ok')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+class BotApi(object):
+    # answers bot api calls (http, base_url http://127.0.0.1:port/bot) with plausible Message objects
+    # and records when each bench-<seq> mail first showed up in a request
+    def __init__(self):
+        self.received: dict[int, float] = {}
+        self.calls: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.message_id = 0
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                method = self.path.rsplit('/', 1)[-1]
+                now = time.time()
+                with api.lock:
+                    api.calls[method] = api.calls.get(method, 0) + 1
+                    m = re.search(rb'bench-(\d+)', body)
+                    if m:
+                        api.received.setdefault(int(m.group(1)), now)
+                    count = body.count(b'attach://') if method == 'sendMediaGroup' else 0
+                    messages = []
+                    for _ in range(max(count, 1)):
+                        api.message_id += 1
+                        messages.append({'message_id': api.message_id, 'date': int(now), 'chat': {'id': 1, 'type': 'private'}})
+                result = json.dumps({'ok': True, 'result': messages if method == 'sendMediaGroup' else messages[0]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(result)))
+                self.end_headers()
+                self.wfile.write(result)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='bench-bot-api', daemon=True).start()
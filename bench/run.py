@@ -0,0 +1,311 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+# offline benchmark of the hot paths: polling N accounts against local IMAP/POP3 servers through
+# to a local bot api, SMTP sending, and mail parsing/rendering. nothing leaves 127.0.0.1.
+#   python -m bench.run --accounts 50 --backlog 20 --live 5
+# the mail servers and the bot api run in a child process, so syscalls and memory below are the bot's own
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from bench.fake_servers import BotApi, MailFactory, Mailbox, MailServers, make_cert # noqa: E402
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='offline benchmark against local mail servers and bot api')
+    parser.add_argument('--accounts', type=int, default=20)
+    parser.add_argument('--protocol', choices=('imap', 'pop3', 'mixed'), default='mixed')
+    parser.add_argument('--backlog', type=int, default=10, help='mails waiting in every mailbox at start')
+    parser.add_argument('--live', type=int, default=5, help='mails arriving in every mailbox during the run')
+    parser.add_argument('--duration', type=float, default=10, help='seconds the live mails are spread over')
+    parser.add_argument('--interval', type=float, default=1, help='poll interval in seconds')
+    parser.add_argument('--idle', action='store_true', help='use IMAP IDLE instead of polling imap accounts')
+    parser.add_argument('--body-size', type=int, default=2000)
+    parser.add_argument('--html-ratio', type=float, default=0.5)
+    parser.add_argument('--attachment-ratio', type=float, default=0.2)
+    parser.add_argument('--attachment-size', type=int, default=200 * 1024)
+    parser.add_argument('--smtp', type=int, default=50, help='mails sent one-shot and pooled each, 0 to skip')
+    parser.add_argument('--parse', type=int, default=200, help='mails parsed and rendered, 0 to skip')
+    parser.add_argument('--timeout', type=float, default=120)
+    parser.add_argument('--tracemalloc', action='store_true', help='also report the python heap peak (slower)')
+    parser.add_argument('--json', help='write the results to this file')
+    return parser.parse_args(argv)
+
+def account_addrs(options: dict) -> list[tuple[str, str]]:
+    # (email_addr, protocol)
+    protocols = ['imap', 'pop3'] if options['protocol'] == 'mixed' else [options['protocol']]
+    return [(f'user{i}@bench.test', protocols[i % len(protocols)]) for i in range(options['accounts'])]
+
+def mail_factory(options: dict, seed=1) -> MailFactory:
+    return MailFactory(body_size=options['body_size'], html_ratio=options['html_ratio'],
+                       attachment_ratio=options['attachment_ratio'], attachment_size=options['attachment_size'], seed=seed)
+
+def world_main(conn, options: dict, cert: str, key: str):
+    # child process: mail servers and bot api, driven over conn
+    factory = mail_factory(options)
+    mailboxes = {addr: Mailbox() for addr, _ in account_addrs(options)}
+    backlog = []
+    for addr, box in mailboxes.items():
+        for _ in range(options['backlog']):
+            seq, raw = factory.make(addr)
+            box.add(raw)
+            backlog.append(seq)
+    injected: dict[int, float] = {}
+    loop = asyncio.new_event_loop()
+    servers = MailServers(mailboxes, cert, key)
+    ports = loop.run_until_complete(servers.start())
+    api = BotApi()
+    api.start()
+    ports['bot_api'] = api.port
+    threading.Thread(target=loop.run_forever, name='bench-mail-servers', daemon=True).start()
+
+    async def inject_live():
+        start = time.time()
+        arrivals = sorted((random.uniform(0, options['duration']), addr)
+                          for addr in mailboxes for _ in range(options['live']))
+        for at, addr in arrivals:
+            await asyncio.sleep(max(start + at - time.time(), 0))
+            seq, raw = factory.make(addr)
+            injected[seq] = time.time()
+            mailboxes[addr].add(raw)
+
+    conn.send(ports)
+    while True:
+        command, arg = conn.recv()
+        if command == 'start':
+            injected.update((seq, arg) for seq in backlog)
+            asyncio.run_coroutine_threadsafe(inject_live(), loop)
+        elif command == 'status':
+            conn.send(len(api.received))
+        elif command == 'report':
+            conn.send({'injected': dict(injected), 'backlog': backlog, 'received': dict(api.received),
+                       'calls': dict(api.calls), 'servers': dict(servers.counters)})
+        elif command == 'stop':
+            return
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {'p50': None, 'p99': None, 'max': None}
+    values = sorted(values)
+    return {'p50': statistics.median(values), 'p99': values[min(int(len(values) * 0.99), len(values) - 1)], 'max': values[-1]}
+
+def io_syscalls() -> int | None:
+    # read and write class syscalls of this process so far (syscr + syscw), linux only
+    try:
+        with open('/proc/self/io') as f:
+            fields = dict(line.split(':') for line in f)
+        return int(fields['syscr']) + int(fields['syscw'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def max_rss_mib() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == 'darwin' else rss / 1024
+
+def bench_poll(options: dict, conn, ports: dict) -> dict:
+    import bot
+    from telegram.ext import Updater
+
+    bot.updater = Updater(token=bot.bot_token, base_url=f'http://127.0.0.1:{ports["bot_api"]}/bot', use_context=True)
+    polls = 0
+    async def counted_poll(email_addr: str, woken: bool):
+        nonlocal polls
+        delivered = await bot.poll_account(email_addr, woken)
+        if delivered is not None:
+            polls += 1
+        return delivered
+    bot.engine = bot.AsyncPollEngine(counted_poll, options['interval'], idle_fn=bot.idle_account if options['idle'] else None,
+                                     max_concurrency=bot.poll_concurrency, min_interval=options['interval'],
+                                     max_interval=options['interval'], jitter=bot.poll_jitter)
+    for i, (addr, protocol) in enumerate(account_addrs(options)):
+        account = {'email_addr': addr, 'email_passwd': 'bench', 'server_uri': f'{protocol}s://127.0.0.1:{ports[protocol]}',
+                   'smtp_server_uri': f'smtp://127.0.0.1:{ports["smtp"]}', 'chat_id': 1000 + i,
+                   'inbox_num': 0, 'uid_validity': 1, 'last_uid': 0, 'highest_modseq': 0,
+                   'seen_uidls': [] if protocol == 'pop3' else None}
+        bot.emailDB.upsert(account)
+    bot.engine.start()
+    bot.tgDispatcher.start()
+
+    expected = options['accounts'] * (options['backlog'] + options['live'])
+    syscallsBefore = io_syscalls()
+    started = time.time()
+    conn.send(('start', started))
+    bot.periodic_task()
+    delivered = 0
+    while time.time() - started < options['timeout']:
+        time.sleep(0.2)
+        conn.send(('status', None))
+        delivered = conn.recv()
+        if delivered >= expected:
+            break
+    elapsed = time.time() - started
+    syscallsAfter = io_syscalls()
+    bot.engine.sync_accounts({})
+    bot.emailDB.flush()
+
+    conn.send(('report', None))
+    report = conn.recv()
+    received, injected = report['received'], report['injected']
+    backlogSeqs = set(report['backlog'])
+    backlogDone = max((received[seq] for seq in backlogSeqs if seq in received), default=started)
+    return {
+        'accounts': options['accounts'],
+        'expected_mails': expected,
+        'delivered_mails': len(received),
+        'elapsed_s': elapsed,
+        'throughput_mails_per_s': len(received) / elapsed if elapsed else None,
+        'backlog_drain_s': backlogDone - started,
+        'backlog_mails_per_s': len(backlogSeqs & set(received)) / max(backlogDone - started, 1e-9),
+        'latency_live_s': percentiles([received[seq] - at for seq, at in injected.items() if seq in received and seq not in backlogSeqs]),
+        'latency_backlog_s': percentiles([received[seq] - injected[seq] for seq in backlogSeqs if seq in received]),
+        'polls': polls,
+        'io_syscalls_per_poll': (syscallsAfter - syscallsBefore) / polls if polls and syscallsBefore is not None else None,
+        'bot_api_calls': report['calls'],
+        'server_counters': report['servers'],
+        'errors': {addr: list(errors) for addr, errors in bot.PERIODIC_TASK_ERRORS.items()},
+    }
+
+def bench_smtp(options: dict, ports: dict) -> dict:
+    # a new connection per mail (send_email) against the pooled connection replies go through
+    from utils.smtpclient import SmtpPool, send_email
+    pool = SmtpPool()
+    results = {}
+    for name, send in (('one_shot', send_email), ('pooled', pool.send)):
+        latencies = []
+        started = time.perf_counter()
+        for i in range(options['smtp']):
+            t = time.perf_counter()
+            send(f'smtp://127.0.0.1:{ports["smtp"]}', 'user0@bench.test', 'bench', 'someone@example.org',
+                 f'Re: bench-{i}', 'reply body ' * 50)
+            latencies.append(time.perf_counter() - t)
+        elapsed = time.perf_counter() - started
+        results[name] = {'mails': options['smtp'], 'mails_per_s': options['smtp'] / elapsed if elapsed else None,
+                         'latency_s': percentiles(latencies)}
+    pool.close_all()
+    return results
+
+def bench_parse(options: dict) -> dict:
+    from utils.mail import Email
+    from utils.mail_stream import StreamingMailParser
+    from utils.render import split_message
+    factory = mail_factory(options, seed=2)
+    raws = [factory.make('user0@bench.test')[1] for _ in range(options['parse'])]
+    size = sum(len(raw) for raw in raws)
+    results = {'mails': len(raws), 'bytes': size}
+
+    def timed(name, fn):
+        started = time.perf_counter()
+        for raw in raws:
+            fn(raw)
+        elapsed = time.perf_counter() - started
+        results[name] = {'mails_per_s': len(raws) / elapsed, 'mib_per_s': size / elapsed / 1024 / 1024}
+
+    def stream(raw):
+        parser = StreamingMailParser()
+        for start in range(0, len(raw), 64 * 1024):
+            parser.feed(raw[start:start + 64 * 1024])
+        mail = parser.close()
+        mail.convert_html()
+        mail.close()
+    def render(raw):
+        mail = Email(raw.split(b'\r\n'))
+        split_message(mail.format_email()[0])
+    timed('parse_stream', stream)
+    timed('parse_legacy', lambda raw: Email(raw.split(b'\r\n')))
+    timed('parse_and_render', render)
+
+    # html conversion of all mails at once in the cpu pool, warmed up, against the loop doing it
+    from utils.cpu_pool import CpuPool
+    from utils.html_text import render_html
+    htmls = []
+    for raw in raws:
+        parser = StreamingMailParser()
+        parser.feed(raw)
+        mail = parser.close()
+        if mail.raw_html is not None:
+            htmls.append(mail.raw_html)
+        mail.close()
+    async def offload():
+        pool = CpuPool()
+        try:
+            await asyncio.gather(*(pool.run(len, '') for _ in range(pool.workers)))
+            started = time.perf_counter()
+            await asyncio.gather(*(pool.run(render_html, html) for html in htmls))
+            return time.perf_counter() - started, pool.workers
+        finally:
+            await pool.close()
+    from utils.html_text import converter
+    started = time.perf_counter()
+    for html in htmls:
+        converter.render(html)
+    inline = time.perf_counter() - started
+    offloaded, workers = asyncio.run(offload())
+    results['html_inline'] = {'bodies': len(htmls), 'bodies_per_s': len(htmls) / inline if inline else None}
+    results['html_cpu_pool'] = {'bodies': len(htmls), 'workers': workers, 'bodies_per_s': len(htmls) / offloaded if offloaded else None}
+    return results
+
+def print_results(results: dict, indent=''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print(f'{indent}{key}:')
+            print_results(value, indent + '    ')
+        elif isinstance(value, float):
+            print(f'{indent}{key}: {value:.4g}')
+        else:
+            print(f'{indent}{key}: {value}')
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.json:
+        args.json = os.path.abspath(args.json) # before changing into the work directory
+    options = vars(args)
+    workdir = tempfile.mkdtemp(prefix='mailbot-bench-')
+    cert, key = make_cert(workdir)
+    # the servers are started before any thread exists here, so forking is safe
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn')
+    conn, childConn = context.Pipe()
+    world = context.Process(target=world_main, args=(childConn, options, cert, key), daemon=True)
+    world.start()
+    ports = conn.recv()
+
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+    # bot.py reads its configuration from the environment when imported and keeps its state in ./conf
+    os.environ['SSL_CERT_FILE'] = cert
+    for name, value in (('TELEGRAM_TOKEN', '123456:bench'), ('OWNER_CHAT_ID', '1'), ('POLL_INTERVAL', '60'),
+                        ('IMAP_IDLE', '1' if args.idle else '0'), ('LAZY_ATTACHMENTS', '0'),
+                        ('TG_RATE_GLOBAL', '100000'), ('TG_RATE_CHAT', '100000'), ('TG_RATE_GROUP', '100000')):
+        os.environ.setdefault(name, value)
+    os.chdir(workdir)
+    import logging
+    logging.disable(logging.INFO) # per-mail info logs would dominate the profile
+
+    results = {'poll': bench_poll(options, conn, ports)}
+    if args.smtp:
+        results['smtp'] = bench_smtp(options, ports)
+    if args.parse:
+        results['parse'] = bench_parse(options)
+    results['memory'] = {'max_rss_mib': max_rss_mib()}
+    if args.tracemalloc:
+        results['memory']['python_heap_peak_mib'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    conn.send(('stop', None))
+    world.join(5)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,27 +1,41 @@
+import asyncio
 import datetime
+import functools
+import hashlib
 import logging
 import os
 import re
+import signal
 import socket
+import threading
 import time
 from traceback import format_exc
+from concurrent.futures import CancelledError, Future
 from typing import Type
 import dataclasses
 import typing
-from telegram import Bot, ParseMode, Update
-from telegram.constants import MAX_MESSAGE_LENGTH
-from telegram.ext import (Updater, CommandHandler, MessageHandler, ConversationHandler, Filters, CallbackContext)
-from pysondb import db as pysondb
-from utils import EmailClientBase, EmailClientIMAP, EmailClientPOP3
-from utils.oauth2_helper import OAuth2_MS, OAuth2Factory
-from utils.smtpclient import send_email
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, InputMediaPhoto, ParseMode, Update
+from telegram.constants import MAX_CAPTION_LENGTH, MAX_MESSAGE_LENGTH, MAX_PHOTOSIZE_UPLOAD
+from telegram.ext import (Updater, CallbackQueryHandler, CommandHandler, MessageHandler, ConversationHandler, Filters, CallbackContext)
+from utils import AsyncEmailClientBase, AsyncEmailClientIMAP, AsyncEmailClientPOP3, MailboxStatus
+from utils.mail import Email
+from utils.oauth2_helper import OAuth2_MS, OAuth2Factory, TokenStore
+from utils.smtpclient import SmtpPool
+from utils.aio_engine import AsyncPollEngine
+from utils.store import AccountStore
+from utils.sharding import ShardCoordinator
+from utils.budget import SharedBudget, WorkBudget, split_fresh
+from utils.client_pool import ClientPool
+from utils.render import escape, split_message, utf16_len
+from utils.html_text import converter as htmlConverter, render_html
+from utils.cpu_pool import PARSE_OFFLOAD_MIN_SIZE, PARSE_WORKERS, CpuPool, CpuPoolError
+from utils import metrics, profiling
+from utils.tg_dispatcher import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_NOTIFY, TelegramDispatcher
 
 updater: Updater = None # type: ignore[assignment]
 
 socket.setdefaulttimeout(10) # avoid imaplib timeout
 
-emailDB = pysondb.getDb("conf/email_accounts.json")
-
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s:%(lineno)d - %(message)s',
                     # stream=sys.stdout,
                     level=logging.INFO)
@@ -40,6 +54,18 @@ _poll_interval = getconf('POLL_INTERVAL')
 if not _poll_interval:
     _poll_interval = '60'
 poll_interval = int(_poll_interval)
+_poll_interval_min = getconf('POLL_INTERVAL_MIN')
+if not _poll_interval_min:
+    _poll_interval_min = str(max(poll_interval // 4, 1))
+poll_interval_min = int(_poll_interval_min)
+_poll_interval_max = getconf('POLL_INTERVAL_MAX')
+if not _poll_interval_max:
+    _poll_interval_max = str(poll_interval * 2) # a dormant inbox's first new mail waits up to this long
+poll_interval_max = int(_poll_interval_max)
+_poll_jitter = getconf('POLL_JITTER')
+if not _poll_jitter:
+    _poll_jitter = '0.2'
+poll_jitter = float(_poll_jitter)
 _err_report_interval = getconf('ERR_REPORT_INTERVAL')
 if not _err_report_interval:
     _err_report_interval = '3600'
@@ -48,20 +74,105 @@ _request_timeout = getconf('REQUEST_TIMEOUT')
 if not _request_timeout:
     _request_timeout = '60'
 request_timeout = int(_request_timeout)
+_poll_concurrency = getconf('POLL_CONCURRENCY')
+if not _poll_concurrency:
+    _poll_concurrency = '100'
+poll_concurrency = int(_poll_concurrency)
+_imap_idle = getconf('IMAP_IDLE')
+if not _imap_idle:
+    _imap_idle = '1'
+imap_idle = _imap_idle.lower() not in ('0', 'false', 'no', 'off')
+_imap_idle_renew_interval = getconf('IMAP_IDLE_RENEW_INTERVAL')
+if not _imap_idle_renew_interval:
+    _imap_idle_renew_interval = '1500'
+imap_idle_renew_interval = int(_imap_idle_renew_interval)
+_lazy_attachments = getconf('LAZY_ATTACHMENTS')
+if not _lazy_attachments:
+    _lazy_attachments = '0'
+lazy_attachments = _lazy_attachments.lower() not in ('0', 'false', 'no', 'off')
+_pop3_preview_size = getconf('POP3_PREVIEW_SIZE')
+if not _pop3_preview_size:
+    _pop3_preview_size = '262144'
+pop3_preview_size = int(_pop3_preview_size)
+_pop3_preview_lines = getconf('POP3_PREVIEW_LINES')
+if not _pop3_preview_lines:
+    _pop3_preview_lines = '50'
+pop3_preview_lines = int(_pop3_preview_lines)
+_state_commit_interval = getconf('STATE_COMMIT_INTERVAL')
+if not _state_commit_interval:
+    _state_commit_interval = '1'
+state_commit_interval = float(_state_commit_interval)
+_tg_rate_global = getconf('TG_RATE_GLOBAL')
+if not _tg_rate_global:
+    _tg_rate_global = '30'
+tg_rate_global = float(_tg_rate_global)
+_tg_rate_chat = getconf('TG_RATE_CHAT')
+if not _tg_rate_chat:
+    _tg_rate_chat = '1'
+tg_rate_chat = float(_tg_rate_chat)
+_tg_rate_group = getconf('TG_RATE_GROUP')
+if not _tg_rate_group:
+    _tg_rate_group = '0.33'
+tg_rate_group = float(_tg_rate_group)
+_catchup_notify_mails = getconf('CATCHUP_NOTIFY_MAILS')
+if not _catchup_notify_mails:
+    _catchup_notify_mails = '3'
+catchup_notify_mails = int(_catchup_notify_mails)
+_message_html = getconf('MESSAGE_HTML')
+if not _message_html:
+    _message_html = '0'
+message_html = _message_html.lower() not in ('0', 'false', 'no', 'off')
+_max_message_chunks = getconf('MAX_MESSAGE_CHUNKS')
+if not _max_message_chunks:
+    _max_message_chunks = '20'
+max_message_chunks = int(_max_message_chunks)
+_client_pool_size = getconf('CLIENT_POOL_SIZE')
+if not _client_pool_size:
+    _client_pool_size = '100'
+client_pool_size = int(_client_pool_size)
+_client_idle_timeout = getconf('CLIENT_IDLE_TIMEOUT')
+if not _client_idle_timeout:
+    _client_idle_timeout = '300'
+client_idle_timeout = int(_client_idle_timeout)
+_dedup_index_size = getconf('DEDUP_INDEX_SIZE')
+if not _dedup_index_size:
+    _dedup_index_size = '10000'
+dedup_index_size = int(_dedup_index_size)
+_reply_index_size = getconf('REPLY_INDEX_SIZE')
+if not _reply_index_size:
+    _reply_index_size = '50000'
+reply_index_size = int(_reply_index_size)
+# prometheus /metrics endpoint, disabled unless a port is set
+_metrics_port = getconf('METRICS_PORT')
+metrics_port = int(_metrics_port) if _metrics_port else None
+_metrics_addr = getconf('METRICS_ADDR')
+if not _metrics_addr:
+    _metrics_addr = '127.0.0.1'
+metrics_addr = _metrics_addr
+# encrypts persisted oauth2 access tokens, defaults to one derived from TELEGRAM_TOKEN
+_token_store_key = getconf('TOKEN_STORE_KEY')
+if not _token_store_key:
+    _token_store_key = bot_token
+token_store_key = _token_store_key
+# all: one process does everything. to spread polling over processes sharing conf/, run one front
+# (telegram updates and commands) and any number of workers (polling and delivery)
+_bot_role = getconf('BOT_ROLE')
+if not _bot_role:
+    _bot_role = 'all'
+bot_role = _bot_role.lower()
+if bot_role not in ('all', 'front', 'worker'):
+    raise ValueError(f'BOT_ROLE must be all, front or worker, not {bot_role}')
+_worker_id = getconf('WORKER_ID')
+worker_id = _worker_id if _worker_id else None
+
+# conf/email_accounts.json (pysondb) is migrated on first start
+emailDB = AccountStore("conf/email_accounts.db", legacy_json_path="conf/email_accounts.json",
+                       commit_interval=state_commit_interval, dedup_size=dedup_index_size, reply_index_size=reply_index_size)
+TokenStore.configure(emailDB, token_store_key)
 
 def is_owner(update: Update) -> bool:
     return update.message.chat_id == owner_chat_id
 
-def handle_large_text(text):
-    while text:
-        if len(text) < MAX_MESSAGE_LENGTH:
-            yield text
-            text = None
-        else:
-            out = text[:MAX_MESSAGE_LENGTH]
-            yield out
-            text = text.lstrip(out)
-
 def error(update: Update, context: CallbackContext) -> None:
     """Log Errors caused by Updates."""
     logger.warning('Update "%s" caused error "%s"', update, context.error)
@@ -89,6 +200,10 @@ def _help(update: Update, context: CallbackContext) -> None:
 
 /list_email
 /del_email john.doe@example.com
+/set_folders john.doe@example.com Junk, Work/Projects 监控收件箱以外的 IMAP 文件夹 (不带文件夹名则列出服务器上的文件夹)
+/skip_backlog [john.doe@example.com] 跳过未转发的积压邮件, 只转发之后的新邮件 (不带邮箱则对所有邮箱)
+/stats 连接池和轮询状态
+/profile [cpu|sample|mem] [seconds] 性能分析 (cProfile / 线程采样 / tracemalloc)
 /help get help
 
 Telegram中回复即可直接回复邮件
@@ -105,21 +220,106 @@ class EmailConf():
     smtp_server_uri: str | None
     chat_id: int
     inbox_num: int
+    # IMAP incremental sync state, 0 means not initialized yet
+    uid_validity: int = 0
+    last_uid: int = 0
+    highest_modseq: int = 0
+    # POP3 incremental sync state, UIDLs already delivered, None means not initialized yet
+    seen_uidls: list[str] | None = None
+    # IMAP folders watched besides INBOX, and their sync state {folder: {uid_validity, last_uid, highest_modseq}}
+    folders: list[str] | None = None
+    folder_cursors: dict[str, dict] | None = None
+    # IMAP uid ranges {folder: [[after_uid, last_uid], ...]} still to deliver after a large backlog was cut short
+    backlogs: dict[str, list[list[int]]] | None = None
+    # set by /skip_backlog, the next poll marks all mail as delivered
+    skip_backlog: int = 0
+
+INBOX = 'INBOX'
 
 def setting_list_email(update: Update, context: CallbackContext) -> None:
     if not is_owner(update):
         return
     
     msg = 'Email Account List:\n'
-    for emailConfDict in emailDB.getAll():
+    for emailConfDict in emailDB.get_all():
         try:
             emailConf = getEmailConfFromDict(emailConfDict)
         except Exception:
             msg += "    (Invalid Email Account: %s)\n" % emailConfDict
             continue
-        msg += f"    Email: {emailConf.email_addr}, Password: {emailConf.email_passwd}, Server: {emailConf.server_uri}, SMTP Server: {emailConf.smtp_server_uri}, InboxNum: {emailConf.inbox_num}\n"
+        msg += f"    Email: {emailConf.email_addr}, Password: {emailConf.email_passwd}, Server: {emailConf.server_uri}, SMTP Server: {emailConf.smtp_server_uri}, InboxNum: {emailConf.inbox_num}, LastUID: {emailConf.last_uid}"
+        if emailConf.folders:
+            msg += f", Folders: {', '.join(emailConf.folders)}"
+        if emailConf.backlogs:
+            # uids have gaps, the ranges are an upper bound
+            backlogSize = sum(last - after for ranges in emailConf.backlogs.values() for after, last in ranges)
+            msg += f", Backlog: up to {backlogSize} mails"
+        msg += "\n"
     update.message.reply_text(msg)
 
+def show_stats(update: Update, context: CallbackContext) -> None:
+    if not is_owner(update):
+        return
+    async def collect():
+        return emailClientPool.stats(), {addr: schedule.interval for addr, schedule in engine.schedules.items()}
+    poolStats, intervals = engine.run_sync(collect())
+    msg = 'Connection Pool:\n'
+    for k, v in poolStats.items():
+        msg += f"    {k}: {v}\n"
+    msg += 'Telegram Send Queue:\n'
+    for k, v in tgDispatcher.stats().items():
+        msg += f"    {k}: {v}\n"
+    msg += 'SMTP:\n'
+    for k, v in smtpPool.stats().items():
+        msg += f"    {k}: {v}\n"
+    if cpuPool:
+        msg += 'CPU Pool:\n'
+        for k, v in cpuPool.stats().items():
+            msg += f"    {k}: {v}\n"
+    msg += 'HTML Conversion:\n'
+    for k, v in htmlConverter.stats().items():
+        msg += f"    {k}: {v}\n"
+    if bot_role == 'front':
+        msg += 'Workers:\n'
+        for worker in emailDB.get_workers():
+            msg += f"    {worker['worker_id']}: {worker['leases']} accounts, heartbeat {time.time() - worker['heartbeat']:.0f}s ago\n"
+    msg += f'Accounts ({len(intervals)}, {len(idlingAccounts)} idling):\n'
+    for addr, interval in intervals.items():
+        msg += f"    {addr}: poll interval {interval:.0f}s{' (IDLE)' if addr in idlingAccounts else ''}\n"
+    update.message.reply_text(msg)
+
+PROFILE_MODES = {
+    'cpu': lambda seconds: profiling.profile_loop(engine.loop, seconds),
+    'sample': profiling.sample_threads,
+    'mem': profiling.trace_allocations,
+}
+MAX_PROFILE_SECONDS = 600
+profileLock = threading.Lock()
+
+def run_profile(update: Update, context: CallbackContext) -> None:
+    # runs in a worker thread (run_async) for the whole window, one profile at a time
+    if not is_owner(update):
+        return
+    mode = context.args[0] if context.args else 'cpu'
+    if mode not in PROFILE_MODES:
+        update.message.reply_text(f"Usage: /profile [{'|'.join(PROFILE_MODES)}] [seconds]")
+        return
+    try:
+        seconds = min(float(context.args[1]), MAX_PROFILE_SECONDS) if len(context.args) > 1 else 60
+    except ValueError:
+        update.message.reply_text("Invalid seconds!")
+        return
+    if not profileLock.acquire(blocking=False):
+        update.message.reply_text("A profile is already running.")
+        return
+    try:
+        update.message.reply_text(f"Profiling ({mode}) for {seconds:.0f}s...")
+        report = PROFILE_MODES[mode](seconds)
+    finally:
+        profileLock.release()
+    update.message.reply_document(document=report.encode(), filename=f'profile-{mode}-{int(time.time())}.txt',
+                                  caption=report.split('\n', 1)[0][:MAX_CAPTION_LENGTH])
+
 def setting_add_email(update: Update, context: CallbackContext) -> None:
     if not is_owner(update):
         return
@@ -156,15 +356,20 @@ def setting_add_email(update: Update, context: CallbackContext) -> None:
         update.message.reply_text(f"Exchanged refresh_token {new_passwd} from {email_passwd} for email {email_addr}, Rewriting password~")
         emailConf.email_passwd = email_passwd = new_passwd
 
-    with getEmailClient(emailConf) as client:
-        inbox_num = client.get_mails_count()
-    emailConf.inbox_num = inbox_num
+    async def init_account():
+        client = await createEmailClient(emailConf)
+        try:
+            emailConf.inbox_num = await with_timeout(client.get_mails_count())
+            if client.supports_uid_sync() or client.supports_uidl_sync():
+                await init_sync_state(emailConf, client)
+        finally:
+            client.kill()
+    engine.run_sync(init_account())
     
-    if emailDB.getByQuery({'email_addr': email_addr}):
+    if emailDB.get(email_addr):
         update.message.reply_text(f"Email {email_addr} is already configured! Overriding...")
-        emailDB.updateByQuery({'email_addr': email_addr},  dataclasses.asdict(emailConf))
-    else:
-        emailDB.add(dataclasses.asdict(emailConf))
+    emailDB.upsert(dataclasses.asdict(emailConf))
+    periodic_task()
     
     update.message.reply_text("Configure email success!")
 
@@ -177,38 +382,99 @@ def setting_del_email(update: Update, context: CallbackContext) -> None:
         return
     email_addr = context.args[0]
     
-    emails = emailDB.getByQuery({'email_addr': email_addr})
-    if not emails:
+    if not emailDB.delete(email_addr):
         update.message.reply_text(f'cannot find email account: {email_addr}')
         return
-    assert len(emails) == 1
-    pk = emails[0][emailDB.id_fieldname]
-    assert emailDB.deleteById(pk)
+    periodic_task() # stops polling it and drops its token
     update.message.reply_text(f'Successfully deleted email account {email_addr}')
 
-def safeSendText(sender, content):
-    for text in handle_large_text(content):
-        safeSend(sender, text)
+def setting_skip_backlog(update: Update, context: CallbackContext) -> None:
+    # done by the next poll of the accounts, in whichever process polls them
+    if not is_owner(update):
+        return
+    email_addrs = context.args or [conf['email_addr'] for conf in emailDB.get_all()]
+    for email_addr in email_addrs:
+        if not emailDB.get(email_addr):
+            update.message.reply_text(f'cannot find email account: {email_addr}')
+            return
+    for email_addr in email_addrs:
+        emailDB.update_cursor(email_addr, {'skip_backlog': 1})
+    emailDB.flush()
+    if bot_role == 'front':
+        # the workers find the flag at their next periodic task
+        update.message.reply_text(f"Skipping the unforwarded mail of {', '.join(email_addrs)} within {poll_interval}s")
+        return
+    for email_addr in email_addrs:
+        engine.poke(email_addr)
+    update.message.reply_text(f"Skipping the unforwarded mail of {', '.join(email_addrs)} at their next poll")
 
-def safeSend(sender, content):
-    for i in range(10):
+def setting_folders(update: Update, context: CallbackContext) -> None:
+    if not is_owner(update):
+        return
+    if not context.args:
+        update.message.reply_text("Usage: /set_folders john.doe@example.com [Folder, Other/Folder, ...]")
+        return
+    email_addr = context.args[0]
+    emailConfDict = emailDB.get(email_addr)
+    if not emailConfDict:
+        update.message.reply_text(f'cannot find email account: {email_addr}')
+        return
+    emailConf = getEmailConfFromDict(dict(emailConfDict))
+    if not emailConf.server_uri.startswith('imap'):
+        update.message.reply_text("Only IMAP accounts can watch other folders than the inbox")
+        return
+    async def list_folders():
+        client = await createEmailClient(emailConf)
         try:
-            sender(content)
-            break
-        except Exception:
-            logger.warning('cannot send tg msg (retry %d)', i, exc_info=True)
-        time.sleep(i * 5)
+            return await with_timeout(client.list_mailboxes())
+        finally:
+            client.kill()
+    available = engine.run_sync(list_folders())
+    # names may contain spaces, so they are separated by commas
+    requested = update.message.text.split(None, 2)[2] if len(context.args) > 1 else ''
+    if not requested:
+        update.message.reply_text(f"Watching: {', '.join(watchedFolders(emailConf))}\nOn the server: {', '.join(available)}")
+        return
+    folders = list(dict.fromkeys(folder.strip() for folder in requested.split(',') if folder.strip() and folder.strip() != INBOX))
+    unknown = [folder for folder in folders if folder not in available]
+    if unknown:
+        update.message.reply_text(f"No such folder: {', '.join(unknown)}\nOn the server: {', '.join(available)}")
+        return
+    # the cursors belong to the worker polling the account, it drops those of unwatched folders itself
+    emailDB.update_config(email_addr, {'folders': folders})
+    update.message.reply_text(f"Watching {', '.join([INBOX] + folders)} of {email_addr}, new mail from now on")
+
+# every bot api call made outside of command replies goes through it, rate limited and retried
+tgDispatcher = TelegramDispatcher(global_rate=tg_rate_global, chat_rate=tg_rate_chat, group_rate=tg_rate_group)
+
+def sendText(chat_id: int, content: str | list[str], priority=PRIORITY_NOTIFY, reply_markup=None, html=False,
+             reply_to: int | None = None, sent_all: list[Future] | None = None) -> Future:
+    # content: text, or chunks already split by split_message. reply_markup goes to the final chunk,
+    # reply_to to the first one, returns the future of the final chunk, sent_all collects those of every chunk
+    texts = split_message(content, html=html, max_chunks=max_message_chunks) if isinstance(content, str) else content
+    texts = texts or ['(empty)']
+    parseMode = ParseMode.HTML if html else None
+    for i, text in enumerate(texts):
+        markup = reply_markup if i == len(texts) - 1 else None
+        replyTo = reply_to if i == 0 else None
+        sent = tgDispatcher.submit(chat_id, lambda text=text, markup=markup, replyTo=replyTo: updater.bot.send_message( # type: ignore[has-type]
+            chat_id=chat_id, text=text, reply_markup=markup, parse_mode=parseMode,
+            reply_to_message_id=replyTo, allow_sending_without_reply=True), priority)
+        if sent_all is not None:
+            sent_all.append(sent)
+    return sent
+
+def rewind(content):
+    # spooled attachments are file handles, retries must upload them from the start again
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return content
 
 def getEmailConf(email_addr):
-    emailConfs = emailDB.getByQuery({'email_addr': email_addr})
-    if not emailConfs:
+    emailConfDict = emailDB.get(email_addr)
+    if not emailConfDict:
         raise Exception(f'cannot find config for email {email_addr}')
-    assert len(emailConfs) == 1
-    emailConfDict = emailConfs[0]
-    if 'id' in emailConfDict:
-        emailConfDict.pop('id')
-    emailConf = EmailConf(**emailConfDict)
-    return emailConf
+    return getEmailConfFromDict(emailConfDict)
 
 def getEmailConfFromDict(emailConfDict):
     if 'id' in emailConfDict:
@@ -216,133 +482,802 @@ def getEmailConfFromDict(emailConfDict):
     emailConf = EmailConf(**emailConfDict)
     return emailConf
 
-emailClientCache: dict[tuple, EmailClientBase] = {}
-def getEmailClient(emailConf: EmailConf) -> EmailClientBase:
-    cacheKey = tuple(dataclasses.astuple(emailConf))
-    emailClient: EmailClientBase | None = emailClientCache.get(cacheKey, None)
-    if emailClient:
-        try:
-            emailClient.refresh_connection()
-            logger.info(f'email client for {emailConf.email_addr} is still good')
-            return emailClient
-        except Exception as e:
-            logger.info(f'email client for {emailConf.email_addr} is invalid ({str(e)}), re-creating...')
-            emailClient = None
+def accountIdentity(emailConf: EmailConf) -> tuple:
+    # what a connection depends on, sync state (inbox_num, last_uid, ...) must not be part of it
+    return (emailConf.email_passwd, emailConf.server_uri)
 
-    EmailClient: Type[EmailClientBase]
+emailClientPool = ClientPool(max_size=client_pool_size, idle_timeout=client_idle_timeout, request_timeout=request_timeout)
+smtpPool = SmtpPool(timeout=request_timeout)
+cpuPool = CpuPool() if PARSE_WORKERS > 0 else None
+# backlog of all accounts polled by this process, per CATCHUP_WINDOW
+catchupBudget = SharedBudget()
+def leaseEmailClient(emailConf: EmailConf):
+    # only used from the engine loop, one connection per account reused across polls
+    return emailClientPool.lease(emailConf.email_addr, accountIdentity(emailConf), lambda: createEmailClient(emailConf))
+
+async def createEmailClient(emailConf: EmailConf) -> AsyncEmailClientBase:
+    EmailClient: Type[AsyncEmailClientBase]
     if emailConf.server_uri.startswith('pop3'):
-        EmailClient = EmailClientPOP3
+        EmailClient = AsyncEmailClientPOP3
     elif emailConf.server_uri.startswith('imap'):
-        EmailClient = EmailClientIMAP
+        EmailClient = AsyncEmailClientIMAP
     else:
         raise Exception(f"invalid email server_uri: {emailConf.server_uri}")
     
     emailClient = EmailClient(emailConf.email_addr, emailConf.email_passwd, emailConf.server_uri)
-    emailClientCache[cacheKey] = emailClient
+    emailClient.cpu_pool = cpuPool
+    try:
+        await with_timeout(emailClient.connect())
+    except BaseException:
+        emailClient.kill()
+        raise
     return emailClient
 
+async def with_timeout(aw):
+    # cancels the network operation for real, unlike the ThreadPool(1) approach this replaces
+    return await asyncio.wait_for(aw, request_timeout)
+
+async def anext_with_timeout(mails):
+    async def _anext():
+        # not anext(mails, default): its awaitable breaks when wrapped into a task by wait_for
+        try:
+            return await mails.__anext__()
+        except StopAsyncIteration:
+            return None, None
+    return await with_timeout(_anext())
+
+def run_blocking(fun, *args, **kwargs):
+    # telegram api and db calls are blocking, run them on the engine's bounded executor
+    return asyncio.get_running_loop().run_in_executor(engine.executor, functools.partial(fun, *args, **kwargs))
+
 PERIODIC_TASK_ERRORS: dict[str, dict[str, list[str]]] = {
     
 }
 PERIODIC_TASK_TICK = 0
+
+# accounts currently parked in IMAP IDLE, they are polled when pushed instead of every interval
+idlingAccounts: set[str] = set()
+
+def needsScheduledPoll(emailConf: EmailConf) -> bool:
+    # IDLE only pushes new mail of INBOX: the other watched folders, an open backlog or a pending skip are
+    # still left to the scheduled polls, which cost one batched STATUS when nothing changed
+    return bool(emailConf.backlogs or emailConf.skip_backlog or len(watchedFolders(emailConf)) > 1)
+
+async def poll_account(email_addr: str, woken: bool) -> int | None:
+    # returns the number of delivered mails, None if the mailbox was not looked at
+    try:
+        emailConf = await run_blocking(getEmailConf, email_addr)
+    except Exception:
+        logger.warning('Cannot load config of %s', email_addr, exc_info=True)
+        metrics.polls.inc(email_addr, 'skipped')
+        return None
+    if not polledHere(email_addr):
+        return None # its lease ran out, another worker may be polling it already
+    if not woken and email_addr in idlingAccounts and not needsScheduledPoll(emailConf):
+        return None
+    logger.info("processing periodic task for %s", email_addr)
+    started = time.monotonic()
+    budget = WorkBudget(shared=catchupBudget)
+    try:
+        async with leaseEmailClient(emailConf) as client:
+            bytesBefore = client.bytes_received
+            try:
+                if emailConf.skip_backlog:
+                    delivered = await skip_backlog(emailConf, client)
+                elif client.supports_uid_sync():
+                    delivered = await _poll_account_by_uid(emailConf, client, budget)
+                elif client.supports_uidl_sync():
+                    delivered = await _poll_account_by_uidl(emailConf, client, budget)
+                else:
+                    delivered = await _poll_account_by_index(emailConf, client, budget)
+            finally:
+                metrics.fetched_bytes.inc(email_addr, amount=client.bytes_received - bytesBefore)
+        metrics.polls.inc(email_addr, 'ok')
+        return delivered
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        metrics.polls.inc(email_addr, 'error')
+        if re.findall(r'\bEOF\b', str(e)):
+            pass # do not process occasional random network issue
+        elif re.findall(r'Server Unavailable. 21', str(e)):
+            pass # ignore stupid outlook server error
+        else:
+            if email_addr not in PERIODIC_TASK_ERRORS:
+                PERIODIC_TASK_ERRORS[email_addr] = {}
+            exceptionStr = str(e) or type(e).__name__
+            if exceptionStr not in PERIODIC_TASK_ERRORS[email_addr]:
+                PERIODIC_TASK_ERRORS[email_addr][exceptionStr] = []
+            PERIODIC_TASK_ERRORS[email_addr][exceptionStr].append(format_exc())
+        logger.warning('periodic task error in %s', email_addr, exc_info=True)
+        return None
+    finally:
+        metrics.poll_duration.observe(time.monotonic() - started, email_addr)
+
+def mailPriority(delivered: int) -> int:
+    # the first few mails of a poll are notifications, the rest of a backlog is sent as bulk behind them
+    return PRIORITY_NOTIFY if delivered < catchup_notify_mails else PRIORITY_BULK
+
+def claimOwner(emailConf: EmailConf, folder: str) -> str:
+    # folders of one account claim separately, a mail in INBOX and in a label folder is only sent once
+    return emailConf.email_addr if folder == INBOX else f'{emailConf.email_addr}/{folder}'
+
+async def claim_messages(emailConf: EmailConf, message_ids: list[str], priority: int, folder=INBOX) -> set[str]:
+    # aliases and shared mailboxes get the same mail in several accounts, only the first copy sent
+    # to a chat is delivered, later ones become a reply to it. returns the duplicate message ids
+    message_ids = [message_id for message_id in message_ids if message_id]
+    if not dedup_index_size or not message_ids:
+        return set()
+    owner = claimOwner(emailConf, folder)
+    duplicates = await run_blocking(emailDB.claim_messages, emailConf.chat_id, owner, message_ids)
+    for message_id, claim in duplicates.items():
+        logger.info('%s in %s was delivered by %s already', message_id, owner, claim['email_addr'])
+        text = f'Also delivered to {owner}'
+        if not claim['tg_message_id']:
+            text += f' (first copy from {claim["email_addr"]}, {message_id})'
+        await run_blocking(sendText, emailConf.chat_id, text, priority, reply_to=claim['tg_message_id'])
+    return set(duplicates)
+
+def sentMessageId(result) -> int | None:
+    # send_message returns a Message, send_media_group a list of them
+    if isinstance(result, list):
+        result = result[0] if result else None
+    return getattr(result, 'message_id', None)
+
+async def convertHtml(mail: Email):
+    # html conversion is pure python and the heaviest part of parsing: large bodies go to the cpu pool,
+    # so one newsletter does not stall every other account on the engine loop
+    payload = mail.raw_html
+    if payload is None or not cpuPool or len(payload) < PARSE_OFFLOAD_MIN_SIZE:
+        return # converted in place when rendered
+    cached = htmlConverter.cached(payload)
+    if cached is not None:
+        mail.set_html(cached)
+        return
+    try:
+        (text, outcome), elapsed = await cpuPool.run(render_html, payload)
+    except (asyncio.TimeoutError, CpuPoolError):
+        logger.warning('cannot convert html of %s in the cpu pool, fallback to raw HTML instead.', mail.id, exc_info=True)
+        text, outcome, elapsed = htmlConverter.fallback(payload), 'failed', 0
+    htmlConverter.remember(payload, text, outcome)
+    mail.set_html(text)
+    mail.parse_time += elapsed
+
+class DeliveryError(Exception):
+    pass
+
+async def deliver(emailConf: EmailConf, idx: int, mail: Email, delivered: int, uidl: str | None = None, claimed=False, folder=INBOX,
+                  priority: int | None = None) -> bool:
+    # waits (without holding a thread) until telegram got the mail, so the cursor only moves past sent mails.
+    # claimed: the message id was checked against the dedup index before the mail was fetched.
+    # returns False for a copy another account delivered already, raises DeliveryError if sending failed:
+    # that ends the poll before the cursor moves, the mail is tried again by the next one
+    if priority is None:
+        priority = mailPriority(delivered)
+    owner = claimOwner(emailConf, folder)
+    if not claimed and mail.id in await claim_messages(emailConf, [mail.id], priority, folder):
+        mail.close()
+        return False
+    await convertHtml(mail)
+    metrics.parse_duration.observe(mail.parse_time, emailConf.email_addr)
+    try:
+        rendered = await renderMailOffloaded(emailConf, idx, mail, folder)
+    except BaseException:
+        mail.close()
+        raise
+    started = time.monotonic()
+    sent = await run_blocking(deliver_mail, emailConf, idx, mail, uidl, priority, folder, rendered)
+    try:
+        result = await asyncio.wrap_future(sent)
+        metrics.delivery_duration.observe(time.monotonic() - started, emailConf.email_addr)
+        metrics.delivered_mails.inc(emailConf.email_addr)
+    except Exception as e:
+        if dedup_index_size and mail.id:
+            await run_blocking(emailDB.release_message, mail.id, emailConf.chat_id, owner)
+        raise DeliveryError(f'mail {idx} of {emailConf.email_addr} was not delivered to telegram completely') from e
+    if dedup_index_size and mail.id:
+        await run_blocking(emailDB.set_message_ref, mail.id, emailConf.chat_id, owner, sentMessageId(result))
+    return True
+
+async def _poll_account_by_index(emailConf: EmailConf, client: AsyncEmailClientBase, budget: WorkBudget) -> int:
+    # pop3 servers without UIDL: no ids to remember a backlog by, it is delivered in order and resumes from inbox_num
+    email_addr = emailConf.email_addr
+    delivered = 0
+    new_inbox_num = await with_timeout(client.get_mails_count())
+    if new_inbox_num > emailConf.inbox_num:
+        first_idx = emailConf.inbox_num + 1
+        remaining = budget.remaining_mails()
+        last_idx = new_inbox_num if remaining is None else min(new_inbox_num, first_idx + max(remaining, 1) - 1)
+        mails = client.get_mails_by_range(first_idx, last_idx)
+        while True:
+            isBacklog = mailPriority(delivered) == PRIORITY_BULK
+            if budget.exhausted(isBacklog):
+                break
+            bytesBefore = client.bytes_received
+            try:
+                idx, mail = await anext_with_timeout(mails)
+                if idx is None:
+                    break
+            except asyncio.TimeoutError:
+                raise
+            except Exception:
+                logger.warning('cannot retrieve mail after %d for %s', emailConf.inbox_num, emailConf, exc_info=True)
+                break
+            budget.spend(client.bytes_received - bytesBefore, isBacklog)
+            
+            await deliver(emailConf, idx, mail, delivered)
+            await run_blocking(emailDB.update_cursor, email_addr, {'inbox_num': idx})
+            emailConf.inbox_num = idx
+            delivered += 1
+    return delivered
+
+async def init_sync_state(emailConf: EmailConf, client: AsyncEmailClientBase) -> dict:
+    # (re)establish the UID high-water mark / seen UIDL set, returns the changed fields
+    if client.supports_uidl_sync():
+        emailConf.seen_uidls = list(await with_timeout(client.get_uidl_listing()))
+        return {'seen_uidls': emailConf.seen_uidls}
+    mailboxStatus = await with_timeout(client.get_mailbox_status())
+    if emailConf.uid_validity == 0 and 0 < emailConf.inbox_num <= mailboxStatus.messages:
+        # migrating from the sequence number counter: continue right after the last delivered message
+        last_uid = await with_timeout(client.get_uid_by_index(emailConf.inbox_num))
+    else:
+        if emailConf.uid_validity:
+            logger.warning('UIDVALIDITY of %s changed (%d -> %d), mailbox was renumbered, skipping to newest mail',
+                           emailConf.email_addr, emailConf.uid_validity, mailboxStatus.uidvalidity)
+        last_uid = mailboxStatus.uidnext - 1
+    emailConf.uid_validity = mailboxStatus.uidvalidity
+    emailConf.last_uid = last_uid
+    emailConf.highest_modseq = mailboxStatus.highestmodseq
+    emailConf.inbox_num = mailboxStatus.messages
+    return {
+        'uid_validity': emailConf.uid_validity,
+        'last_uid': emailConf.last_uid,
+        'highest_modseq': emailConf.highest_modseq,
+        'inbox_num': emailConf.inbox_num,
+    }
+
+def folderCursor(emailConf: EmailConf, folder: str) -> dict:
+    # INBOX keeps the account's own cursor columns, the other folders share the folder_cursors json
+    if folder == INBOX:
+        return {'uid_validity': emailConf.uid_validity, 'last_uid': emailConf.last_uid, 'highest_modseq': emailConf.highest_modseq}
+    return {'uid_validity': 0, 'last_uid': 0, 'highest_modseq': 0, **(emailConf.folder_cursors or {}).get(folder, {})}
+
+def folderBacklog(emailConf: EmailConf, folder: str) -> list[list[int]]:
+    # uid ranges [after_uid, last_uid] of the folder left for later polls, oldest first
+    return [list(uidRange) for uidRange in (emailConf.backlogs or {}).get(folder, [])]
+
+async def saveFolderCursor(emailConf: EmailConf, folder: str, fields: dict, backlog: list[list[int]] | None = None):
+    # backlog: the folder's remaining backlog ranges, saved in the same update as fields
+    extra = {}
+    if backlog is not None:
+        emailConf.backlogs = {k: v for k, v in {**(emailConf.backlogs or {}), folder: backlog}.items() if v}
+        extra['backlogs'] = emailConf.backlogs
+    if folder == INBOX:
+        for k, v in fields.items():
+            setattr(emailConf, k, v)
+        await run_blocking(emailDB.update_cursor, emailConf.email_addr, {**fields, **extra})
+        return
+    emailConf.folder_cursors = {**(emailConf.folder_cursors or {}), folder: {**folderCursor(emailConf, folder), **fields}}
+    await run_blocking(emailDB.update_cursor, emailConf.email_addr, {'folder_cursors': emailConf.folder_cursors, **extra})
+
+def watchedFolders(emailConf: EmailConf) -> list[str]:
+    return [INBOX] + [folder for folder in emailConf.folders or [] if folder != INBOX]
+
+async def forgetUnwatchedFolders(emailConf: EmailConf):
+    # cursors and backlogs of folders /set_folders removed, so a folder watched again starts from new mail
+    folders = watchedFolders(emailConf)
+    cursors = {k: v for k, v in (emailConf.folder_cursors or {}).items() if k in folders}
+    backlogs = {k: v for k, v in (emailConf.backlogs or {}).items() if k in folders}
+    if cursors == (emailConf.folder_cursors or {}) and backlogs == (emailConf.backlogs or {}):
+        return
+    emailConf.folder_cursors, emailConf.backlogs = cursors, backlogs
+    await run_blocking(emailDB.update_cursor, emailConf.email_addr, {'folder_cursors': cursors, 'backlogs': backlogs})
+
+async def _poll_account_by_uid(emailConf: EmailConf, client: AsyncEmailClientBase, budget: WorkBudget) -> int:
+    # every watched folder is checked in one round trip, only folders with changes are selected.
+    # new mail of every folder goes first, the backlogs share whatever budget is left after it
+    await forgetUnwatchedFolders(emailConf)
+    folders = watchedFolders(emailConf)
+    statuses: dict[str, MailboxStatus] = await with_timeout(client.get_mailboxes_status(folders))
+    if INBOX not in statuses:
+        raise Exception(f'no STATUS of {INBOX} from the server')
+    delivered = 0
+    catchUp: dict[str, list[int]] = {}
+    try:
+        for folder in folders:
+            if folder in statuses:
+                client.mailbox = folder
+                fetched, uids = await _poll_folder_by_uid(emailConf, client, folder, statuses[folder], delivered, budget)
+                delivered += fetched
+                if uids is not None:
+                    catchUp[folder] = uids
+        for folder, uids in catchUp.items():
+            if budget.exhausted(backlog=True):
+                break
+            client.mailbox = folder
+            delivered += await _catch_up_folder_by_uid(emailConf, client, folder, uids, delivered, budget)
+    finally:
+        client.mailbox = INBOX # the pooled connection is reused by the next poll
+    return delivered
+
+async def _poll_folder_by_uid(emailConf: EmailConf, client: AsyncEmailClientBase, folder: str, mailboxStatus: MailboxStatus,
+                              delivered: int, budget: WorkBudget) -> tuple[int, list[int] | None]:
+    # delivers the new mail of the folder. delivered: mails of the account delivered by this poll so far,
+    # for their priority. returns the number delivered and, when the folder has an open backlog and all
+    # its new mail is out, the searched uids for _catch_up_folder_by_uid
+    email_addr = emailConf.email_addr
+    cursor = folderCursor(emailConf, folder)
+    backlog = folderBacklog(emailConf, folder)
+    if mailboxStatus.uidvalidity != cursor['uid_validity']:
+        if folder == INBOX:
+            await saveFolderCursor(emailConf, folder, await init_sync_state(emailConf, client), backlog=[])
+        else:
+            if cursor['uid_validity']:
+                logger.warning('UIDVALIDITY of %s/%s changed (%d -> %d), skipping to newest mail',
+                               email_addr, folder, cursor['uid_validity'], mailboxStatus.uidvalidity)
+            # a newly watched folder starts at its newest mail, the backlog in it is not forwarded
+            await saveFolderCursor(emailConf, folder, {'uid_validity': mailboxStatus.uidvalidity, 'last_uid': mailboxStatus.uidnext - 1,
+                                                       'highest_modseq': mailboxStatus.highestmodseq}, backlog=[])
+        return 0, None
+    if mailboxStatus.highestmodseq and mailboxStatus.highestmodseq == cursor['highest_modseq'] and not backlog:
+        return 0, None # CONDSTORE: nothing at all changed in the mailbox
+    fetched = 0
+    uids: list[int] = []
+    if mailboxStatus.uidnext - 1 > cursor['last_uid'] or backlog:
+        # one search covers the new mail and the open backlog ranges
+        uids = await with_timeout(client.search_uids_since(min([after for after, _ in backlog] + [cursor['last_uid']])))
+        newUids = [uid for uid in uids if uid > cursor['last_uid']]
+        fresh, older = split_fresh(newUids, budget.remaining_mails(), catchup_notify_mails)
+        if not fresh and newUids:
+            return 0, None # the budget is spent, all of it stays new mail for the next poll
+        if older:
+            # more new mail than this poll may take: the newest few go out now, the older ones join the backlog
+            backlog.append([cursor['last_uid'], older[-1]])
+            cursor['last_uid'] = older[-1]
+            await saveFolderCursor(emailConf, folder, {'last_uid': older[-1]}, backlog)
+            logger.info('%s/%s: %d older mails left for later polls', email_addr, folder, len(older))
+        async def saveHead(uid: int):
+            if uid > cursor['last_uid']:
+                cursor['last_uid'] = uid
+                await saveFolderCursor(emailConf, folder, {'last_uid': uid})
+        fetched, caughtUp = await _deliver_by_uids(emailConf, client, folder, fresh, delivered, budget, saveHead)
+        if not caughtUp:
+            return fetched, None
+    # all new mail is delivered, the modseq may only be advanced now
+    fields = {'highest_modseq': mailboxStatus.highestmodseq}
+    if folder == INBOX:
+        fields['inbox_num'] = mailboxStatus.messages
+    await saveFolderCursor(emailConf, folder, fields)
+    return fetched, uids if backlog else None
+
+async def _catch_up_folder_by_uid(emailConf: EmailConf, client: AsyncEmailClientBase, folder: str, uids: list[int],
+                                  delivered: int, budget: WorkBudget) -> int:
+    # the backlog gets what is left of the budget, oldest range first
+    backlog = folderBacklog(emailConf, folder)
+    fetched = 0
+    for uidRange in list(backlog):
+        rangeUids = [uid for uid in uids if uidRange[0] < uid <= uidRange[1]]
+        remaining = budget.remaining_mails()
+        batch = rangeUids if remaining is None else rangeUids[:remaining]
+        async def saveRange(uid: int, uidRange=uidRange):
+            uidRange[0] = uid
+            await saveFolderCursor(emailConf, folder, {}, backlog)
+        count, done = await _deliver_by_uids(emailConf, client, folder, batch, delivered + fetched, budget, saveRange, backlog=True)
+        fetched += count
+        if not done or len(batch) < len(rangeUids):
+            break
+        backlog.remove(uidRange)
+        await saveFolderCursor(emailConf, folder, {}, backlog)
+        if not backlog:
+            logger.info('%s/%s caught up with its backlog', emailConf.email_addr, folder)
+    return fetched
+
+async def _deliver_by_uids(emailConf: EmailConf, client: AsyncEmailClientBase, folder: str, uids: list[int], delivered: int,
+                           budget: WorkBudget, save: typing.Callable[[int], typing.Awaitable], backlog=False) -> tuple[int, bool]:
+    # delivers uids in order while the budget lasts, save(uid) persists the progress after every mail.
+    # returns the number delivered and whether all of them were
+    duplicateUids: set[int] = set()
+    if dedup_index_size and uids:
+        # only a small header fetch for copies another account delivered already
+        messageIds = await with_timeout(client.get_message_ids_by_uids(uids))
+        duplicates = await claim_messages(emailConf, [messageIds.get(uid, '') for uid in uids],
+                                          PRIORITY_BULK if backlog else PRIORITY_NOTIFY, folder)
+        duplicateUids = {uid for uid in uids if messageIds.get(uid) in duplicates}
+    mails = client.get_mails_by_uids([uid for uid in uids if uid not in duplicateUids], lazy_attachments=lazy_attachments)
+    fetched = 0
+    try:
+        while True:
+            if budget.exhausted(backlog):
+                return fetched, False
+            bytesBefore = client.bytes_received
+            try:
+                uid, mail = await anext_with_timeout(mails)
+                if uid is None:
+                    break
+            except asyncio.TimeoutError:
+                raise
+            except Exception:
+                logger.warning('cannot retrieve mail of %s in %s for %s', uids, folder, emailConf, exc_info=True)
+                return fetched, False
+            budget.spend(client.bytes_received - bytesBefore, backlog)
+            
+            await deliver(emailConf, uid, mail, delivered + fetched, claimed=bool(dedup_index_size), folder=folder,
+                          priority=PRIORITY_BULK if backlog else None)
+            await save(uid)
+            fetched += 1
+    finally:
+        await mails.aclose()
+    if uids:
+        await save(uids[-1]) # skipped duplicates at the end
+    return fetched, True
+
+async def _poll_account_by_uidl(emailConf: EmailConf, client: AsyncEmailClientBase, budget: WorkBudget) -> int:
+    email_addr = emailConf.email_addr
+    listing: dict[str, tuple[int, int]] = await with_timeout(client.get_uidl_listing())
+    if emailConf.seen_uidls is None:
+        # migrating from the message counter: everything up to inbox_num was delivered already
+        seen = {uidl for uidl, (index, _) in listing.items() if index <= emailConf.inbox_num}
+    else:
+        seen = set(emailConf.seen_uidls)
+    
+    # the listing is in arrival order: unseen mails older than the newest seen one are the backlog
+    # of an earlier poll which was cut short, the ones after it are fresh
+    uidls = list(listing)
+    lastSeen = max((pos for pos, uidl in enumerate(uidls) if uidl in seen), default=-1)
+    backlogUidls = [uidl for uidl in uidls[:lastSeen] if uidl not in seen]
+    freshUidls = uidls[lastSeen + 1:]
+    # more new mail than this poll may take: the newest few go out now, the older ones join the backlog
+    freshUidls, olderUidls = split_fresh(freshUidls, budget.remaining_mails(), catchup_notify_mails)
+    backlogUidls += olderUidls
+    backlog = set(backlogUidls)
+    newUidls = freshUidls + backlogUidls
+    delivered = 0
+    try:
+        for uidl in newUidls:
+            isBacklog = uidl in backlog
+            if budget.exhausted(isBacklog):
+                break
+            index, size = listing[uidl]
+            priority = PRIORITY_BULK if isBacklog else mailPriority(delivered)
+            bytesBefore = client.bytes_received
+            try:
+                # a copy delivered by another account is told apart by the Message-ID of the retrieved headers
+                if pop3_preview_size and size > pop3_preview_size:
+                    mail = await with_timeout(client.get_mail_preview(index, pop3_preview_lines, size))
+                else:
+                    mail = await with_timeout(client.get_mail_by_index(index, size))
+            except asyncio.TimeoutError:
+                raise
+            except Exception:
+                logger.warning('cannot retrieve mail %s (%d) for %s', uidl, index, emailConf, exc_info=True)
+                break
+            budget.spend(client.bytes_received - bytesBefore, isBacklog)
+            
+            sent = await deliver(emailConf, index, mail, delivered, uidl=uidl, priority=priority)
+            seen.add(uidl)
+            delivered += sent
+    finally:
+        # once per poll, also when it ends early. only uidls still on the server are kept, deleted mails drop out
+        seenUidls = [uidl for uidl in listing if uidl in seen]
+        if seenUidls != emailConf.seen_uidls:
+            emailConf.seen_uidls = seenUidls
+            await run_blocking(emailDB.update_cursor, email_addr, {'seen_uidls': seenUidls, 'inbox_num': len(listing)})
+    return delivered
+
+async def skip_backlog(emailConf: EmailConf, client: AsyncEmailClientBase) -> int:
+    # asked for by the owner: all mail on the server counts as delivered, forwarding goes on from now
+    email_addr = emailConf.email_addr
+    skipped = 0
+    if client.supports_uid_sync():
+        statuses: dict[str, MailboxStatus] = await with_timeout(client.get_mailboxes_status(watchedFolders(emailConf)))
+        try:
+            for folder, mailboxStatus in statuses.items():
+                cursor = folderCursor(emailConf, folder)
+                backlog = folderBacklog(emailConf, folder)
+                if mailboxStatus.uidvalidity == cursor['uid_validity']:
+                    client.mailbox = folder
+                    uids = await with_timeout(client.search_uids_since(min([after for after, _ in backlog] + [cursor['last_uid']])))
+                    skipped += sum(1 for uid in uids if uid > cursor['last_uid'] or any(after < uid <= last for after, last in backlog))
+                fields = {'uid_validity': mailboxStatus.uidvalidity, 'last_uid': mailboxStatus.uidnext - 1,
+                          'highest_modseq': mailboxStatus.highestmodseq}
+                if folder == INBOX:
+                    fields['inbox_num'] = mailboxStatus.messages
+                await saveFolderCursor(emailConf, folder, fields, backlog=[])
+        finally:
+            client.mailbox = INBOX
+    elif client.supports_uidl_sync():
+        listing = await with_timeout(client.get_uidl_listing())
+        skipped = len(set(listing) - set(emailConf.seen_uidls or []))
+        emailConf.seen_uidls = list(listing)
+        await run_blocking(emailDB.update_cursor, email_addr, {'seen_uidls': emailConf.seen_uidls, 'inbox_num': len(listing)})
+    else:
+        inbox_num = await with_timeout(client.get_mails_count())
+        skipped = max(inbox_num - emailConf.inbox_num, 0)
+        emailConf.inbox_num = inbox_num
+        await run_blocking(emailDB.update_cursor, email_addr, {'inbox_num': inbox_num})
+    emailConf.skip_backlog = 0
+    await run_blocking(emailDB.update_cursor, email_addr, {'skip_backlog': 0})
+    logger.info('skipped %d mails of %s', skipped, email_addr)
+    await run_blocking(sendText, owner_chat_id, f'Skipped {skipped} mails of {email_addr}, forwarding new mail from now on', PRIORITY_INTERACTIVE)
+    return 0
+
+async def idle_account(email_addr: str, poke):
+    # parks a dedicated connection in IMAP IDLE (RFC 2177) and pokes the poller on new mail
+    emailConf = await run_blocking(getEmailConf, email_addr)
+    if not imap_idle or not emailConf.server_uri.startswith('imap'):
+        return
+    client = await createEmailClient(emailConf)
+    try:
+        if not client.supports_idle():
+            logger.info('%s does not support IDLE, falling back to polling', email_addr)
+            return
+        idlingAccounts.add(email_addr)
+        poke() # catch up with whatever arrived while we were not idling
+        while True:
+            if await client.idle(imap_idle_renew_interval):
+                poke()
+    finally:
+        idlingAccounts.discard(email_addr)
+        client.kill()
+
+MAX_MEDIA_GROUP_SIZE = 10
+
+def renderMail(emailConf: EmailConf, idx: int, mail: Email, folder: str) -> tuple[str, list]:
+    # -> (message text, attachments)
+    inFolder = f' in {folder}' if folder != INBOX else ''
+    header = f'''New Email{inFolder} [{emailConf.email_addr}-{idx}]\n'''
+    emailbody, emailfiles = mail.format_email(html=message_html)
+    return (escape(header) if message_html else header) + emailbody, emailfiles
+
+async def renderMailOffloaded(emailConf: EmailConf, idx: int, mail: Email, folder: str) -> tuple[list[str], list]:
+    # splitting is pure python as well: large texts are split in the cpu pool, see convertHtml
+    started = time.perf_counter()
+    text, emailfiles = renderMail(emailConf, idx, mail, folder)
+    if not cpuPool or len(text) < PARSE_OFFLOAD_MIN_SIZE:
+        chunks = split_message(text, html=message_html, max_chunks=max_message_chunks)
+    else:
+        try:
+            chunks, _ = await cpuPool.run(split_message, text, MAX_MESSAGE_LENGTH, message_html, max_message_chunks)
+        except (asyncio.TimeoutError, CpuPoolError):
+            logger.warning('cannot split %s in the cpu pool, splitting it in place instead.', mail.id, exc_info=True)
+            chunks = split_message(text, html=message_html, max_chunks=max_message_chunks)
+    metrics.render_duration.observe(time.perf_counter() - started, emailConf.email_addr)
+    return chunks, emailfiles
+
+def deliver_mail(emailConf: EmailConf, idx: int, mail: Email, uidl: str | None = None, priority=PRIORITY_NOTIFY, folder=INBOX,
+                 rendered: tuple[list[str], list] | None = None) -> Future:
+    # queues the messages of a mail, the returned future resolves once all of them were sent.
+    # rendered: (chunks, attachments) if rendered already, see renderMailOffloaded
+    try:
+        sent = _deliver_mail(emailConf, idx, mail, uidl, priority, folder, rendered)
+    except BaseException:
+        mail.close()
+        raise
+    sent.add_done_callback(lambda _: mail.close()) # spooled attachments, sent in order per chat
+    return sent
+
+def _deliver_mail(emailConf: EmailConf, idx: int, mail: Email, uidl: str | None, priority: int, folder: str,
+                  rendered: tuple[list[str], list] | None) -> Future:
+    # rendered and split once, the first chunk may become a caption
+    if rendered is None:
+        started = time.perf_counter()
+        text, emailfiles = renderMail(emailConf, idx, mail, folder)
+        chunks = split_message(text, html=message_html, max_chunks=max_message_chunks)
+        metrics.render_duration.observe(time.perf_counter() - started, emailConf.email_addr)
+    else:
+        chunks, emailfiles = rendered
+    
+    reply_markup = None
+    if mail.lazy_parts:
+        # attachments left on the server, fetched by BODY.PEEK[section] when the button is pressed
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton(f'Download {part.filename or part.type} ({part.size} bytes)',
+                                  callback_data=f'att:{accountKey(emailConf.email_addr)}:{folderCursor(emailConf, folder)["uid_validity"]}:{idx}:{part.section}'
+                                                + folderKey(folder))]
+            for part in mail.lazy_parts
+        ])
+    elif mail.truncated_size and uidl:
+        reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton(
+            f'Download full message ({mail.truncated_size} bytes)',
+            callback_data=f'pop:{accountKey(emailConf.email_addr)}:{uidlKey(uidl)}')]])
+    photos, documents = [], []
+    for filename, filemime, file_content in emailfiles:
+        # telegram only renders jpeg/png as photos, anything else (or too large) goes as a document
+        if filemime in ('image/jpeg', 'image/png') and contentSize(file_content) <= MAX_PHOTOSIZE_UPLOAD:
+            photos.append((filename, file_content))
+        else:
+            documents.append((filename, file_content))
+    caption = None
+    sentAll: list[Future] = []
+    if (photos or documents) and not reply_markup and len(chunks) == 1 and utf16_len(chunks[0]) <= MAX_CAPTION_LENGTH:
+        caption = chunks[0] # media groups cannot carry a reply_markup
+    else:
+        sendText(emailConf.chat_id, chunks, priority, reply_markup=reply_markup, html=message_html, sent_all=sentAll)
+    # albums cannot mix photos and documents
+    for kind, files in (('photo', photos), ('document', documents)):
+        for i in range(0, len(files), MAX_MEDIA_GROUP_SIZE):
+            sentAll.append(sendMedia(emailConf.chat_id, kind, files[i:i + MAX_MEDIA_GROUP_SIZE], caption, priority, html=message_html))
+            caption = None
+    recordReplyContext(emailConf, uidl or (str(idx) if folder == INBOX else f'{folder}/{idx}'), mail, sentAll)
+    return allSent(sentAll)
+
+def allSent(futures: list[Future]) -> Future:
+    # resolves once every message of a mail is out, to the result of the last one. a mail with a chunk
+    # or album missing is not delivered, so this fails with the first error if any of them failed
+    combined: Future = Future()
+    lock = threading.Lock()
+    pending = len(futures)
+    def done(_):
+        nonlocal pending
+        with lock:
+            pending -= 1
+            if pending:
+                return
+        for future in futures:
+            error = CancelledError() if future.cancelled() else future.exception()
+            if error is not None:
+                combined.set_exception(error)
+                return
+        combined.set_result(futures[-1].result())
+    for future in futures:
+        future.add_done_callback(done)
+    return combined
+
+def recordReplyContext(emailConf: EmailConf, mail_ref: str, mail: Email, sent_all: list[Future]):
+    # a reply to any message of the mail (a later chunk, an attachment) finds the mail again
+    context = {
+        'email_addr': emailConf.email_addr,
+        'mail_ref': mail_ref,
+        'message_id': mail.id,
+        'mail_references': mail.references,
+        'from_addr': mail.sender[1],
+        'subject': mail.subject,
+    }
+    def record(future: Future):
+        if future.cancelled() or future.exception():
+            return
+        result = future.result()
+        messageIds = [message.message_id for message in (result if isinstance(result, list) else [result])]
+        emailDB.add_reply_context(emailConf.chat_id, messageIds, context)
+    for sent in sent_all:
+        sent.add_done_callback(record)
+
+def contentSize(content) -> int:
+    if hasattr(content, 'seek'):
+        size = content.seek(0, os.SEEK_END)
+        content.seek(0)
+        return size
+    return len(content)
+
+def sendMedia(chat_id: int, kind: str, files: list[tuple[str, typing.Any]], caption: str | None, priority: int, html=False) -> Future:
+    # one sendMediaGroup call for up to 10 files of the same kind, caption goes to the first one
+    parseMode = ParseMode.HTML if html else None
+    def send():
+        # InputFile reads the content when created, so build them on every attempt
+        if len(files) == 1:
+            filename, content = files[0]
+            if kind == 'photo':
+                return updater.bot.send_photo(chat_id=chat_id, photo=rewind(content), filename=filename, caption=caption, parse_mode=parseMode) # type: ignore[has-type]
+            return updater.bot.send_document(chat_id=chat_id, document=rewind(content), filename=filename, caption=caption, parse_mode=parseMode) # type: ignore[has-type]
+        InputMedia = InputMediaPhoto if kind == 'photo' else InputMediaDocument
+        return updater.bot.send_media_group(chat_id=chat_id, media=[ # type: ignore[has-type]
+            InputMedia(media=rewind(content), filename=filename, caption=caption if i == 0 else None, parse_mode=parseMode if i == 0 else None)
+            for i, (filename, content) in enumerate(files)
+        ])
+    return tgDispatcher.submit(chat_id, send, priority)
+
+def accountKey(email_addr: str) -> str:
+    # short stable id, telegram limits callback_data to 64 bytes
+    return hashlib.sha1(email_addr.encode()).hexdigest()[:10]
+
+def uidlKey(uidl: str) -> str:
+    # uidls may be up to 70 chars long
+    return hashlib.sha1(uidl.encode()).hexdigest()[:16]
+
+def folderKey(folder: str) -> str:
+    # callback_data suffix locating a watched folder, names may not fit in 64 bytes. by name and not
+    # by position, so buttons keep pointing at their folder when /set_folders reorders the list
+    return '' if folder == INBOX else ':' + hashlib.sha1(folder.encode()).hexdigest()[:8]
+
+def getEmailConfByAccountKey(key: str) -> EmailConf | None:
+    for emailConfDict in emailDB.get_all():
+        if accountKey(emailConfDict.get('email_addr', '')) == key:
+            return getEmailConfFromDict(emailConfDict)
+    return None
+
+def handle_attachment_download(update: Update, context: CallbackContext):
+    query = update.callback_query
+    _, key, uid_validity, uid, section, *rest = query.data.split(':')
+    emailConf = getEmailConfByAccountKey(key)
+    if not emailConf or update.effective_chat.id not in (emailConf.chat_id, owner_chat_id):
+        query.answer('Email account not found')
+        return
+    suffix = ''.join(':' + k for k in rest) # folderKey() of the folder, empty for INBOX
+    folder = next((folder for folder in watchedFolders(emailConf) if folderKey(folder) == suffix), None)
+    if folder is None:
+        query.answer('Folder is not watched anymore')
+        return
+    query.answer('Downloading...')
+    async def fetch_part():
+        # separate short-lived connection, the cached one belongs to the account's poll task
+        client = await createEmailClient(emailConf)
+        client.mailbox = folder
+        try:
+            if (await with_timeout(client.get_mailbox_status())).uidvalidity != int(uid_validity):
+                return None, None
+            return await with_timeout(client.get_part_by_uid(int(uid), section))
+        finally:
+            client.kill()
+    part, content = engine.run_sync(fetch_part())
+    if part is None:
+        query.message.reply_text('Mailbox was renumbered on the server (UIDVALIDITY changed), cannot locate the attachment anymore')
+        return
+    filename = part.filename or f'part-{section}'
+    tgDispatcher.submit(query.message.chat_id, lambda: context.bot.send_document(chat_id=query.message.chat_id, document=content, filename=filename,
+                                                                                   reply_to_message_id=query.message.message_id), PRIORITY_INTERACTIVE)
+
+engine: AsyncPollEngine = None # type: ignore[assignment]
+shard: ShardCoordinator | None = None
+
+def polledHere(email_addr: str) -> bool:
+    if bot_role == 'all':
+        return True
+    return shard is not None and email_addr in shard.owned
+
+def shareGlobalRate():
+    # the telegram limit is per bot, split evenly between the front and the live workers
+    workers = len(shard.live_workers) if shard else len(emailDB.get_workers())
+    tgDispatcher.set_global_rate(tg_rate_global / (workers + 1))
+
+def releaseAccounts(email_addrs: set[str]):
+    # before another worker may poll them: no poll of them is left running and their cursors are committed
+    engine.run_sync(engine.stop_accounts(email_addrs), timeout=request_timeout)
+    emailDB.flush()
+    retainTokens()
+
+def retainTokens(emailConfDicts: list[dict] | None = None):
+    # oauth tokens are only refreshed ahead of time for accounts this process still talks to:
+    # a worker polls its own accounts, the front sends mail for all of them
+    refreshTokens = set()
+    for emailConfDict in emailDB.get_all() if emailConfDicts is None else emailConfDicts:
+        if bot_role == 'worker' and not polledHere(emailConfDict['email_addr']):
+            continue
+        try:
+            refreshToken = OAuth2Factory.refresh_token_from_string(emailConfDict['email_passwd'] or '')
+        except ValueError:
+            continue
+        if refreshToken:
+            refreshTokens.add(refreshToken)
+    TokenStore.retain(refreshTokens)
+
 def periodic_task() -> None:
-    # {
-    #     'email_addr': email_addr,
-    #     'email_passwd': email_passwd,
-    #     'server_uri': email_server,
-    #     'chat_id': update.message.chat_id,
-    # }
+    # accounts are polled by their own task on the engine, this only syncs the account list
     global PERIODIC_TASK_TICK
     logger.info("entered periodic task, tick: %d...", PERIODIC_TASK_TICK)
     PERIODIC_TASK_TICK += 1
     
-    # updater.bot.send_message()
-    def handler(emailConfDict, managers=None):
-        logger.info("processing periodic task for %s", emailConfDict)
+    accounts = {}
+    skipping = []
+    emailConfDicts = emailDB.get_all()
+    retainTokens(emailConfDicts)
+    for emailConfDict in emailConfDicts:
         try:
-            if 'id' in emailConfDict:
-                emailConfDict.pop('id')
-            emailConf = EmailConf(**emailConfDict)
-            email_addr = emailConf.email_addr
+            emailConf = getEmailConfFromDict(emailConfDict)
         except Exception:
             logger.warning('Cannot parse emailConfDict: %s', emailConfDict, exc_info=True)
-            return
-        from multiprocessing import get_context, Process, Manager, Queue
-        ctx = get_context('fork')
-        # def run_with_timeout(fun, *args, **kwargs):
-        #     d = Manager().dict()
-        #     def wrapper():
-        #         d['ret'] = fun(*args, **kwargs)
-        #     p: Process = ctx.Process(target=wrapper, args=args, kwargs=kwargs)
-        #     p.start()
-        #     p.join(request_timeout)
-        #     if p.exitcode != 0:
-        #         raise RuntimeError("Error during executing run_with_timeout, code: %s" % p.exitcode)
-        #     p.kill()
-        #     return d['ret']
-        #     # cannot use Pool because it will pickle lots of things causing error
-        #     # try:
-        #     #     pool = ctx.Pool(1)
-        #     #     fut = pool.apply_async(fun, args=args, kwds=kwargs)
-        #     #     return fut.get(request_timeout)
-        #     # finally:
-        #     #     pool.close()
-        def run_with_timeout(fun, *args, **kwargs):
-            pool = ThreadPool(1)
-            fut = pool.apply_async(fun, args=args, kwds=kwargs)
-            return fut.get(request_timeout)
-        try:
-            client = getEmailClient(emailConf)
-            new_inbox_num = run_with_timeout(lambda: client.get_mails_count())
-            if new_inbox_num > emailConf.inbox_num:
-                for idx in range(emailConf.inbox_num + 1, new_inbox_num + 1):
-                    try:
-                        mail = run_with_timeout(lambda: client.get_mail_by_index(idx))
-                    except Exception:
-                        logger.warning('cannot retrieve mail %d for %s', idx, emailConf, exc_info=True)
-                        break
-                    
-                    text = f'''New Email [{emailConf.email_addr}-{idx}]\n'''
-                    emailbody, emailfiles = mail.format_email()
-                    text += emailbody
-                    
-                    run_with_timeout(lambda: safeSendText(
-                        lambda text: updater.bot.send_message(chat_id=emailConf.chat_id, text=text), # type: ignore[has-type]
-                        text,
-                    ))
-                    for filename, filemime, file_content in emailfiles:
-                        if filemime.startswith('image'):
-                            run_with_timeout(lambda: safeSend(
-                                lambda text: updater.bot.send_document(chat_id=emailConf.chat_id, document=text, filename=filename), # type: ignore[has-type]
-                                text
-                            ))
-                        else:
-                            run_with_timeout(lambda: safeSend(
-                                lambda text: updater.bot.send_photo(chat_id=emailConf.chat_id, photo=file_content, filename=filename), # type: ignore[has-type]
-                                text
-                            ))
-                    emailDB.updateByQuery({'email_addr': email_addr}, {'inbox_num': idx})
-        except Exception as e:
-            if re.findall(r'\bEOF\b', str(e)):
-                pass # do not process occasional random network issue
-            elif re.findall(r'Server Unavailable. 21', str(e)):
-                pass # ignore stupid outlook server error
-            else:
-                if email_addr not in PERIODIC_TASK_ERRORS:
-                    PERIODIC_TASK_ERRORS[email_addr] = {}
-                exceptionStr = str(e)
-                if exceptionStr not in PERIODIC_TASK_ERRORS[email_addr]:
-                    PERIODIC_TASK_ERRORS[email_addr][exceptionStr] = []
-                PERIODIC_TASK_ERRORS[email_addr][exceptionStr].append(format_exc())
-            logger.warning('periodic task error in %s', email_addr, exc_info=True)
-    
-    # for emailConfDict in emailDB.getAll():
-    #     handler(emailConfDict)
-    
-    # TODO: Implement timeout control
-    from multiprocessing.pool import ThreadPool
-    for _ in ThreadPool(5).imap_unordered(handler, emailDB.getAll()):
-        pass
+            continue
+        metrics.registry.set_protocol(emailConf.email_addr, 'pop3' if emailConf.server_uri.startswith('pop3') else 'imap')
+        if not polledHere(emailConf.email_addr):
+            continue
+        # credential or server changes restart the account's tasks
+        accounts[emailConf.email_addr] = accountIdentity(emailConf)
+        if emailConf.skip_backlog:
+            skipping.append(emailConf.email_addr)
+    engine.sync_accounts(accounts)
+    for email_addr in skipping:
+        engine.poke(email_addr) # /skip_backlog on the front only sets the flag, the worker polling the account acts on it
+    if bot_role != 'all':
+        shareGlobalRate()
 
 LAST_ERROR_REPORT_TIME: float | None = None
 LAST_ERROR_REPORT_TICK = 0
@@ -373,34 +1308,118 @@ def periodic_task_error_report():
     if not text:
         logger.info("No account have massive errors, skipping this report!")
     text = f'''Error Summary during last {queries} queries in duration {time_since_last_report}:\n''' + text
-    safeSendText(
-        lambda text: updater.bot.send_message(chat_id=owner_chat_id, text=text), # type: ignore[has-type]
-        text
-    )
+    sendText(owner_chat_id, text)
+
+def handle_full_mail_download(update: Update, context: CallbackContext):
+    query = update.callback_query
+    _, key, uidl_key = query.data.split(':')
+    emailConf = getEmailConfByAccountKey(key)
+    if not emailConf or update.effective_chat.id not in (emailConf.chat_id, owner_chat_id):
+        query.answer('Email account not found')
+        return
+    query.answer('Downloading...')
+    async def fetch_mail():
+        client = await createEmailClient(emailConf)
+        try:
+            listing = await with_timeout(client.get_uidl_listing())
+            for uidl, (index, size) in listing.items():
+                if uidlKey(uidl) == uidl_key:
+                    return index, await with_timeout(client.get_mail_by_index(index, size))
+            return None, None
+        finally:
+            client.kill()
+    index, mail = engine.run_sync(fetch_mail())
+    if mail is None:
+        query.message.reply_text('Mail was deleted from the server')
+        return
+    deliver_mail(emailConf, index, mail, priority=PRIORITY_INTERACTIVE)
+
+def threadHeaders(replyContext: dict) -> tuple[str | None, str | None]:
+    # In-Reply-To and References of a reply to the mail
+    messageId = replyContext['message_id'].strip()
+    if not messageId:
+        return None, None
+    references = ' '.join(replyContext['mail_references'].split() + [messageId])
+    return messageId, references
 
 def handle_reply_send_email(update: Update, context: CallbackContext):
-    original_message = update.message.reply_to_message.text
-    email, mail_id, from_email = re.findall(r'^.*?\[(.*?)-(\d+)\]\n[\S\s]+?From: .*?(\S+)\n', original_message)[0]
+    repliedTo = update.message.reply_to_message
     reply_message = update.message.text
+    if reply_message is None:
+        update.message.reply_text("Only text can be sent as an email reply")
+        return
+    replyContext = emailDB.get_reply_context(repliedTo.chat_id, repliedTo.message_id)
+    if replyContext:
+        email, from_email = replyContext['email_addr'], replyContext['from_addr']
+        in_reply_to, references = threadHeaders(replyContext)
+    else:
+        # sent before the reply index was kept, or pruned from it
+        original_message = repliedTo.text or repliedTo.caption or ''
+        m = re.search(r'^.*?\[(.*?)-(\d+)\]\n[\S\s]+?From: .*?(\S+)\n', original_message)
+        if not m:
+            update.message.reply_text("Cannot tell which email this replies to, reply to the message of a received email")
+            return
+        email, mail_id, from_email = m.groups()
+        in_reply_to = references = None
     subject, split, body = reply_message.partition('\n\n')
     if split != '\n\n':
-        update.message.reply_text("Don't know the subject of email. Send the email in this form: \n\n(Your subject here)\n\n(Your body)")
+        if not replyContext:
+            update.message.reply_text("Don't know the subject of email. Send the email in this form: \n\n(Your subject here)\n\n(Your body)")
+            return
+        # body only, answers under the original subject
+        originalSubject = replyContext['subject']
+        subject = originalSubject if originalSubject.lower().startswith('re:') else f'Re: {originalSubject}'
+        body = reply_message
+    emailConfDict = emailDB.get(email)
+    if not emailConfDict:
+        update.message.reply_text(f'cannot find email account: {email}')
+        return
+    emailConf = getEmailConfFromDict(emailConfDict)
+    if not emailConf.smtp_server_uri:
+        update.message.reply_text(f"No SMTP server configured for {email}")
         return
-    emailConf = getEmailConf(email)
-    emailConf.smtp_server_uri
-    send_email(
+    # sent in the background, the outcome is posted as a reply to the message
+    chatId, messageId = update.message.chat_id, update.message.message_id
+    def reportResult(future: Future):
+        try:
+            future.result()
+        except Exception as e:
+            logger.warning('cannot send email from %s to %s', email, from_email, exc_info=True)
+            sendText(chatId, f"Failed to send the email from {email} to {from_email}: {e!r}", PRIORITY_INTERACTIVE, reply_to=messageId)
+            return
+        sendText(chatId, f"Successfully sent the email from {email} to {from_email} with subject {subject}", PRIORITY_INTERACTIVE,
+                 reply_to=messageId)
+    smtpPool.submit(
         smtp_server_uri=emailConf.smtp_server_uri, 
         sender_email=emailConf.email_addr, 
         password=emailConf.email_passwd, 
         receiver_email=from_email, 
-        subject=subject, body=body)
-    update.message.reply_text(f"Successfully sent the email from {email} to {from_email} with subject {subject}")
+        subject=subject, body=body,
+        in_reply_to=in_reply_to, references=references).add_done_callback(reportResult)
+
+def registerGauges():
+    # current state, read when scraped
+    def accountLabels(email_addr):
+        return (email_addr, metrics.registry.protocols.get(email_addr, 'unknown'))
+    metrics.registry.gauge('mailbot_poll_interval_seconds', 'Current adaptive poll interval',
+                           lambda: {accountLabels(addr): schedule.interval for addr, schedule in list(engine.schedules.items())},
+                           ('account', 'protocol'))
+    metrics.registry.gauge('mailbot_idling', 'Whether the account is parked in IMAP IDLE',
+                           lambda: {accountLabels(addr): int(addr in idlingAccounts) for addr in list(engine.accounts)},
+                           ('account', 'protocol'))
+    metrics.registry.gauge('mailbot_telegram_queue', 'Bot api calls waiting or in flight',
+                           lambda: {(k,): v for k, v in tgDispatcher.queue_depth().items()}, ('state',))
+    metrics.registry.gauge('mailbot_client_pool', 'Cached mail server connections',
+                           lambda: {('pooled',): len(emailClientPool.clients), ('leased',): emailClientPool.leased}, ('state',))
+    metrics.registry.gauge('mailbot_html_cache_entries', 'Cached html conversions',
+                           lambda: {(): len(htmlConverter.cache)})
 
 def main():
     # Create the EventHandler and pass it your bot's token.
     global updater
     updater = Updater(token=bot_token, use_context=True)
     print(bot_token)
+    logger.info('starting as %s', bot_role)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
@@ -414,7 +1433,13 @@ def main():
     dp.add_handler(CommandHandler("list_email", setting_list_email))
     dp.add_handler(CommandHandler("add_email", setting_add_email))
     dp.add_handler(CommandHandler("del_email", setting_del_email))
+    dp.add_handler(CommandHandler("set_folders", setting_folders))
+    dp.add_handler(CommandHandler("skip_backlog", setting_skip_backlog))
+    dp.add_handler(CommandHandler("stats", show_stats))
+    dp.add_handler(CommandHandler("profile", run_profile, run_async=True))
     dp.add_handler(MessageHandler(Filters.reply, handle_reply_send_email))
+    dp.add_handler(CallbackQueryHandler(handle_attachment_download, pattern=r'^att:', run_async=True))
+    dp.add_handler(CallbackQueryHandler(handle_full_mail_download, pattern=r'^pop:', run_async=True))
     # TODO: implement send mail
     # dp.add_handler(ConversationHandler(
     #     entry_points=[CommandHandler("send_email", handle_start_send_email)],
@@ -431,12 +1456,30 @@ def main():
         import traceback
         if context.error:
             excStr = '\n'.join(traceback.format_exception(context.error))
-            update.message.reply_text(f'Error processing command: {excStr}')
+            update.effective_message.reply_text(f'Error processing command: {excStr}')
         else:
-            update.message.reply_text('Error processing command: (unknown error)')
+            update.effective_message.reply_text('Error processing command: (unknown error)')
         
     dp.add_error_handler(errorHandler)
     
+    global engine
+    engine = AsyncPollEngine(poll_account, poll_interval, idle_fn=idle_account if imap_idle else None,
+                             max_concurrency=poll_concurrency,
+                             min_interval=poll_interval_min, max_interval=poll_interval_max, jitter=poll_jitter)
+    engine.start()
+    tgDispatcher.start()
+    engine.spawn(emailClientPool.run_reaper())
+    TokenStore.start_refresher()
+    if metrics_port:
+        registerGauges()
+        metrics.registry.serve(metrics_port, metrics_addr)
+    global shard
+    if bot_role == 'worker':
+        shard = ShardCoordinator(emailDB, lambda: [conf['email_addr'] for conf in emailDB.get_all()],
+                                 releaseAccounts, periodic_task, worker_id=worker_id)
+        shard.start()
+    periodic_task()
+    
     from apscheduler.schedulers.background import BackgroundScheduler
     scheduler = BackgroundScheduler()
     scheduler.add_job(periodic_task, 'interval', seconds=poll_interval, id='email-periodic_task', replace_existing=True)
@@ -445,13 +1488,27 @@ def main():
 
     dp.add_error_handler(error)
 
-    # Start the Bot
-    updater.start_polling()
+    if bot_role == 'worker':
+        # only sends, getUpdates belongs to the front
+        stopped = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(signum, lambda signum, frame: stopped.set())
+        stopped.wait()
+        scheduler.shutdown(wait=False)
+        shard.stop() # type: ignore[union-attr]
+    else:
+        # Start the Bot
+        updater.start_polling()
 
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
+    engine.run_sync(emailClientPool.close_all(), timeout=request_timeout)
+    if cpuPool:
+        engine.run_sync(cpuPool.close(), timeout=request_timeout)
+    smtpPool.close_all() # lets queued replies go out
+    emailDB.flush() # pending cursor updates
 
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+import time
+
+from utils.budget import SharedBudget, WorkBudget, split_fresh
+
+def test_split_fresh_within_budget():
+    assert split_fresh([1, 2, 3], 5, 3) == ([1, 2, 3], [])
+    assert split_fresh([1, 2, 3], None, 3) == ([1, 2, 3], [])
+
+def test_split_fresh_over_budget_newest_first():
+    fresh, older = split_fresh(list(range(1, 61)), 50, 3)
+    assert fresh == [58, 59, 60]
+    assert older == list(range(1, 58))
+
+def test_split_fresh_newest_capped_by_remaining():
+    assert split_fresh([1, 2, 3, 4], 2, 3) == ([3, 4], [1, 2])
+
+def test_split_fresh_budget_spent():
+    # a later folder after the budget ran out: nothing taken, nothing moved to the backlog
+    assert split_fresh([7], 0, 3) == ([], [])
+    assert split_fresh([5, 6, 7], 0, 3) == ([], [])
+
+def test_work_budget_mails():
+    budget = WorkBudget(mails=2, bytes=0, seconds=0)
+    assert budget.remaining_mails() == 2
+    budget.spend(10)
+    budget.spend(10)
+    assert budget.remaining_mails() == 0
+    assert budget.exhausted()
+
+def test_work_budget_bytes_and_seconds():
+    assert WorkBudget(mails=0, bytes=100, seconds=0).remaining_mails() is None
+    budget = WorkBudget(mails=0, bytes=100, seconds=0)
+    budget.spend(100)
+    assert budget.exhausted()
+    budget = WorkBudget(mails=0, bytes=0, seconds=0.01)
+    time.sleep(0.02)
+    assert budget.exhausted()
+
+def test_shared_budget_only_charges_backlog():
+    shared = SharedBudget(mails=1, bytes=0, window=60)
+    budget = WorkBudget(mails=0, bytes=0, seconds=0, shared=shared)
+    budget.spend(10) # fresh mail
+    assert not budget.exhausted(backlog=True)
+    budget.spend(10, backlog=True)
+    assert budget.exhausted(backlog=True)
+    assert not budget.exhausted() # fresh mail still flows
+
+def test_shared_budget_window_rolls():
+    shared = SharedBudget(mails=1, bytes=0, window=0.01)
+    shared.spend(1)
+    assert shared.exhausted()
+    time.sleep(0.02)
+    assert not shared.exhausted()
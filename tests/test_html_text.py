@@ -0,0 +1,63 @@
+import utils.html_text
+from utils.html_text import TRUNCATED_NOTICE, HtmlConverter
+
+def test_convert():
+    text, outcome = HtmlConverter().render('<html><head><style>p {}</style></head><body><p>Hello&nbsp;<b>world</b></p>'
+                                           '<script>alert(1)</script><ul><li>one</li><li>two</li></ul>'
+                                           '<a href="https://example.com/">site</a><img alt="logo"></body></html>')
+    assert outcome == 'converted'
+    assert text == 'Hello world\n\n- one\n- two\nsite (https://example.com/) logo'
+
+def test_size_cap_does_not_leave_half_a_tag():
+    html = '<p>' + 'x' * 90 + '</p><a href="https://example.com/very/long">'
+    text, outcome = HtmlConverter(max_size=100).render(html)
+    assert outcome == 'truncated'
+    assert text == 'x' * 90 + TRUNCATED_NOTICE
+
+def test_time_budget_keeps_what_was_converted():
+    # checked between feeds: the first one is converted, the rest is cut off
+    size = utils.html_text._FEED_SIZE
+    html = '<p>first</p>' + ' ' * size + '<p>second</p>' * size
+    text, outcome = HtmlConverter(time_budget=-1).render(html)
+    assert outcome == 'truncated'
+    assert text == 'first' + TRUNCATED_NOTICE
+
+def test_pathological_html():
+    converter = HtmlConverter(max_size=200 * 1024)
+    for html in ('<div>' * 50000 + 'deep' + '</div>' * 50000, # cut by the size cap
+                 '<!-- never closed ' + 'x' * 100000,
+                 '<' * 100000,
+                 '<a href="https://example.com/">' * 10000 + 'link'):
+        text, outcome = converter.render(html)
+        assert outcome in ('converted', 'truncated')
+        assert len(text) <= len(html) + len(TRUNCATED_NOTICE)
+
+def test_failed_conversion_falls_back_to_raw_html(monkeypatch):
+    def broken(payload, deadline):
+        raise ValueError('broken converter')
+    monkeypatch.setitem(utils.html_text.CONVERTERS, 'text', broken)
+    converter = HtmlConverter(max_size=10)
+    html = '<p>raw html body</p>'
+    assert converter.render(html) == ('<p>raw htm', 'failed')
+    assert converter.convert(html) == '<p>raw htm'
+    # failures are not cached, the next render tries again
+    assert converter.stats()['cached'] == 0
+    assert converter.counters['failed'] == 1
+
+def test_cache(monkeypatch):
+    calls = []
+    convert = utils.html_text.CONVERTERS['text']
+    def counting(payload, deadline):
+        calls.append(payload)
+        return convert(payload, deadline)
+    monkeypatch.setitem(utils.html_text.CONVERTERS, 'text', counting)
+    converter = HtmlConverter(cache_size=2)
+    for html in ('<p>a</p>', '<p>a</p>', '<p>b</p>', '<p>a</p>', '<p>c</p>', '<p>b</p>'):
+        converter.convert(html)
+    # a stays cached as the most recently used one, b was evicted by c
+    assert calls == ['<p>a</p>', '<p>b</p>', '<p>c</p>', '<p>b</p>']
+    assert converter.stats() == {'backend': 'text', 'cached': 2, 'converted': 4, 'cache_hits': 2, 'truncated': 0, 'failed': 0}
+
+    uncached = HtmlConverter(cache_size=0)
+    uncached.convert('<p>a</p>')
+    assert uncached.cached('<p>a</p>') is None
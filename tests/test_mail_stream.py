@@ -0,0 +1,65 @@
+import asyncio
+import base64
+
+import pytest
+
+import utils.mail_stream
+from utils.cpu_pool import CpuPool
+from utils.mail_stream import OffloadedMailParser, StreamingMailParser
+
+ATTACHMENT = bytes(range(256)) * 40
+
+MAIL = (b'From: a@example.com\r\nSubject: stream\r\nMessage-ID: <stream@example.com>\r\n'
+        b'Content-Type: multipart/mixed; boundary="OUT"\r\n\r\npreamble\r\n--OUT\r\n'
+        b'Content-Type: multipart/alternative; boundary="IN"\r\n\r\n--IN\r\n'
+        b'Content-Type: text/plain; charset=utf-8\r\nContent-Transfer-Encoding: quoted-printable\r\n\r\n'
+        b'h=C3=A9llo soft=\r\nbreak\r\n--dash line\r\nend\r\n--IN\r\n'
+        b'Content-Type: text/html; charset=utf-8\r\n\r\n<p>html</p>\r\n--IN--\r\n--OUT\r\n'
+        b'Content-Type: application/octet-stream; name="a.bin"\r\nContent-Transfer-Encoding: base64\r\n\r\n'
+        + base64.encodebytes(ATTACHMENT).replace(b'\n', b'\r\n') + b'--OUT--\r\nepilogue\r\n')
+
+def parse(feed):
+    parser = StreamingMailParser()
+    feed(parser)
+    return summary(parser.close())
+
+def summary(mail):
+    return mail.id, mail.text, mail.raw_html, [(part.filename, part.get_payload()) for part in mail.additional_parts]
+
+def in_chunks(size):
+    def feed(parser):
+        for start in range(0, len(MAIL), size):
+            parser.feed(MAIL[start:start + size])
+    return feed
+
+def by_lines(parser):
+    for line in MAIL.split(b'\r\n')[:-1]:
+        parser.feed_line(line)
+
+def test_parse():
+    assert parse(in_chunks(len(MAIL))) == ('<stream@example.com>', 'héllo softbreak\n--dash line\nend', '<p>html</p>',
+                                           [('a.bin', ATTACHMENT)])
+
+@pytest.mark.parametrize('block_size', [5, 100, 64 * 1024])
+def test_same_result_however_fed(monkeypatch, block_size):
+    monkeypatch.setattr(utils.mail_stream, 'BLOCK_SIZE', block_size)
+    expected = parse(in_chunks(len(MAIL)))
+    for size in (1, 7, 1000):
+        assert parse(in_chunks(size)) == expected
+    assert parse(by_lines) == expected
+
+@pytest.mark.parametrize('closed', [False, True])
+def test_offloaded_same_result(closed):
+    # the attachment is above the spool threshold, so it comes back from the worker in a file.
+    # a closed pool falls back to parsing in place
+    async def run():
+        pool = CpuPool(workers=1)
+        if closed:
+            await pool.close()
+        try:
+            parser = OffloadedMailParser(pool, spool_threshold=1024)
+            by_lines(parser)
+            return summary(await parser.parse())
+        finally:
+            await pool.close()
+    assert asyncio.run(run()) == parse(in_chunks(len(MAIL)))
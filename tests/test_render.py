@@ -0,0 +1,53 @@
+import random
+import re
+
+from utils.render import split_message, utf16_len
+
+def visible(chunks, html=False):
+    # the text as read in telegram: tags dropped, cuts at line ends lose only the newline
+    text = ''.join(chunks).replace('\n', '')
+    return re.sub(r'<[^<>]*>', '', text) if html else text
+
+def test_astral_chars_count_twice():
+    text = '😀' * 30 + '\n' + 'a😀' * 20
+    chunks = split_message(text, limit=10)
+    assert all(utf16_len(chunk) <= 10 for chunk in chunks)
+    assert utf16_len(chunks[0]) == 10 # 5 emoji, not 10
+    # no surrogate pair is cut in half
+    assert all(chunk.encode('utf-16-le').decode('utf-16-le') == chunk for chunk in chunks)
+    assert visible(chunks) == text.replace('\n', '')
+
+def test_no_content_dropped():
+    rng = random.Random(7)
+    words = ['mail', 'überweisung', '😀', '', 'x' * 50, '测试']
+    lines = [' '.join(rng.choice(words) for _ in range(rng.randrange(0, 30))) for _ in range(300)]
+    text = '\n'.join(lines)
+    for limit in (40, 100, 4096):
+        chunks = split_message(text, limit=limit)
+        assert all(utf16_len(chunk) <= limit for chunk in chunks)
+        assert visible(chunks) == text.replace('\n', '')
+
+def test_prefers_paragraph_breaks():
+    # the blank line is in the second half of the first message, the cut moves back to it
+    text = 'a' * 40 + '\n\n' + 'b' * 20 + '\n' + 'c' * 20
+    assert split_message(text, limit=70) == ['a' * 40, 'b' * 20 + '\n' + 'c' * 20]
+
+def test_html_tags_reopened_across_cuts():
+    line = '<b>bold <a href="https://example.com/x">' + 'link text ' * 20 + '</a> tail &amp; more</b>'
+    chunks = split_message(line, limit=60, html=True)
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert utf16_len(chunk) <= 60
+        # every piece is well formed on its own
+        assert chunk.count('<b>') == chunk.count('</b>')
+        assert chunk.count('<a ') == chunk.count('</a>')
+        # tags and character references are never cut
+        assert not re.search(r'<[^>]*$|^[^<]*>|&[#\w]*$', chunk)
+    assert chunks[1].startswith('<b><a href="https://example.com/x">')
+    assert visible(chunks, html=True) == re.sub(r'<[^<>]*>', '', line)
+
+def test_max_chunks():
+    chunks = split_message('\n'.join(['x' * 50] * 10), limit=60, max_chunks=3)
+    assert len(chunks) == 3
+    assert chunks[-1].endswith('(truncated, 7 more messages)')
+    assert all(utf16_len(chunk) <= 60 for chunk in chunks)
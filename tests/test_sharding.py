@@ -0,0 +1,33 @@
+import time
+
+from utils.sharding import ShardCoordinator
+from utils.store import AccountStore
+
+ACCOUNTS = [f'u{i}@example.com' for i in range(10)]
+
+def wait_for(condition, timeout=3.0):
+    started = time.monotonic()
+    while not condition() and time.monotonic() - started < timeout:
+        time.sleep(0.05)
+    return condition()
+
+def test_lease_lapses_without_heartbeat(tmp_path):
+    store = AccountStore(str(tmp_path / 'accounts.db'))
+    released: list[set[str]] = []
+    shard = ShardCoordinator(store, lambda: ACCOUNTS, released.append, lambda: None,
+                             worker_id='w0', heartbeat_interval=0.1, timeout=1.0)
+    shard.start()
+    try:
+        assert shard.owned == set(ACCOUNTS)
+        heartbeat = store.heartbeat
+        def broken(*args):
+            raise Exception('database is locked')
+        store.heartbeat = broken # type: ignore[method-assign]
+        # polling stops once the leases run out, not at the first missed beat
+        assert not wait_for(lambda: not shard.owned, timeout=0.5)
+        assert wait_for(lambda: not shard.owned)
+        assert released == [set(ACCOUNTS)]
+        store.heartbeat = heartbeat # type: ignore[method-assign]
+        assert wait_for(lambda: shard.owned == set(ACCOUNTS))
+    finally:
+        shard.stop()
@@ -0,0 +1,18 @@
+from utils.store import AccountStore
+
+ACCOUNT = {'email_addr': 'u@example.com', 'email_passwd': 'pw', 'server_uri': 'imaps://imap.example.com', 'smtp_server_uri': None,
+           'chat_id': 5, 'folders': None, 'inbox_num': 3, 'uid_validity': 7, 'last_uid': 3, 'highest_modseq': 0,
+           'folder_cursors': {'Junk': {'uid_validity': 9, 'last_uid': 1}}}
+
+def test_update_config_keeps_cursors(tmp_path):
+    store = AccountStore(str(tmp_path / 'accounts.db'), commit_interval=0)
+    store.upsert(ACCOUNT)
+    # a worker moved the cursors meanwhile
+    store.update_cursor('u@example.com', {'last_uid': 5, 'folder_cursors': {'Junk': {'uid_validity': 9, 'last_uid': 4}}})
+    assert store.update_config('u@example.com', {'folders': ['Junk'], 'last_uid': 0})
+    account = store.get('u@example.com')
+    assert account['folders'] == ['Junk']
+    assert account['last_uid'] == 5
+    assert account['folder_cursors'] == {'Junk': {'uid_validity': 9, 'last_uid': 4}}
+    assert not store.update_config('nobody@example.com', {'folders': []})
+    store.close()
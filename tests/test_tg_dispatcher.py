@@ -0,0 +1,147 @@
+import types
+
+import pytest
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+import utils.tg_dispatcher
+from utils.tg_dispatcher import PRIORITY_BULK, PRIORITY_INTERACTIVE, PRIORITY_NOTIFY, TelegramDispatcher, TokenBucket
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+class FakeBot(object):
+    # send(text) fails with the queued errors first
+    def __init__(self):
+        self.sent: list[str] = []
+        self.errors: list[Exception] = []
+
+    def send(self, text):
+        if self.errors:
+            raise self.errors.pop(0)
+        self.sent.append(text)
+        return text
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(utils.tg_dispatcher, 'time', types.SimpleNamespace(monotonic=clock.monotonic))
+    return clock
+
+def dispatcher(**kwargs):
+    # the dispatcher thread is not started, the tests take the jobs themselves
+    return TelegramDispatcher(**{'global_rate': 100, 'chat_rate': 100, 'chat_burst': 100, **kwargs})
+
+def run_next(d: TelegramDispatcher):
+    job, wait = d._next_job()
+    if job is not None:
+        d._execute(job)
+    return job, wait
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(rate=1, capacity=3)
+    for _ in range(3):
+        assert bucket.delay(clock.now) == 0
+        bucket.take(clock.now)
+    assert bucket.delay(clock.now) == pytest.approx(1)
+    clock.now += 0.5
+    assert bucket.delay(clock.now) == pytest.approx(0.5)
+    clock.now += 10
+    bucket.delay(clock.now)
+    assert bucket.tokens == 3 # never more than capacity
+
+def test_chat_rate(clock):
+    d = dispatcher(chat_rate=1, chat_burst=2)
+    bot = FakeBot()
+    futures = [d.submit(5, lambda i=i: bot.send(i)) for i in range(3)]
+    assert run_next(d)[0] is not None
+    assert run_next(d)[0] is not None
+    job, wait = run_next(d)
+    assert job is None and wait == pytest.approx(1)
+    clock.now += 1
+    run_next(d)
+    assert [f.result() for f in futures] == [0, 1, 2]
+
+def test_global_rate_across_chats(clock):
+    d = dispatcher(global_rate=2)
+    bot = FakeBot()
+    for chat_id in range(1, 4):
+        d.submit(chat_id, lambda chat_id=chat_id: bot.send(chat_id))
+    run_next(d)
+    run_next(d)
+    job, wait = run_next(d)
+    assert job is None and wait == pytest.approx(0.5)
+    clock.now += 0.5
+    run_next(d)
+    assert bot.sent == [1, 2, 3]
+
+def test_priority_order(clock):
+    d = dispatcher()
+    bot = FakeBot()
+    d.submit(5, lambda: bot.send('bulk'), PRIORITY_BULK)
+    d.submit(5, lambda: bot.send('notify 1'), PRIORITY_NOTIFY)
+    d.submit(6, lambda: bot.send('interactive'), PRIORITY_INTERACTIVE)
+    d.submit(5, lambda: bot.send('notify 2'), PRIORITY_NOTIFY)
+    while run_next(d)[0] is not None:
+        pass
+    assert bot.sent == ['interactive', 'notify 1', 'notify 2', 'bulk']
+
+def test_one_job_per_chat_in_flight(clock):
+    d = dispatcher()
+    d.submit(5, lambda: None)
+    d.submit(5, lambda: None)
+    job, _ = d._next_job()
+    assert d._next_job() == (None, None) # waits for the call to return
+    d._execute(job)
+    assert d._next_job()[0] is not None
+
+def test_retry_after_requeues_in_order(clock):
+    d = dispatcher()
+    bot = FakeBot()
+    bot.errors.append(RetryAfter(5))
+    first = d.submit(5, lambda: bot.send('first'))
+    run_next(d)
+    assert not first.done()
+    second = d.submit(5, lambda: bot.send('second'))
+    job, wait = run_next(d)
+    assert job is None and wait == pytest.approx(5)
+    clock.now += 5
+    run_next(d)
+    run_next(d)
+    assert bot.sent == ['first', 'second']
+    assert first.result() == 'first' and second.result() == 'second'
+    assert d.counters['retry_after'] == 1
+
+def test_network_errors_retried_then_given_up(clock):
+    d = dispatcher(max_retries=3, retry_interval=2)
+    bot = FakeBot()
+    bot.errors += [NetworkError('reset'), NetworkError('reset')]
+    sent = d.submit(5, lambda: bot.send('x'))
+    run_next(d)
+    assert run_next(d) == (None, pytest.approx(2))
+    clock.now += 2
+    run_next(d)
+    assert run_next(d) == (None, pytest.approx(4)) # backs off further
+    clock.now += 4
+    run_next(d)
+    assert sent.result() == 'x'
+
+    bot.errors += [NetworkError('reset')] * 3
+    failed = d.submit(5, lambda: bot.send('y'))
+    for _ in range(3):
+        clock.now += 100
+        run_next(d)
+    assert isinstance(failed.exception(), NetworkError)
+
+def test_bad_request_not_retried(clock):
+    d = dispatcher()
+    bot = FakeBot()
+    bot.errors.append(BadRequest("can't parse entities"))
+    failed = d.submit(5, lambda: bot.send('x'))
+    run_next(d)
+    assert isinstance(failed.exception(), BadRequest)
+    assert d._next_job() == (None, None)
+    assert d.counters['failed'] == 1
@@ -1,7 +1,9 @@
-from .client_base import EmailClientBase
-from .client_imap import EmailClientIMAP
-from .client_pop3 import EmailClientPOP3
-
+# before the submodules, some read their settings from the environment when imported
 from dotenv import dotenv_values
 import os
-os.environ.update({k:v for k,v in dotenv_values().items() if v})
\ No newline at end of file
+os.environ.update({k:v for k,v in dotenv_values().items() if v})
+
+from .client_base import MailboxStatus
+from .aio_client_base import AsyncEmailClientBase
+from .aio_client_imap import AsyncEmailClientIMAP
+from .aio_client_pop3 import AsyncEmailClientPOP3
@@ -0,0 +1,92 @@
+import logging
+import typing
+from typing import AsyncIterator
+
+from .client_base import MailboxStatus
+from .cpu_pool import CpuPool
+from .mail import Email
+from .mail_stream import OffloadedMailParser, StreamingMailParser, mail_parser
+
+logger = logging.getLogger(__name__)
+
+class AsyncEmailClientBase(object):
+    # one connection to a mailbox, network calls are coroutines. what a protocol lacks stays unsupported
+    bytes_received = 0 # over the connection's lifetime, for metrics
+    cpu_pool: CpuPool | None = None # set by the owner to parse large mails off the event loop
+
+    def _mail_parser(self, size=None) -> StreamingMailParser | OffloadedMailParser:
+        return mail_parser(size, self.cpu_pool)
+
+    def __init__(self, email_account, passwd, server_uri=None):
+        raise NotImplementedError()
+
+    async def connect(self):
+        raise NotImplementedError()
+
+    async def get_mails_count(self) -> int:
+        raise NotImplementedError()
+
+    async def get_mail_by_index(self, index, size=None) -> Email:
+        raise NotImplementedError()
+
+    async def get_mails_by_range(self, start, end) -> AsyncIterator[tuple[int, Email]]:
+        # the fallback for mailboxes without unique ids, yields (index, mail) for start..end inclusive
+        for index in range(start, end + 1):
+            yield index, await self.get_mail_by_index(index)
+
+    def supports_uid_sync(self) -> bool:
+        return False
+
+    async def get_mailbox_status(self, mailbox=None) -> MailboxStatus:
+        raise NotImplementedError()
+
+    async def get_mailboxes_status(self, mailboxes: list[str]) -> dict[str, MailboxStatus]:
+        raise NotImplementedError()
+
+    async def list_mailboxes(self) -> list[str]:
+        raise NotImplementedError()
+
+    async def get_uid_by_index(self, index) -> int:
+        raise NotImplementedError()
+
+    async def search_uids_since(self, last_uid) -> list[int]:
+        raise NotImplementedError()
+
+    def get_mails_by_uids(self, uids, lazy_attachments=False) -> AsyncIterator[tuple[int, Email]]:
+        raise NotImplementedError()
+
+    async def get_message_ids_by_uids(self, uids) -> dict[int, str]:
+        raise NotImplementedError()
+
+    async def get_part_by_uid(self, uid, section) -> tuple[typing.Any, bytes]:
+        raise NotImplementedError()
+
+    def supports_uidl_sync(self) -> bool:
+        return False
+
+    async def get_uidl_listing(self) -> dict[str, tuple[int, int]]:
+        raise NotImplementedError()
+
+    async def get_mail_preview(self, index, lines, size=None) -> Email:
+        raise NotImplementedError()
+
+    def supports_idle(self) -> bool:
+        return False
+
+    async def idle(self, timeout) -> bool:
+        raise NotImplementedError()
+
+    async def refresh_connection(self) -> None:
+        raise NotImplementedError()
+
+    async def cleanup(self) -> None:
+        raise NotImplementedError()
+
+    def kill(self) -> None:
+        raise NotImplementedError()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
@@ -0,0 +1,347 @@
+import asyncio
+import logging
+import re
+import ssl
+import time
+from urllib.parse import ParseResult, urlparse
+
+from .aio_client_base import AsyncEmailClientBase
+from .client_base import MailboxStatus
+from .imap_proto import (FETCH_BATCH_SIZE, IDLE_RENEW_INTERVAL, STRUCTURE_FETCH_ITEMS, body_fetch_items, build_structure_mails,
+                          decode_mailbox_name, encode_mailbox_name, find_fetched_part, is_new_mail_response, parse_mailbox_name,
+                          parse_status_response, plan_structure_fetch)
+from .imap_bodystructure import BodyPart, parse_fetch_response
+from .mail import Email, message_id_from_header
+from .oauth2_helper import OAuth2Factory
+
+logger = logging.getLogger(__name__)
+
+IMAP4_SSL_PORT = 993
+LITERAL_CHUNK_SIZE = 64 * 1024
+
+class AsyncIMAPError(Exception):
+    pass
+
+def _quote(s: str) -> bytes:
+    return b'"' + s.replace('\\', '\\\\').replace('"', '\\"').encode() + b'"'
+
+class AsyncEmailClientIMAP(AsyncEmailClientBase):
+    # minimal IMAP4rev1 client on asyncio streams, only what the poller needs
+    def __init__(self, email_account, passwd, server_uri=None):
+        self.email_account = email_account
+        self.password = passwd
+        if not server_uri:
+            server_uri = 'imaps://imap.'+self.email_account.split('@')[-1]
+        self.server_uri: ParseResult = urlparse(server_uri) # type: ignore
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.capabilities: tuple[str, ...] = ()
+        self.selected: str | None = None # the mailbox EXAMINEd, kept for the next command on it
+        self.mailbox = 'INBOX' # what fetches, searches and IDLE work on
+        self._tagnum = 0
+
+    async def connect(self):
+        if self.server_uri.scheme != 'imaps':
+            # TODO: implement imap starttls
+            raise RuntimeError(f'Unsupported IMAP protocol variant: {self.server_uri.scheme}')
+        self.reader, self.writer = await asyncio.open_connection(
+            self.server_uri.hostname, self.server_uri.port or IMAP4_SSL_PORT, ssl=ssl.create_default_context())
+        welcome = await self.reader.readline()
+        logger.info('imap server welcome: %s', welcome.decode('utf8', 'replace').strip())
+        if not welcome.startswith(b'* OK'):
+            raise AsyncIMAPError(f'imap server refused connection: {welcome!r}')
+        token = OAuth2Factory.token_from_string(self.password)
+        if token is None:
+            # normal basic auth
+            await self._command(b'LOGIN', _quote(self.email_account), _quote(self.password))
+        else:
+            # token refresh is a blocking https request
+            saslBody = await asyncio.to_thread(token.getSasl, self.email_account)
+            await self._command(b'AUTHENTICATE', b'XOAUTH2', continuation=saslBody.encode())
+        logger.info('imap login ok: %s', self.email_account)
+        # capabilities may change after login (e.g. IDLE only advertised to authenticated clients)
+        for line in await self._command(b'CAPABILITY'):
+            if line[0].startswith(b'* CAPABILITY '):
+                self.capabilities = tuple(line[0].decode().upper().split()[2:])
+        return self
+
+    def _new_tag(self) -> bytes:
+        self._tagnum += 1
+        return b'A%04d' % self._tagnum
+
+    async def _read_response(self, stream_rfc822=False) -> list:
+        # one response, as a list of bytes and (prefix, literal) tuples like imaplib returns.
+        # with stream_rfc822, RFC822 literals are parsed while read and come back as a parser (see _mail_parser)
+        chunks: list = []
+        while True:
+            line = await self.reader.readline() # type: ignore[union-attr]
+            if not line:
+                raise AsyncIMAPError('imap connection closed by server')
+            self.bytes_received += len(line)
+            m = re.search(rb'\{(\d+)\}\r\n$', line)
+            if m:
+                size = int(m.group(1))
+                self.bytes_received += size
+                if stream_rfc822 and re.search(rb'RFC822 \{\d+\}\r\n$', line):
+                    parser = self._mail_parser(size)
+                    while size > 0:
+                        data = await self.reader.readexactly(min(size, LITERAL_CHUNK_SIZE)) # type: ignore[union-attr]
+                        parser.feed(data)
+                        size -= len(data)
+                    chunks.append((line.rstrip(b'\r\n'), parser))
+                    continue
+                literal = await self.reader.readexactly(size) # type: ignore[union-attr]
+                chunks.append((line.rstrip(b'\r\n'), literal))
+                continue
+            chunks.append(line.rstrip(b'\r\n'))
+            return chunks
+
+    @staticmethod
+    def _first_line(chunks) -> bytes:
+        return chunks[0][0] if isinstance(chunks[0], tuple) else chunks[0]
+
+    async def _pipeline(self, commands: list[tuple[bytes, ...]]) -> list[tuple[bytes, list[list]]]:
+        # sends all commands in one write, returns (tagged completion, untagged responses) for each.
+        # a server completes pipelined commands in order, untagged data belongs to the next completion
+        tags = [self._new_tag() for _ in commands]
+        self.writer.write(b''.join(b' '.join((tag,) + command) + b'\r\n' for tag, command in zip(tags, commands))) # type: ignore[union-attr]
+        await self.writer.drain() # type: ignore[union-attr]
+        results = []
+        untagged: list = []
+        while len(results) < len(tags):
+            chunks = await self._read_response()
+            first = self._first_line(chunks)
+            if first.startswith(tags[len(results)] + b' '):
+                results.append((first[len(tags[len(results)]) + 1:], untagged))
+                untagged = []
+            elif first.split(b' ', 1)[0] in tags:
+                raise AsyncIMAPError(f'imap server completed pipelined commands out of order: {first.decode("utf8", "replace")}')
+            else:
+                untagged.append(chunks)
+        return results
+
+    async def _command(self, name: bytes, *args: bytes, continuation: bytes | None = None, stream_rfc822=False) -> list[list]:
+        # returns the untagged responses, raises unless completed with OK
+        tag = self._new_tag()
+        self.writer.write(b' '.join((tag, name) + args) + b'\r\n') # type: ignore[union-attr]
+        await self.writer.drain() # type: ignore[union-attr]
+        untagged = []
+        while True:
+            chunks = await self._read_response(stream_rfc822)
+            first = self._first_line(chunks)
+            if first.startswith(b'+'):
+                # answering with an empty line aborts e.g. a failed AUTHENTICATE
+                self.writer.write((continuation or b'') + b'\r\n') # type: ignore[union-attr]
+                await self.writer.drain() # type: ignore[union-attr]
+                continuation = None
+            elif first.startswith(tag + b' '):
+                if not first.startswith(tag + b' OK'):
+                    raise AsyncIMAPError(f'imap {name.decode()} failed: {first.decode("utf8", "replace")}')
+                return untagged
+            else:
+                untagged.append(chunks)
+
+    def has_capability(self, capability: str) -> bool:
+        return capability.upper() in self.capabilities
+
+    def supports_idle(self) -> bool:
+        return self.has_capability('IDLE')
+
+    def supports_uid_sync(self) -> bool:
+        return True
+
+    async def _examine(self) -> int:
+        exists = 0
+        for line in await self._command(b'EXAMINE', _quote(encode_mailbox_name(self.mailbox))):
+            m = re.match(rb'^\* (\d+) EXISTS', self._first_line(line))
+            if m:
+                exists = int(m.group(1))
+        self.selected = self.mailbox
+        return exists
+
+    async def _select_mailbox(self):
+        # a poll searches and fetches a folder on one EXAMINE, which implicitly leaves the previous folder
+        if self.selected != self.mailbox:
+            await self._examine()
+
+    async def _leave_mailbox(self):
+        # back to authenticated state, STATUS on the selected mailbox is discouraged (RFC 3501 6.3.10)
+        if self.selected is not None:
+            await self._command(b'CLOSE')
+            self.selected = None
+
+    async def get_mails_count(self) -> int:
+        return await self._examine()
+
+    def _status_items(self) -> bytes:
+        items = [b'MESSAGES', b'UIDNEXT', b'UIDVALIDITY']
+        if self.has_capability('CONDSTORE'):
+            items.append(b'HIGHESTMODSEQ')
+        return b'(' + b' '.join(items) + b')'
+
+    async def get_mailbox_status(self, mailbox=None) -> MailboxStatus:
+        mailbox = mailbox or self.mailbox
+        statuses = await self.get_mailboxes_status([mailbox])
+        if mailbox not in statuses:
+            raise AsyncIMAPError(f'imap server sent no STATUS response for {mailbox}')
+        return statuses[mailbox]
+
+    async def get_mailboxes_status(self, mailboxes: list[str]) -> dict[str, MailboxStatus]:
+        # one round trip for all mailboxes: LIST-STATUS (RFC 5819) if supported, else pipelined STATUS commands.
+        # mailboxes the server has no status for (deleted, no permission) are left out
+        await self._leave_mailbox()
+        encoded = {encode_mailbox_name(mailbox): mailbox for mailbox in mailboxes}
+        statuses: dict[str, MailboxStatus] = {}
+        if len(mailboxes) > 1 and self.has_capability('LIST-STATUS'):
+            patterns = b'(' + b' '.join(_quote(name) for name in encoded) + b')'
+            for chunks in await self._command(b'LIST', b'""', patterns, b'RETURN', b'(STATUS ' + self._status_items() + b')'):
+                if self._first_line(chunks).startswith(b'* STATUS '):
+                    name, rest = parse_mailbox_name(chunks, b'* STATUS ')
+                    if name in encoded:
+                        statuses[encoded[name]] = parse_status_response(rest)
+            return statuses
+        results = await self._pipeline([(b'STATUS', _quote(name), self._status_items()) for name in encoded])
+        for mailbox, (completion, untagged) in zip(mailboxes, results):
+            if not completion.startswith(b'OK'):
+                logger.warning('imap STATUS %s of %s failed: %s', mailbox, self.email_account, completion.decode('utf8', 'replace'))
+                continue
+            for chunks in untagged:
+                if self._first_line(chunks).startswith(b'* STATUS '):
+                    statuses[mailbox] = parse_status_response(self._first_line(chunks) if not isinstance(chunks[0], tuple) else chunks[-1])
+        return statuses
+
+    async def list_mailboxes(self) -> list[str]:
+        names = []
+        for chunks in await self._command(b'LIST', b'""', b'"*"'):
+            m = re.match(rb'^\* LIST \(([^)]*)\) (?:NIL|"(?:[^"\\]|\\.)*") ', self._first_line(chunks))
+            if m and b'\\NOSELECT' not in m.group(1).upper():
+                names.append(decode_mailbox_name(parse_mailbox_name(chunks, m.group(0))[0]))
+        return names
+
+    @staticmethod
+    def _fetch_data(untagged) -> list:
+        # turn "* 12 FETCH (...)" responses into imaplib's "12 (...)" shape for parse_fetch_response
+        data: list = []
+        for chunks in untagged:
+            first = chunks[0][0] if isinstance(chunks[0], tuple) else chunks[0]
+            m = re.match(rb'^\* (\d+) FETCH ', first)
+            if not m:
+                continue
+            stripped = m.group(1) + b' ' + first[m.end():]
+            data.append((stripped, chunks[0][1]) if isinstance(chunks[0], tuple) else stripped)
+            data += chunks[1:]
+        return data
+
+    async def _fetch(self, uid: bool, sequence: str, items: str) -> dict[int, dict]:
+        await self._select_mailbox()
+        command = (b'UID', b'FETCH') if uid else (b'FETCH',)
+        untagged = await self._command(*command, sequence.encode(), items.encode(), # type: ignore[arg-type]
+                                       stream_rfc822='RFC822' in items)
+        values = parse_fetch_response(self._fetch_data(untagged))
+        if uid:
+            # unsolicited flag updates of the selected mailbox come keyed by sequence number
+            values = {key: items for key, items in values.items() if 'UID' in items}
+        return values
+
+    async def get_mail_by_index(self, index, size=None) -> Email:
+        values = await self._fetch(False, '%d' % index, '(RFC822)')
+        return await values[index]['RFC822'].parse()
+
+    async def get_uid_by_index(self, index) -> int:
+        values = await self._fetch(False, '%d' % index, '(UID)')
+        if index not in values:
+            raise AsyncIMAPError(f'no uid for message {index}')
+        return int(values[index]['UID'])
+
+    async def search_uids_since(self, last_uid) -> list[int]:
+        await self._select_mailbox()
+        untagged = await self._command(b'UID', b'SEARCH', b'UID', b'%d:*' % (last_uid + 1))
+        uids = []
+        for line in untagged:
+            first = self._first_line(line)
+            if first.startswith(b'* SEARCH'):
+                uids += map(int, first.split()[2:])
+        # "n:*" always matches the highest uid, even if it is below n
+        return sorted(uid for uid in uids if uid > last_uid)
+
+    async def get_mails_by_uids(self, uids, batch_size=FETCH_BATCH_SIZE, lazy_attachments=False):
+        uids = list(uids)
+        for batch_start in range(0, len(uids), batch_size):
+            batch = ','.join(map(str, uids[batch_start:batch_start + batch_size]))
+            if lazy_attachments:
+                structures = await self._fetch(True, batch, STRUCTURE_FETCH_ITEMS)
+                mailParts, bySections = plan_structure_fetch(structures)
+                bodyData: dict[int, dict] = {}
+                for sections, sectionUids in bySections.items():
+                    bodyData.update(await self._fetch(True, ','.join(map(str, sectionUids)), body_fetch_items(sections)))
+                for uid, mail in build_structure_mails(structures, mailParts, bodyData):
+                    yield uid, mail
+                continue
+            mails = await self._fetch(True, batch, '(UID RFC822)')
+            for uid in sorted(mails):
+                yield uid, await mails.pop(uid)['RFC822'].parse()
+
+    async def get_message_ids_by_uids(self, uids, batch_size=FETCH_BATCH_SIZE) -> dict[int, str]:
+        uids = list(uids)
+        messageIds = {}
+        for batch_start in range(0, len(uids), batch_size):
+            batch = ','.join(map(str, uids[batch_start:batch_start + batch_size]))
+            values = await self._fetch(True, batch, '(UID BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
+            for uid, items in values.items():
+                header = next((v for k, v in items.items() if k.startswith('BODY[HEADER.FIELDS')), None)
+                messageIds[uid] = message_id_from_header(header) if isinstance(header, bytes) else ''
+        return messageIds
+
+    async def get_part_by_uid(self, uid, section) -> tuple[BodyPart, bytes]:
+        values = await self._fetch(True, str(uid), f'(UID BODYSTRUCTURE BODY.PEEK[{section}])')
+        return find_fetched_part(uid, section, values.get(uid))
+
+    async def idle(self, timeout=IDLE_RENEW_INTERVAL) -> bool:
+        # RFC 2177 IDLE on the mailbox, True if the server reported new mail before timeout
+        await self._select_mailbox()
+        tag = self._new_tag()
+        self.writer.write(tag + b' IDLE\r\n') # type: ignore[union-attr]
+        await self.writer.drain() # type: ignore[union-attr]
+        resp = await self.reader.readline() # type: ignore[union-attr]
+        if not resp.startswith(b'+'):
+            raise AsyncIMAPError(f'imap failed to idle: {resp!r}')
+        got_new = False
+        deadline = time.monotonic() + timeout
+        while not got_new:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                # cancelling readline() leaves the buffered data in the reader
+                line = await asyncio.wait_for(self.reader.readline(), remaining) # type: ignore[union-attr]
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                raise AsyncIMAPError('imap connection closed by server')
+            got_new = is_new_mail_response(line)
+        self.writer.write(b'DONE\r\n') # type: ignore[union-attr]
+        await self.writer.drain() # type: ignore[union-attr]
+        while True:
+            line = await self.reader.readline() # type: ignore[union-attr]
+            if not line:
+                raise AsyncIMAPError('imap connection closed by server')
+            if line.startswith(tag):
+                break
+            got_new = got_new or is_new_mail_response(line)
+        if not line.startswith(tag + b' OK'):
+            raise AsyncIMAPError(f'imap idle failed: {line!r}')
+        return got_new
+
+    async def refresh_connection(self):
+        await self._command(b'NOOP')
+
+    async def cleanup(self):
+        try:
+            await self._command(b'LOGOUT')
+        finally:
+            self.kill()
+
+    def kill(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+import ssl
+from urllib.parse import ParseResult, urlparse
+
+from .aio_client_base import AsyncEmailClientBase
+from .pop3_proxy import create_proxy_connection
+from .mail import Email
+from .mail_stream import StreamingMailParser
+from .oauth2_helper import OAuth2Factory
+
+logger = logging.getLogger(__name__)
+
+POP3_SSL_PORT = 995
+
+class AsyncPOP3Error(Exception):
+    pass
+
+class AsyncEmailClientPOP3(AsyncEmailClientBase):
+    # minimal POP3 client on asyncio streams, only what the poller needs
+    def __init__(self, email_account, passwd, server_uri=None):
+        self.email_account = email_account
+        self.password = passwd
+        if not server_uri:
+            server_uri = 'pop3s://pop.'+self.email_account.split('@')[-1]
+        self.server_uri: ParseResult = urlparse(server_uri) # type: ignore
+        self.reader: asyncio.StreamReader | None = None
+        self.writer: asyncio.StreamWriter | None = None
+        self.has_uidl = False
+        self.uidls: list[bytes] | None = None # the UIDL answer of connect, for the first listing
+
+    async def connect(self):
+        if self.server_uri.scheme != 'pop3s':
+            # TODO: implement pop3 starttls
+            raise RuntimeError(f'Unsupported POP3 protocol variant: {self.server_uri.scheme}')
+        host, port = self.server_uri.hostname, self.server_uri.port or POP3_SSL_PORT
+        sslContext = ssl.create_default_context()
+        if os.getenv('POP3_PROXY'):
+            # pysocks only speaks blocking sockets, hand the connected socket over to asyncio afterwards
+            sock = await asyncio.to_thread(create_proxy_connection, host, port, 10)
+            sock.setblocking(False)
+            self.reader, self.writer = await asyncio.open_connection(sock=sock, ssl=sslContext, server_hostname=host)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(host, port, ssl=sslContext)
+        welcome = await self._getresp()
+        logger.info('pop3 server welcome: %s', welcome.decode('utf8', 'replace'))
+        token = OAuth2Factory.token_from_string(self.password)
+        if token is None:
+            # normal basic auth
+            await self._shortcmd(b'USER ' + self.email_account.encode())
+            await self._shortcmd(b'PASS ' + self.password.encode())
+        else:
+            saslBody = await asyncio.to_thread(token.getSasl, self.email_account)
+            await self._shortcmd(b'AUTH XOAUTH2', expect=b'+')
+            await self._shortcmd(saslBody.encode())
+        # UIDL is optional (RFC 1939 7), servers without it are polled by message number. the maildrop
+        # does not change during a session, so the answer also serves the poll on this connection
+        try:
+            _, self.uidls, _ = await self._longcmd(b'UIDL')
+            self.has_uidl = True
+        except AsyncPOP3Error as e:
+            logger.info('pop3 server of %s has no UIDL: %s', self.email_account, e)
+            self.uidls, self.has_uidl = None, False
+        return self
+
+    async def _getline(self) -> bytes:
+        line = await self.reader.readline() # type: ignore[union-attr]
+        if not line:
+            raise AsyncPOP3Error('pop3 connection closed by server')
+        self.bytes_received += len(line)
+        return line.rstrip(b'\r\n')
+
+    async def _getresp(self, expect=b'+OK') -> bytes:
+        resp = await self._getline()
+        if not resp.startswith(expect):
+            raise AsyncPOP3Error(resp.decode('utf8', 'replace'))
+        return resp
+
+    async def _shortcmd(self, line: bytes, expect=b'+OK') -> bytes:
+        self.writer.write(line + b'\r\n') # type: ignore[union-attr]
+        await self.writer.drain() # type: ignore[union-attr]
+        return await self._getresp(expect)
+
+    async def _longcmd(self, line: bytes, sink=None) -> tuple[bytes, list[bytes], int]:
+        # same shape as poplib: (response, lines without CRLF, octets)
+        # lines are handed to sink(line) instead of being collected if given
+        resp = await self._shortcmd(line)
+        lines, octets = [], 0
+        while True:
+            data = await self._getline()
+            if data == b'.':
+                break
+            if data.startswith(b'..'):
+                data = data[1:] # dot-stuffing
+            octets += len(data) + 2
+            if sink:
+                sink(data)
+            else:
+                lines.append(data)
+        return resp, lines, octets
+
+    async def get_mails_count(self) -> int:
+        resp = await self._shortcmd(b'STAT')
+        return int(resp.split()[1])
+
+    async def get_mail_by_index(self, index, size=None) -> Email:
+        # parsed while it is received, large attachments never sit in memory. size from LIST, if known
+        parser = self._mail_parser(size)
+        await self._longcmd(b'RETR %d' % index, sink=parser.feed_line)
+        return await parser.parse()
+
+    def supports_uidl_sync(self) -> bool:
+        return self.has_uidl
+
+    async def get_uidl_listing(self) -> dict[str, tuple[int, int]]:
+        uidls, self.uidls = self.uidls, None
+        if uidls is None:
+            _, uidls, _ = await self._longcmd(b'UIDL')
+        _, sizes, _ = await self._longcmd(b'LIST')
+        sizeDict = {}
+        for line in sizes:
+            index, size = line.split()[:2]
+            sizeDict[int(index)] = int(size)
+        listing = {}
+        for line in uidls:
+            index, uidl = line.split()[:2]
+            listing[uidl.decode()] = (int(index), sizeDict.get(int(index), 0))
+        return listing
+
+    async def get_mail_preview(self, index, lines, size=None) -> Email:
+        parser = StreamingMailParser()
+        _, _, mail_octets = await self._longcmd(b'TOP %d %d' % (index, lines), sink=parser.feed_line)
+        mail = parser.close()
+        mail.close()
+        mail.additional_parts = [] # cut off by TOP, would be broken anyway
+        mail.truncated_size = size or mail_octets
+        return mail
+
+    async def refresh_connection(self):
+        # pop3 cannot be polled using same connection (specified RFC)
+        self.kill()
+        await self.connect()
+
+    async def cleanup(self):
+        try:
+            await self._shortcmd(b'QUIT')
+        finally:
+            self.kill()
+
+    def kill(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
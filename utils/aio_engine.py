@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import threading
+import time
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+from .poll_schedule import AdaptiveInterval
+
+logger = logging.getLogger(__name__)
+
+class AsyncPollEngine(object):
+    # one asyncio task per account on a dedicated event loop thread;
+    # blocking work (telegram api, db, token refresh) goes to one bounded executor
+    def __init__(self,
+                 poll_fn: typing.Callable[[str, bool], typing.Awaitable[int | None]],
+                 interval: float,
+                 idle_fn: typing.Callable[[str, typing.Callable[[], None]], typing.Awaitable[None]] | None = None,
+                 max_concurrency=100,
+                 blocking_workers=8,
+                 idle_retry_interval=60,
+                 min_interval: float | None = None,
+                 max_interval: float | None = None,
+                 jitter=0.2):
+        # poll_fn(email_addr, woken): woken is True if poked (e.g. by IDLE) instead of interval,
+        # returns the number of new mails (drives the adaptive interval) or None if it did not look
+        self.poll_fn = poll_fn
+        self.idle_fn = idle_fn # idle_fn(email_addr, poke): long running, calls poke() on new mail
+        self.interval = interval
+        self.min_interval = interval if min_interval is None else min_interval
+        self.max_interval = interval if max_interval is None else max_interval
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.idle_retry_interval = idle_retry_interval
+        self.executor = ThreadPoolExecutor(blocking_workers, thread_name_prefix='engine-blocking')
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor) # asyncio.to_thread() uses it as well
+        self.thread = threading.Thread(target=self._run, name='poll-engine', daemon=True)
+        self.accounts: dict[str, typing.Hashable] = {}
+        self.tasks: dict[str, list[asyncio.Task]] = {}
+        self.wakeups: dict[str, asyncio.Event] = {}
+        self.schedules: dict[str, AdaptiveInterval] = {}
+        # outlive restarts of an account, so a cancelled poll still unwinding never overlaps the new one
+        self.poll_locks: dict[str, asyncio.Lock] = {}
+        self.semaphore: asyncio.Semaphore | None = None
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+
+    def run_sync(self, coro, timeout=None):
+        # run a coroutine on the engine loop from another thread and wait for its result
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def spawn(self, coro) -> asyncio.Future:
+        # schedule a background coroutine on the engine loop without waiting for it
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def sync_accounts(self, accounts: dict[str, typing.Hashable]):
+        # {email_addr: key}, tasks of an account are restarted when its key (e.g. credentials) changes
+        self.loop.call_soon_threadsafe(self._sync_accounts, dict(accounts))
+
+    async def stop_accounts(self, email_addrs: typing.Iterable[str]):
+        # stops the accounts and waits for their tasks to unwind, nothing of them runs anymore afterwards
+        tasks = [task for email_addr in email_addrs for task in self.tasks.get(email_addr, [])]
+        for email_addr in email_addrs:
+            self._stop_account(email_addr)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    def poke(self, email_addr: str):
+        self.loop.call_soon_threadsafe(self._poke, email_addr)
+
+    def _poke(self, email_addr: str):
+        if email_addr in self.wakeups:
+            self.wakeups[email_addr].set()
+
+    def _sync_accounts(self, accounts: dict[str, typing.Hashable]):
+        for email_addr in list(self.accounts):
+            if accounts.get(email_addr, None) != self.accounts[email_addr]:
+                self._stop_account(email_addr)
+        for email_addr, key in accounts.items():
+            if email_addr not in self.accounts:
+                self._start_account(email_addr, key)
+
+    def _start_account(self, email_addr: str, key: typing.Hashable):
+        self.accounts[email_addr] = key
+        self.wakeups[email_addr] = asyncio.Event()
+        self.schedules[email_addr] = AdaptiveInterval(self.interval, self.min_interval, self.max_interval, jitter=self.jitter)
+        if email_addr not in self.poll_locks:
+            self.poll_locks[email_addr] = asyncio.Lock()
+        self.tasks[email_addr] = [self.loop.create_task(self._poll_loop(email_addr), name=f'poll-{email_addr}')]
+        if self.idle_fn:
+            self.tasks[email_addr].append(self.loop.create_task(self._idle_loop(email_addr), name=f'idle-{email_addr}'))
+
+    def _stop_account(self, email_addr: str):
+        for task in self.tasks.pop(email_addr, []):
+            task.cancel()
+        self.accounts.pop(email_addr, None)
+        self.wakeups.pop(email_addr, None)
+        self.schedules.pop(email_addr, None)
+
+    async def _wait_wakeup(self, wakeup: asyncio.Event, delay: float) -> tuple[bool, float]:
+        # returns whether it was poked and when the poll was due
+        due = time.monotonic() + delay
+        try:
+            await asyncio.wait_for(wakeup.wait(), delay)
+            return True, time.monotonic()
+        except asyncio.TimeoutError:
+            return False, due
+
+    async def _poll_loop(self, email_addr: str):
+        wakeup = self.wakeups[email_addr]
+        schedule = self.schedules[email_addr]
+        lock = self.poll_locks[email_addr]
+        woken, due = await self._wait_wakeup(wakeup, schedule.first_delay())
+        while True:
+            wakeup.clear() # pokes arriving during the poll trigger another one right after
+            # the next poll is only scheduled once this one finished, so polls of an account never overlap
+            async with lock, self.semaphore: # type: ignore[union-attr]
+                started = time.monotonic()
+                # a late timer or a full concurrency limit both eat into the poll interval
+                metrics.poll_lag.observe(max(started - due, 0), email_addr)
+                newMails = None
+                try:
+                    newMails = await self.poll_fn(email_addr, woken)
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.warning('poll of %s failed', email_addr, exc_info=True)
+            schedule.observe(newMails, started)
+            woken, due = await self._wait_wakeup(wakeup, schedule.next_delay())
+
+    async def _idle_loop(self, email_addr: str):
+        while True:
+            try:
+                await self.idle_fn(email_addr, lambda: self._poke(email_addr)) # type: ignore[misc]
+                return # returned normally: account does not support push
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.warning('idle of %s failed, retry in %ds', email_addr, self.idle_retry_interval, exc_info=True)
+            await asyncio.sleep(self.idle_retry_interval)
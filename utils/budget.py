@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+import typing
+
+# what one poll of an account may take before the rest waits for its next poll, 0 for no limit
+_poll_budget_mails = os.getenv('POLL_BUDGET_MAILS')
+POLL_BUDGET_MAILS = int(_poll_budget_mails) if _poll_budget_mails else 50
+_poll_budget_bytes = os.getenv('POLL_BUDGET_BYTES')
+POLL_BUDGET_BYTES = int(_poll_budget_bytes) if _poll_budget_bytes else 20 * 1024 * 1024
+_poll_budget_seconds = os.getenv('POLL_BUDGET_SECONDS')
+POLL_BUDGET_SECONDS = float(_poll_budget_seconds) if _poll_budget_seconds else 60.0
+# backlog mails of all accounts together every CATCHUP_WINDOW seconds, 0 for no limit
+_catchup_budget_mails = os.getenv('CATCHUP_BUDGET_MAILS')
+CATCHUP_BUDGET_MAILS = int(_catchup_budget_mails) if _catchup_budget_mails else 300
+_catchup_budget_bytes = os.getenv('CATCHUP_BUDGET_BYTES')
+CATCHUP_BUDGET_BYTES = int(_catchup_budget_bytes) if _catchup_budget_bytes else 100 * 1024 * 1024
+_catchup_window = os.getenv('CATCHUP_WINDOW')
+CATCHUP_WINDOW = float(_catchup_window) if _catchup_window else 60.0
+
+T = typing.TypeVar('T')
+
+def split_fresh(fresh: list[T], remaining: int | None, newest: int) -> tuple[list[T], list[T]]:
+    # new mails, oldest first -> (delivered by this poll, left as backlog). over budget the newest few
+    # go out now and the older ones wait. with no budget left neither: they stay new mail for the next poll
+    if remaining is None or len(fresh) <= remaining:
+        return fresh, []
+    if remaining <= 0:
+        return [], []
+    newest = max(min(newest, remaining), 1)
+    return fresh[-newest:], fresh[:-newest]
+
+class SharedBudget(object):
+    # backlog of all accounts per window, so a fleet recovering from an outage catches up at a steady
+    # pace and fresh mail (never charged here) keeps flowing meanwhile
+    def __init__(self, mails=CATCHUP_BUDGET_MAILS, bytes=CATCHUP_BUDGET_BYTES, window=CATCHUP_WINDOW):
+        self.mails = mails
+        self.bytes = bytes
+        self.window = window
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.spent_mails = self.spent_bytes = 0
+
+    def _roll(self):
+        now = time.monotonic()
+        if now - self.window_start >= self.window:
+            self.window_start = now
+            self.spent_mails = self.spent_bytes = 0
+
+    def exhausted(self) -> bool:
+        with self.lock:
+            self._roll()
+            return bool(self.mails and self.spent_mails >= self.mails or self.bytes and self.spent_bytes >= self.bytes)
+
+    def spend(self, bytes: int):
+        with self.lock:
+            self._roll()
+            self.spent_mails += 1
+            self.spent_bytes += bytes
+
+class WorkBudget(object):
+    # one poll of one account. checked before every mail, so a mail in flight is always finished
+    def __init__(self, mails=POLL_BUDGET_MAILS, bytes=POLL_BUDGET_BYTES, seconds=POLL_BUDGET_SECONDS,
+                 shared: SharedBudget | None = None):
+        self.mails = mails
+        self.bytes = bytes
+        self.seconds = seconds
+        self.shared = shared
+        self.started = time.monotonic()
+        self.spent_mails = self.spent_bytes = 0
+
+    def remaining_mails(self) -> int | None:
+        return max(self.mails - self.spent_mails, 0) if self.mails else None
+
+    def exhausted(self, backlog=False) -> bool:
+        if self.mails and self.spent_mails >= self.mails or self.bytes and self.spent_bytes >= self.bytes:
+            return True
+        if self.seconds and time.monotonic() - self.started >= self.seconds:
+            return True
+        return backlog and self.shared is not None and self.shared.exhausted()
+
+    def spend(self, bytes: int, backlog=False):
+        self.spent_mails += 1
+        self.spent_bytes += bytes
+        if backlog and self.shared is not None:
+            self.shared.spend(bytes)
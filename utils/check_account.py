@@ -0,0 +1,47 @@
+import asyncio
+import logging
+import sys
+
+from . import AsyncEmailClientBase, AsyncEmailClientIMAP, AsyncEmailClientPOP3
+from .oauth2_helper import OAuth2Factory
+
+logger = logging.getLogger(__name__)
+
+# manual server check: python -m utils.check_account john.doe@example.com password imaps://imap.example.com
+# prints the newest mail, then every new one as it arrives
+
+async def main(email_account: str, password: str, server_uri: str, interval=5):
+    new_passwd = OAuth2Factory.code_to_token(password)
+    if new_passwd:
+        print('changed code into token', new_passwd)
+        password = new_passwd
+    client: AsyncEmailClientBase = (AsyncEmailClientPOP3 if server_uri.startswith('pop3') else AsyncEmailClientIMAP)(email_account, password, server_uri)
+    await client.connect()
+    try:
+        inbox_num = await client.get_mails_count()
+        print(inbox_num, 'mails, uid sync:', client.supports_uid_sync(), 'uidl sync:', client.supports_uidl_sync(), 'idle:', client.supports_idle())
+        if inbox_num:
+            print((await client.get_mail_by_index(inbox_num)).format_email()[0])
+        while True:
+            await asyncio.sleep(interval)
+            await client.refresh_connection()
+            new_inbox_num = await client.get_mails_count()
+            for idx in range(inbox_num + 1, new_inbox_num + 1):
+                try:
+                    mail = await client.get_mail_by_index(idx)
+                except Exception:
+                    logger.warning('cannot retrieve mail %d', idx, exc_info=True)
+                    continue
+                print('Got new mail:', mail.format_email()[0])
+            inbox_num = new_inbox_num
+    finally:
+        await client.cleanup()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        sys.exit(f'usage: python -m {__spec__.name} email_account password server_uri')
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main(*sys.argv[1:4]))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,120 @@
+import asyncio
+import dataclasses
+import logging
+import time
+import typing
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from . import metrics
+from .aio_client_base import AsyncEmailClientBase
+
+logger = logging.getLogger(__name__)
+
+@dataclasses.dataclass
+class PooledClient():
+    client: AsyncEmailClientBase
+    identity: typing.Hashable
+    last_used: float
+
+class ClientPool(object):
+    # one cached connection per account on the engine loop, keyed on the account identity
+    # (credentials and server) so sync state changes never orphan it. least recently used
+    # connections are closed above max_size, idle ones after idle_timeout.
+    def __init__(self, max_size=100, idle_timeout=300, request_timeout=60):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.request_timeout = request_timeout
+        self.clients: OrderedDict[str, PooledClient] = OrderedDict()
+        self.leased = 0
+        self.counters = {
+            'hits': 0,
+            'connects': 0,
+            'health_check_failures': 0,
+            'replaced': 0, # credentials or server changed
+            'evicted': 0,
+            'idle_closed': 0,
+            'dropped': 0, # state unknown after an error, timeout or cancellation
+        }
+
+    @asynccontextmanager
+    async def lease(self, email_addr: str, identity: typing.Hashable,
+                    connect: typing.Callable[[], typing.Awaitable[AsyncEmailClientBase]]):
+        # leased clients are out of the pool, so they are never evicted or reaped while in use.
+        # the client is killed if the block raises, as its protocol state is unknown then
+        entry = self.clients.pop(email_addr, None)
+        self.leased += 1
+        try:
+            if entry and entry.identity != identity:
+                self._count('replaced', email_addr)
+                await self._close(entry.client)
+                entry = None
+            if entry:
+                try:
+                    # NOOP on IMAP, a fresh session on POP3
+                    await asyncio.wait_for(entry.client.refresh_connection(), self.request_timeout)
+                    self._count('hits', email_addr)
+                except Exception as e:
+                    logger.info('email client for %s is invalid (%s), re-creating...', email_addr, str(e) or type(e).__name__)
+                    self._count('health_check_failures', email_addr)
+                    entry.client.kill()
+                    entry = None
+            if entry:
+                client = entry.client
+            else:
+                client = await connect()
+                self._count('connects', email_addr)
+            try:
+                yield client
+            except BaseException:
+                self._count('dropped', email_addr)
+                client.kill()
+                raise
+        finally:
+            self.leased -= 1
+        self.clients[email_addr] = PooledClient(client, identity, time.monotonic())
+        await self._evict()
+
+    def _count(self, name: str, email_addr: str):
+        self.counters[name] += 1
+        metrics.client_cache.inc(email_addr, name)
+
+    async def _close(self, client: AsyncEmailClientBase):
+        try:
+            await asyncio.wait_for(client.cleanup(), self.request_timeout)
+        except Exception:
+            logger.debug('cannot close email client cleanly', exc_info=True)
+            client.kill()
+
+    async def _evict(self):
+        while self.clients and len(self.clients) + self.leased > self.max_size:
+            email_addr, entry = self.clients.popitem(last=False)
+            logger.info('closing least recently used email client of %s', email_addr)
+            self._count('evicted', email_addr)
+            await self._close(entry.client)
+
+    async def close_idle(self):
+        deadline = time.monotonic() - self.idle_timeout
+        for email_addr in [k for k, entry in self.clients.items() if entry.last_used < deadline]:
+            entry = self.clients.pop(email_addr, None) # may be leased meanwhile
+            if entry is None:
+                continue
+            logger.info('closing idle email client of %s', email_addr)
+            self._count('idle_closed', email_addr)
+            await self._close(entry.client)
+
+    async def run_reaper(self, interval=60):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.close_idle()
+            except Exception:
+                logger.warning('cannot close idle email clients', exc_info=True)
+
+    async def close_all(self):
+        while self.clients:
+            _, entry = self.clients.popitem()
+            await self._close(entry.client)
+
+    def stats(self) -> dict:
+        return {'pooled': len(self.clients), 'leased': self.leased, 'max_size': self.max_size, **self.counters}
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import pickle
+import struct
+import sys
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+# worker processes for pure python cpu work (parsing, html conversion, splitting), 0 to do it on the engine loop as before
+_parse_workers = os.getenv('PARSE_WORKERS')
+PARSE_WORKERS = int(_parse_workers) if _parse_workers else (os.cpu_count() or 1)
+# seconds one job may run before its worker is killed
+_parse_timeout = os.getenv('PARSE_TIMEOUT')
+PARSE_TIMEOUT = float(_parse_timeout) if _parse_timeout else 10.0
+# smaller mails and bodies are handled in place: spooling and piping them costs more than the work itself,
+# below this only html conversion takes long enough (tens of ms) to be worth it
+_parse_offload_min_size = os.getenv('PARSE_OFFLOAD_MIN_SIZE')
+PARSE_OFFLOAD_MIN_SIZE = int(_parse_offload_min_size) if _parse_offload_min_size else 256 * 1024
+
+_HEADER = struct.Struct('>I')
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class CpuPoolError(Exception):
+    pass
+
+class _Worker(object):
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.jobs = 0
+
+    async def call(self, fn, args) -> tuple[bool, typing.Any, float]:
+        data = pickle.dumps((fn, args), pickle.HIGHEST_PROTOCOL)
+        self.process.stdin.write(_HEADER.pack(len(data)) + data) # type: ignore[union-attr]
+        await self.process.stdin.drain() # type: ignore[union-attr]
+        size, = _HEADER.unpack(await self.process.stdout.readexactly(_HEADER.size)) # type: ignore[union-attr]
+        self.jobs += 1
+        return pickle.loads(await self.process.stdout.readexactly(size)) # type: ignore[union-attr]
+
+    def kill(self):
+        if self.process.returncode is None:
+            self.process.kill()
+
+class CpuPool(object):
+    # runs module level functions in separate python processes, so a burst of heavy mails uses all
+    # cores instead of queueing on the GIL of the engine loop. workers are plain python processes,
+    # not multiprocessing ones, which would import bot.py again. a job is only sent to an idle worker,
+    # so the timeout counts its own run time: the worker of a runaway job is killed and replaced.
+    # only used from the engine loop
+    def __init__(self, workers=PARSE_WORKERS, timeout=PARSE_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self.idle: list[_Worker] = []
+        self.running: set[_Worker] = set()
+        self.semaphore: asyncio.Semaphore | None = None
+        self.closed = False
+        self.counters = {'jobs': 0, 'timeouts': 0, 'failed': 0, 'started': 0}
+
+    async def _spawn(self) -> _Worker:
+        # not `-m`: the package imports this module before it would run as __main__
+        process = await asyncio.create_subprocess_exec(sys.executable, '-c', f'from {__name__} import _serve; _serve()', cwd=_ROOT,
+                                                       stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        self.counters['started'] += 1
+        return _Worker(process)
+
+    async def run(self, fn: typing.Callable, *args) -> tuple[typing.Any, float]:
+        # returns fn(*args) and the seconds the worker spent on it, raises asyncio.TimeoutError
+        # after timeout and CpuPoolError when fn raised or the worker died
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.workers)
+        async with self.semaphore:
+            if self.closed:
+                raise CpuPoolError('cpu pool is closed')
+            worker = self.idle.pop() if self.idle else await self._spawn()
+            self.running.add(worker)
+            try:
+                ok, value, elapsed = await asyncio.wait_for(worker.call(fn, args), self.timeout)
+            except asyncio.TimeoutError:
+                self.counters['timeouts'] += 1
+                worker.kill()
+                raise
+            except (asyncio.IncompleteReadError, ConnectionError, pickle.PickleError) as e:
+                self.counters['failed'] += 1
+                worker.kill()
+                raise CpuPoolError(f'cpu pool worker died running {fn.__name__}') from e
+            except BaseException:
+                worker.kill() # cancelled halfway through the protocol
+                raise
+            finally:
+                self.running.discard(worker)
+            self.counters['jobs'] += 1
+            if not self.closed:
+                self.idle.append(worker)
+            else:
+                worker.kill()
+        if not ok:
+            self.counters['failed'] += 1
+            raise CpuPoolError(f'{fn.__name__} failed in cpu pool: {value}')
+        return value, elapsed
+
+    async def close(self):
+        self.closed = True
+        workers, self.idle = self.idle + list(self.running), []
+        for worker in workers:
+            worker.kill()
+        for worker in workers:
+            await worker.process.wait()
+
+    def stats(self) -> dict:
+        return {'workers': len(self.idle) + len(self.running), 'busy': len(self.running), **self.counters}
+
+def _serve():
+    # worker side: length prefixed pickles of (fn, args) in on stdin, (ok, result, seconds) out on stdout
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    sys.stdout = sys.stderr # stray prints must not end up in the protocol
+    read = sys.stdin.buffer.read
+    while True:
+        header = read(_HEADER.size)
+        if len(header) < _HEADER.size:
+            return # the bot went away
+        fn, args = pickle.loads(read(_HEADER.unpack(header)[0]))
+        started = time.perf_counter()
+        try:
+            response = (True, fn(*args), time.perf_counter() - started)
+        except Exception as e:
+            response = (False, repr(e), time.perf_counter() - started)
+        data = pickle.dumps(response, pickle.HIGHEST_PROTOCOL)
+        out.write(_HEADER.pack(len(data)) + data)
+        out.flush()
+
+if __name__ == '__main__':
+    _serve()
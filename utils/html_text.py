@@ -0,0 +1,189 @@
+import hashlib
+import html.parser
+import logging
+import os
+import re
+import threading
+import time
+import typing
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# text (default, stdlib tokenizer) or markdownify (slower, markdown output)
+HTML_CONVERTER = os.getenv('HTML_CONVERTER') or 'text'
+# html beyond this many characters is not converted
+_html_max_size = os.getenv('HTML_MAX_SIZE')
+HTML_MAX_SIZE = int(_html_max_size) if _html_max_size else 512 * 1024
+# seconds one conversion may take, what is converted by then is kept
+_html_time_budget = os.getenv('HTML_TIME_BUDGET')
+HTML_TIME_BUDGET = float(_html_time_budget) if _html_time_budget else 2.0
+# converted bodies kept by content hash, 0 to disable
+_html_cache_size = os.getenv('HTML_CACHE_SIZE')
+HTML_CACHE_SIZE = int(_html_cache_size) if _html_cache_size else 256
+
+TRUNCATED_NOTICE = '\n\n(HTML body truncated)'
+
+_FEED_SIZE = 64 * 1024 # the time budget is checked between feeds
+_SKIP_TAGS = {'script', 'style', 'head', 'title', 'template', 'noscript'}
+_BLOCK_TAGS = {'p', 'div', 'table', 'tr', 'ul', 'ol', 'dl', 'blockquote', 'pre', 'section', 'article',
+               'header', 'footer', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'form', 'center', 'dt', 'dd'}
+_SPACE_RE = re.compile(r'\s+')
+_BLANK_LINES_RE = re.compile(r'\n[ \t]*(?:\n[ \t]*)+')
+
+class _TextParser(html.parser.HTMLParser):
+    # html to readable plain text in one pass: block elements become line breaks, list items get
+    # a dash, links keep their target, scripts and styles are dropped
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out: list[str] = []
+        self.skip = 0
+        self.pre = 0
+        self.links: list[str | None] = []
+        self.link_text: list[int] = [] # len(out) when the link was opened
+
+    def _newline(self):
+        self.out.append('\n')
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self.skip += 1
+        elif tag == 'br':
+            self._newline()
+        elif tag == 'li':
+            self.out.append('\n- ')
+        elif tag in ('td', 'th'):
+            self.out.append(' ')
+        elif tag == 'a':
+            self.links.append(dict(attrs).get('href'))
+            self.link_text.append(len(self.out))
+        elif tag == 'img':
+            alt = dict(attrs).get('alt')
+            if alt and not self.skip:
+                self.out.append(f' {alt.strip()} ')
+        elif tag in _BLOCK_TAGS:
+            self._newline()
+            if tag == 'pre':
+                self.pre += 1
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in _SKIP_TAGS or tag in ('a', 'pre'):
+            return # nothing inside, nothing to close
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag == 'a' and self.links:
+            href, start = self.links.pop(), self.link_text.pop()
+            text = ''.join(self.out[start:]).strip()
+            if href and href.startswith(('http:', 'https:')) and href != text and not self.skip:
+                self.out.append(f' ({href})')
+        elif tag in _BLOCK_TAGS:
+            if tag == 'pre':
+                self.pre = max(self.pre - 1, 0)
+            self._newline()
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        self.out.append(data if self.pre else _SPACE_RE.sub(' ', data))
+
+    def text(self) -> str:
+        lines = (line.strip() for line in ''.join(self.out).split('\n'))
+        return _BLANK_LINES_RE.sub('\n\n', '\n'.join(lines)).strip()
+
+def _convert_text(payload: str, deadline: float) -> tuple[str, bool]:
+    parser = _TextParser()
+    for start in range(0, len(payload), _FEED_SIZE):
+        if start and time.monotonic() > deadline:
+            return parser.text(), True
+        parser.feed(payload[start:start + _FEED_SIZE])
+    parser.close()
+    return parser.text(), False
+
+def _convert_markdownify(payload: str, deadline: float) -> tuple[str, bool]:
+    # not interruptible, only the size cap bounds it
+    from markdownify import markdownify as md # type: ignore
+    return md(payload), False
+
+CONVERTERS: dict[str, typing.Callable[[str, float], tuple[str, bool]]] = {
+    'text': _convert_text,
+    'markdownify': _convert_markdownify,
+}
+
+class HtmlConverter(object):
+    # converts html bodies with the configured backend, capped in size and time, results are
+    # cached by content hash so repeated templates and re-renders are converted once
+    def __init__(self, backend=HTML_CONVERTER, max_size=HTML_MAX_SIZE, time_budget=HTML_TIME_BUDGET,
+                 cache_size=HTML_CACHE_SIZE):
+        if backend not in CONVERTERS:
+            logger.warning('unknown html converter %s, using text', backend)
+            backend = 'text'
+        self.backend = backend
+        self.max_size = max_size
+        self.time_budget = time_budget
+        self.cache_size = cache_size
+        self.cache: OrderedDict[bytes, str] = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {'converted': 0, 'cache_hits': 0, 'truncated': 0, 'failed': 0}
+
+    def _key(self, payload: str) -> bytes:
+        return hashlib.blake2b(payload.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+    def cached(self, payload: str) -> str | None:
+        key = self._key(payload)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.counters['cache_hits'] += 1
+                return self.cache[key]
+        return None
+
+    def render(self, payload: str) -> tuple[str, str]:
+        # the conversion alone, without cache and counters (also runs in cpu pool workers).
+        # returns the text and converted, truncated or failed
+        head = payload[:self.max_size]
+        truncated = len(head) < len(payload)
+        if truncated and head.rfind('<') > head.rfind('>'):
+            head = head[:head.rfind('<')] # do not leave half a tag as text
+        try:
+            text, timedOut = CONVERTERS[self.backend](head, time.monotonic() + self.time_budget)
+        except Exception:
+            logger.warning('cannot convert html with %s, fallback to raw HTML instead.', self.backend, exc_info=True)
+            return self.fallback(payload), 'failed'
+        if truncated or timedOut:
+            return text + TRUNCATED_NOTICE, 'truncated'
+        return text, 'converted'
+
+    def fallback(self, payload: str) -> str:
+        return payload[:self.max_size]
+
+    def remember(self, payload: str, text: str, outcome: str):
+        with self.lock:
+            if outcome == 'failed':
+                self.counters['failed'] += 1
+                return
+            self.counters['converted'] += 1
+            self.counters['truncated'] += outcome == 'truncated'
+            if self.cache_size > 0:
+                self.cache[self._key(payload)] = text
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+    def convert(self, payload: str) -> str:
+        text = self.cached(payload)
+        if text is None:
+            text, outcome = self.render(payload)
+            self.remember(payload, text, outcome)
+        return text
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'backend': self.backend, 'cached': len(self.cache), **self.counters}
+
+converter = HtmlConverter()
+
+def render_html(payload: str) -> tuple[str, str]:
+    # picklable entry point for the cpu pool
+    return converter.render(payload)
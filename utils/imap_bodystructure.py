@@ -0,0 +1,146 @@
+import dataclasses
+import email.header
+import email.utils
+import itertools
+import re
+import typing
+
+# aio_client_imap reads FETCH responses as a list mixing bytes lines and (prefix, literal) tuples,
+# this module turns them back into nested python lists and walks BODYSTRUCTURE (RFC 3501 7.4.2)
+
+_TOKEN_RE = re.compile(rb'\s*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"|\{(?P<literal>\d+)\}$|(?P<atom>[^\s()"\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?))')
+
+def _tokenize(data) -> typing.Iterator[tuple[str, typing.Any]]:
+    for chunk in data:
+        literal = None
+        if isinstance(chunk, tuple):
+            chunk, literal = chunk
+        if not isinstance(chunk, bytes):
+            continue
+        pos = 0
+        while pos < len(chunk):
+            m = _TOKEN_RE.match(chunk, pos)
+            if not m or m.end() == pos:
+                if chunk[pos:].strip():
+                    raise ValueError(f'cannot parse imap response near {chunk[pos:]!r}')
+                break
+            pos = m.end()
+            if m.group('open'):
+                yield 'open', None
+            elif m.group('close'):
+                yield 'close', None
+            elif m.group('quoted') is not None:
+                yield 'value', re.sub(rb'\\(.)', rb'\1', m.group('quoted'))
+            elif m.group('literal') is not None:
+                yield 'value', literal if literal is not None else b''
+                literal = None
+            elif m.group('atom') is not None:
+                atom = m.group('atom')
+                yield 'value', None if atom.upper() == b'NIL' else atom
+
+def parse_response(data) -> list:
+    # returns the top level items, lists nested as python lists
+    stack: list[list] = [[]]
+    for kind, value in _tokenize(data):
+        if kind == 'open':
+            stack.append([])
+        elif kind == 'close':
+            if len(stack) == 1:
+                raise ValueError('unbalanced imap response')
+            item = stack.pop()
+            stack[-1].append(item)
+        else:
+            stack[-1].append(value)
+    if len(stack) != 1:
+        raise ValueError('unbalanced imap response')
+    return stack[0]
+
+def parse_fetch_response(data) -> dict[int, dict[str, typing.Any]]:
+    # {uid (or sequence number if no UID item): {'BODYSTRUCTURE': [...], 'BODY[HEADER]': b'...'}}
+    items = parse_response(data)
+    ret = {}
+    for seq, attrs in zip(items[::2], items[1::2]):
+        if not isinstance(attrs, list):
+            continue
+        values = {}
+        for key, value in zip(attrs[::2], attrs[1::2]):
+            values[key.decode().upper().replace('BODY.PEEK[', 'BODY[')] = value
+        uid = int(values['UID']) if 'UID' in values else int(seq)
+        ret.setdefault(uid, {}).update(values) # e.g. a flag update for the same message merges in
+    return ret
+
+@dataclasses.dataclass
+class BodyPart():
+    section: str
+    type: str # e.g. text/plain
+    params: dict[str, str]
+    encoding: str
+    size: int
+    disposition: str | None
+    filename: str | None
+
+    @property
+    def charset(self) -> str | None:
+        return self.params.get('charset')
+
+    @property
+    def is_attachment(self) -> bool:
+        if self.disposition == 'attachment':
+            return True
+        return not self.type.startswith('text/') or bool(self.filename)
+
+def _str(value) -> str:
+    if value is None:
+        return ''
+    return value.decode('utf8', 'replace') if isinstance(value, bytes) else str(value)
+
+def _params(value) -> dict[str, str]:
+    if not isinstance(value, list):
+        return {}
+    return {_str(k).lower(): _str(v) for k, v in zip(value[::2], value[1::2])}
+
+def _decode_filename(params: dict[str, str]) -> str | None:
+    for key in ('filename', 'name'):
+        if key in params:
+            return str(email.header.make_header(email.header.decode_header(params[key])))
+        # RFC 2231, servers usually leave continuations/charset for us to decode
+        if key + '*' in params:
+            return email.utils.collapse_rfc2231_value(email.utils.decode_rfc2231(params[key + '*']))
+    return None
+
+def walk_bodystructure(bs: list, section='') -> list[BodyPart]:
+    if bs and isinstance(bs[0], list):
+        # multipart: (part1)(part2)... "subtype" [extension data]
+        parts = []
+        for i, child in enumerate(itertools.takewhile(lambda c: isinstance(c, list), bs)):
+            parts += walk_bodystructure(child, f'{section}.{i + 1}' if section else str(i + 1))
+        return parts
+    maintype, subtype = _str(bs[0]).lower(), _str(bs[1]).lower()
+    params = _params(bs[2])
+    encoding = _str(bs[5]).lower() or '7bit'
+    size = int(bs[6] or 0)
+    # extension data position depends on the type
+    ext = 7
+    if maintype == 'text':
+        ext = 8
+    elif maintype == 'message' and subtype == 'rfc822':
+        ext = 10
+    disposition = None
+    if len(bs) > ext + 1 and isinstance(bs[ext + 1], list) and bs[ext + 1]:
+        disposition = _str(bs[ext + 1][0]).lower()
+        params = {**_params(bs[ext + 1][1] if len(bs[ext + 1]) > 1 else None), **params}
+    return [BodyPart(
+        section=section or '1',
+        type=f'{maintype}/{subtype}',
+        params=params,
+        encoding=encoding,
+        size=size,
+        disposition=disposition,
+        filename=_decode_filename(params),
+    )]
+
+def find_part(bs: list, section: str) -> BodyPart | None:
+    for part in walk_bodystructure(bs):
+        if part.section == section:
+            return part
+    return None
@@ -0,0 +1,115 @@
+# protocol helpers of the asyncio client (aio_client_imap)
+from base64 import b64decode, b64encode
+import logging
+import imaplib
+import re
+
+from .client_base import MailboxStatus
+from .mail import Email, LazyPart, decode_transfer_encoding
+from .imap_bodystructure import BodyPart, find_part, walk_bodystructure
+
+logger = logging.getLogger(__name__)
+
+# RFC 2177: servers may log out clients idling longer than 30 minutes (29 min in practice),
+# so IDLE is re-issued well before that
+IDLE_RENEW_INTERVAL = 25 * 60
+# messages per FETCH round trip, bounds the memory held by one response
+FETCH_BATCH_SIZE = 20
+
+STRUCTURE_FETCH_ITEMS = '(UID BODYSTRUCTURE BODY.PEEK[HEADER])'
+
+def is_new_mail_response(line: bytes) -> bool:
+    return re.match(rb'^\* \d+ EXISTS\b', line) is not None
+
+def parse_status_response(line: bytes) -> MailboxStatus:
+    # b'INBOX (MESSAGES 3 UIDNEXT 10 UIDVALIDITY 1234 HIGHESTMODSEQ 55)'
+    m = re.search(rb'\(([^()]*)\)\s*$', line)
+    if not m:
+        raise imaplib.IMAP4.error(f'invalid imap status response: {line!r}')
+    tokens = m.group(1).split()
+    values = {k.decode().upper(): int(v) for k, v in zip(tokens[::2], tokens[1::2])}
+    return MailboxStatus(
+        messages=values.get('MESSAGES', 0),
+        uidnext=values.get('UIDNEXT', 0),
+        uidvalidity=values.get('UIDVALIDITY', 0),
+        highestmodseq=values.get('HIGHESTMODSEQ', 0),
+    )
+
+def encode_mailbox_name(name: str) -> str:
+    # modified UTF-7 (RFC 3501 5.1.3): printable ascii as is, '&' as '&-', anything else base64'd utf-16
+    out: list[str] = []
+    pending: list[str] = []
+    def flush():
+        if pending:
+            out.append('&' + b64encode(''.join(pending).encode('utf-16-be')).decode().rstrip('=').replace('/', ',') + '-')
+            pending.clear()
+    for c in name:
+        if 0x20 <= ord(c) <= 0x7e:
+            flush()
+            out.append('&-' if c == '&' else c)
+        else:
+            pending.append(c)
+    flush()
+    return ''.join(out)
+
+def decode_mailbox_name(name: str) -> str:
+    def decode(m):
+        data = m.group(1).replace(',', '/')
+        return b64decode(data + '=' * (-len(data) % 4)).decode('utf-16-be', 'replace') if data else '&'
+    return re.sub(r'&([^-]*)-', decode, name)
+
+def parse_mailbox_name(chunks: list, prefix: bytes) -> tuple[str, bytes]:
+    # the (still encoded) mailbox name after prefix in an untagged response as read by the asyncio client,
+    # quoted, an atom or a literal, and what follows it
+    if isinstance(chunks[0], tuple):
+        return chunks[0][1].decode('utf8', 'replace'), chunks[1] if len(chunks) > 1 else b''
+    rest = chunks[0][len(prefix):]
+    m = re.match(rb'"((?:[^"\\]|\\.)*)"', rest)
+    if m:
+        return re.sub(rb'\\(.)', rb'\1', m.group(1)).decode('utf8', 'replace'), rest[m.end():]
+    name, _, rest = rest.partition(b' ')
+    return name.decode('utf8', 'replace'), rest
+
+def decode_charset(raw: bytes, charset: str | None) -> str:
+    try:
+        return raw.decode(charset or 'utf-8', 'replace')
+    except LookupError:
+        return raw.decode('utf-8', 'replace')
+
+def plan_structure_fetch(structures: dict[int, dict]):
+    # split every mail into text bodies to fetch now and attachments to leave on the server,
+    # then group mails by the body sections to fetch
+    mailParts: dict[int, tuple[list[BodyPart], list[BodyPart]]] = {}
+    bySections: dict[tuple[str, ...], list[int]] = {}
+    for uid, values in structures.items():
+        parts = walk_bodystructure(values['BODYSTRUCTURE'])
+        bodies = [p for p in parts if not p.is_attachment and p.type in ('text/plain', 'text/html')]
+        mailParts[uid] = (bodies, [p for p in parts if p not in bodies])
+        if bodies:
+            bySections.setdefault(tuple(p.section for p in bodies), []).append(uid)
+    return mailParts, bySections
+
+def body_fetch_items(sections) -> str:
+    return '(UID %s)' % ' '.join(f'BODY.PEEK[{s}]' for s in sections)
+
+def build_structure_mails(structures: dict[int, dict], mailParts, bodyData: dict[int, dict]):
+    for uid in sorted(structures):
+        bodies, attachments = mailParts[uid]
+        text = html = None
+        for part in bodies:
+            raw = decode_transfer_encoding(bodyData.get(uid, {}).get(f'BODY[{part.section}]') or b'', part.encoding)
+            payload = decode_charset(raw, part.charset)
+            if part.type == 'text/html':
+                html = payload if html is None else html + payload
+            else:
+                text = payload if text is None else text + payload
+        lazyParts = [LazyPart(section=p.section, filename=p.filename, type=p.type, size=p.size) for p in attachments]
+        yield uid, Email.from_structure(structures[uid].get('BODY[HEADER]') or b'', text, html, lazyParts)
+
+def find_fetched_part(uid, section, values) -> tuple[BodyPart, bytes]:
+    if not values:
+        raise imaplib.IMAP4.error(f'message uid {uid} does not exist anymore')
+    part = find_part(values['BODYSTRUCTURE'], section)
+    if not part:
+        raise imaplib.IMAP4.error(f'message uid {uid} has no section {section}')
+    return part, decode_transfer_encoding(values.get(f'BODY[{section}]') or b'', part.encoding)
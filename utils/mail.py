@@ -1,11 +1,70 @@
+from base64 import b64decode
+import dataclasses
+import quopri
+import time
+import typing
+
 from pyzmail import PyzMessage, decode_text # type: ignore
 from pyzmail.parse import MailPart # type: ignore
 
+from .html_text import converter
+from .render import escape
+
 import logging
 logger = logging.getLogger(__name__)
 
+def html_to_text(payload):
+    return converter.convert(payload)
+
+def message_id_from_header(raw_header: bytes) -> str:
+    # same value Email.id gets, for checks made before the body is fetched
+    return PyzMessage.factory(raw_header).get_decoded_header('message-id', '')
+
+def decode_transfer_encoding(data: bytes, encoding: str | None) -> bytes:
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        return b64decode(data)
+    elif encoding == 'quoted-printable':
+        return quopri.decodestring(data)
+    return data
+
+@dataclasses.dataclass
+class LazyPart():
+    # attachment which stays on the server until someone asks for it
+    section: str
+    filename: str | None
+    type: str
+    size: int
+
+    def get_filename(self):
+        return self.filename
+
+@dataclasses.dataclass
+class SpooledPart():
+    # attachment decoded by the streaming parser, in memory or in a temporary file when large
+    filename: str | None
+    type: str
+    size: int
+    charset: str | None
+    file: typing.BinaryIO
+
+    def get_filename(self):
+        return self.filename
+
+    def get_payload(self) -> bytes:
+        return self.open().read()
+
+    def open(self) -> typing.BinaryIO:
+        # rewound on every call, so retried uploads send the whole file again
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
 class Email(object):
     def __init__(self, raw_mail_lines):
+        started = time.perf_counter()
         if isinstance(raw_mail_lines, str):
             msg_content = raw_mail_lines
         else:
@@ -13,54 +72,106 @@ class Email(object):
         try:
             msg =  PyzMessage.factory(msg_content)
 
-            self.subject = msg.get_subject()
-            self.sender = msg.get_address('from')
-            self.date = msg.get_decoded_header('date', '')
-            self.id = msg.get_decoded_header('message-id', '')
+            self._load_headers(msg)
 
             self.text = None
             self.html = None
+            self.raw_html = None
             self.additional_parts = []
+            self.lazy_parts: list[LazyPart] = []
+            self.truncated_size: int | None = None # set if only a preview of the mail was fetched
             for mailpart in msg.mailparts:
                 mailpart: MailPart
-                is_body = mailpart.is_body or ''
+                is_body = mailpart.is_body or '' # None for attachments
                 if is_body.startswith('text/html'):
                     payload, used_charset=decode_text(mailpart.get_payload(), mailpart.charset, None)
-                    try:
-                        from markdownify import markdownify as md # type: ignore
-                        self.html = md(payload)
-                    except Exception:
-                        logger.warning("cannot use markdownify to convert html, fallback to raw HTML instead.")
-                        self.html = payload
-                elif not is_body or is_body.startswith('text/'):
+                    self.html = html_to_text(payload)
+                elif is_body.startswith('text/'):
                     payload, used_charset=decode_text(mailpart.get_payload(), mailpart.charset, None)
                     self.text = payload
                 else:
                     self.additional_parts.append(mailpart)
         except Exception as e:
             raise Exception("Cannot parse email body: %s" % raw_mail_lines) from e
+        self.parse_time = time.perf_counter() - started
+
+    def _load_headers(self, msg):
+        self.subject = msg.get_subject()
+        self.sender = msg.get_address('from')
+        self.date = msg.get_decoded_header('date', '')
+        self.id = msg.get_decoded_header('message-id', '')
+        self.references = msg.get_decoded_header('references', '')
+
+    @classmethod
+    def from_structure(cls, raw_header: bytes, text: str | None, html: str | None, lazy_parts: list[LazyPart],
+                       additional_parts: list | None = None):
+        # build from separately fetched or parsed header and body parts (IMAP BODYSTRUCTURE mode, streaming parser)
+        started = time.perf_counter()
+        self = cls.__new__(cls)
+        try:
+            self._load_headers(PyzMessage.factory(raw_header))
+        except Exception as e:
+            raise Exception("Cannot parse email header: %s" % raw_header) from e
+        self.text = text
+        # converted when rendered, unless the cpu pool did it before
+        self.html = None
+        self.raw_html = html
+        self.additional_parts = additional_parts or []
+        self.lazy_parts = lazy_parts
+        self.truncated_size = None
+        self.parse_time = time.perf_counter() - started # the streaming parser adds its own share
+        return self
+
+    def convert_html(self):
+        if self.raw_html is not None:
+            started = time.perf_counter()
+            self.set_html(html_to_text(self.raw_html))
+            self.parse_time += time.perf_counter() - started
+
+    def set_html(self, html: str):
+        self.html = html
+        self.raw_html = None
+
+    def close(self):
+        # drop temporary files of spooled parts
+        for part in self.additional_parts:
+            if isinstance(part, SpooledPart):
+                part.close()
 
     def __repr__(self):
         text, _ = self.format_email()
         return text
 
-    def format_email(self):
-        mail_str = "Subject: %s\n" % self.subject
-        mail_str += "From: %s %s\n" % self.sender
-        mail_str += "Date: %s\n" % self.date
-        mail_str += "ID: %s\n" % self.id
+    def format_email(self, html=False):
+        # html: markup for telegram's HTML parse mode, everything taken from the mail is escaped
+        self.convert_html()
+        esc = escape if html else str
+        label = (lambda s: f'<b>{s}</b>') if html else (lambda s: s)
+        mail_str = "%s %s\n" % (label('Subject:'), esc(self.subject))
+        mail_str += "%s %s %s\n" % (label('From:'), esc(self.sender[0]), esc(self.sender[1]))
+        mail_str += "%s %s\n" % (label('Date:'), esc(self.date))
+        mail_str += "%s %s\n" % (label('ID:'), esc(self.id))
         mail_str += "\n"
         mainbody = self.text
         if not self.text or len(self.text) < 20: # not like a real email
             mainbody = self.html or self.text or ''
+        mainbody = esc(mainbody)
         retfiles = []
-        if self.additional_parts:
-            mainbody += f'\n\nAdditional Parts:\n'
+        if self.additional_parts or self.lazy_parts:
+            mainbody += f'\n\n{label("Additional Parts:")}\n'
             for part in self.additional_parts:
-                part: MailPart
-                part_name = part.get_filename()
-                part_content = part.get_payload()
-                mainbody += f'- {part_name} ({part.type}, size {len(part_content)})'
+                part: MailPart | SpooledPart
+                part_name = part.filename # MailPart has no get_filename()
+                if isinstance(part, SpooledPart):
+                    part_size, part_content = part.size, part.open() # file handle, may be on disk
+                else:
+                    part_content = part.get_payload()
+                    part_size = len(part_content)
+                mainbody += f'- {esc(part_name)} ({esc(part.type)}, size {part_size})\n'
                 retfiles.append((part_name, part.type, part_content))
+            for lazy_part in self.lazy_parts:
+                mainbody += f'- {esc(lazy_part.filename)} ({esc(lazy_part.type)}, size {lazy_part.size}, not downloaded)\n'
+        if self.truncated_size:
+            mainbody += f'\n\n(Preview only, full message size {self.truncated_size})'
         mail_str += mainbody
-        return mail_str, retfiles
\ No newline at end of file
+        return mail_str, retfiles
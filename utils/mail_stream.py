@@ -0,0 +1,303 @@
+import asyncio
+import binascii
+import email.message
+import email.parser
+import email.policy
+import io
+import logging
+import os
+import shutil
+import tempfile
+import time
+import typing
+
+from pyzmail import decode_text # type: ignore
+
+from .cpu_pool import PARSE_OFFLOAD_MIN_SIZE, CpuPool, CpuPoolError
+from .mail import Email, SpooledPart
+
+logger = logging.getLogger(__name__)
+
+# parts larger than this are spooled to a temporary file instead of memory
+_spool_threshold = os.getenv('MAIL_SPOOL_THRESHOLD')
+SPOOL_THRESHOLD = int(_spool_threshold) if _spool_threshold else 1024 * 1024
+# runaway header blocks are cut off, they are kept in memory
+MAX_HEADER_SIZE = 256 * 1024
+# bodies are decoded, and lines handed over by feed_line() parsed, in blocks of about this size
+BLOCK_SIZE = 64 * 1024
+
+class _Decoder(object):
+    # incremental content-transfer-encoding decoder, fed one line at a time (without its last line break).
+    # a "line" may also be a block of lines, decoded in one call
+    def __init__(self, encoding: str | None):
+        self.encoding = (encoding or '').strip().lower()
+        self.pending = b''
+        self.first = True
+
+    def line(self, line: bytes) -> bytes:
+        if self.encoding == 'base64':
+            self.pending += b''.join(line.split())
+            usable = len(self.pending) - len(self.pending) % 4
+            data, self.pending = self.pending[:usable], self.pending[usable:]
+            try:
+                return binascii.a2b_base64(data) if data else b''
+            except binascii.Error:
+                return b''
+        # the line break before a boundary belongs to the boundary, so it is written lazily
+        prefix = b'' if self.first else b'\r\n'
+        self.first = False
+        if self.encoding == 'quoted-printable':
+            if line.endswith(b'='):
+                # soft line break: no line break follows
+                self.first = True
+                return prefix + binascii.a2b_qp(line[:-1])
+            return prefix + binascii.a2b_qp(line)
+        return prefix + line
+
+    def end(self) -> bytes:
+        if self.encoding == 'base64' and self.pending.rstrip(b'='):
+            try:
+                return binascii.a2b_base64(self.pending + b'=' * (-len(self.pending) % 4))
+            except binascii.Error:
+                pass
+        return b''
+
+class _Part(object):
+    def __init__(self, headers: email.message.Message, spool_threshold: int):
+        self.headers = headers
+        self.type = headers.get_content_type()
+        self.boundary = headers.get_boundary() if headers.get_content_maintype() == 'multipart' else None
+        self.disposition = (headers.get_content_disposition() or '')
+        self.filename = headers.get_filename()
+        self.charset = headers.get_content_charset()
+        self.is_body = self.type in ('text/plain', 'text/html') and self.disposition != 'attachment' and not self.filename
+        self.decoder = _Decoder(headers.get('content-transfer-encoding'))
+        self.size = 0
+        self.file: typing.BinaryIO
+        if self.is_body:
+            self.file = io.BytesIO()
+        else:
+            self.file = tempfile.SpooledTemporaryFile(max_size=spool_threshold) # type: ignore[assignment]
+
+    def write(self, data: bytes):
+        if data:
+            self.size += len(data)
+            self.file.write(data)
+
+class StreamingMailParser(object):
+    # incremental MIME parser, feed() it raw message data as it comes from the socket.
+    # only headers and text bodies stay in memory, other parts are decoded straight into
+    # SpooledTemporaryFiles which move to disk above spool_threshold.
+    def __init__(self, spool_threshold=SPOOL_THRESHOLD):
+        self.spool_threshold = spool_threshold
+        self.buffer = b'' # an incomplete last line
+        self.lines: list[bytes] = [] # from feed_line(), not parsed yet
+        self.lines_size = 0
+        self.header_lines: list[bytes] = []
+        self.header_size = 0
+        self.raw_header: bytes | None = None # of the message itself
+        self.boundaries: list[bytes] = [] # enclosing multipart boundaries, innermost last
+        self.state = 'headers' # headers / body / skip (multipart preamble and epilogue)
+        self.part: _Part | None = None
+        self.leaves: list[_Part] = []
+        self.elapsed = 0.0 # spent parsing, not waiting for data
+
+    def feed(self, data: bytes):
+        started = time.perf_counter()
+        if self.buffer:
+            data = self.buffer + data
+        end = data.rfind(b'\n') + 1
+        self.buffer = data[end:]
+        self._lines(data, end)
+        self.elapsed += time.perf_counter() - started
+
+    def feed_line(self, line: bytes):
+        # for sources that already split lines (e.g. POP3), collected and parsed a block at a time
+        self.lines.append(line)
+        self.lines_size += len(line) + 2
+        if self.lines_size >= BLOCK_SIZE:
+            self._flush_lines()
+
+    def _flush_lines(self):
+        if self.lines:
+            lines, self.lines, self.lines_size = self.lines, [], 0
+            lines.append(b'')
+            self.feed(b'\r\n'.join(lines))
+
+    def _lines(self, data: bytes, end: int):
+        # data[:end] are whole lines. headers go line by line, a body is decoded a block at a time: the
+        # lines up to the next one starting with "--" (the only ones which can be a boundary), BLOCK_SIZE at most
+        pos = 0
+        while pos < end:
+            if self.state == 'headers' or data.startswith(b'--', pos):
+                eol = data.index(b'\n', pos)
+                self._line(data[pos:eol - 1] if data[eol - 1:eol] == b'\r' else data[pos:eol])
+                pos = eol + 1
+                continue
+            candidate = data.find(b'\n--', pos, min(pos + BLOCK_SIZE, end))
+            if candidate >= 0:
+                stop = candidate + 1
+            elif pos + BLOCK_SIZE < end:
+                stop = data.rfind(b'\n', pos, pos + BLOCK_SIZE) + 1 or data.index(b'\n', pos) + 1
+            else:
+                stop = end
+            if self.state == 'body':
+                eol = stop - 2 if data[stop - 2:stop - 1] == b'\r' else stop - 1
+                self.part.write(self.part.decoder.line(data[pos:eol])) # type: ignore[union-attr]
+            pos = stop
+
+    def _match_boundary(self, line: bytes) -> tuple[int, bool] | None:
+        if not line.startswith(b'--') or not self.boundaries:
+            return None
+        stripped = line.rstrip()
+        for depth in range(len(self.boundaries) - 1, -1, -1):
+            boundary = b'--' + self.boundaries[depth]
+            if stripped == boundary:
+                return depth, False
+            if stripped == boundary + b'--':
+                return depth, True
+        return None
+
+    def _line(self, line: bytes):
+        if self.state == 'headers':
+            if line.strip():
+                if self.header_size < MAX_HEADER_SIZE:
+                    self.header_lines.append(line)
+                    self.header_size += len(line) + 2
+                return
+            self._start_part()
+            return
+        match = self._match_boundary(line)
+        if match:
+            depth, closing = match
+            self._end_part()
+            del self.boundaries[depth + 1:]
+            if closing:
+                self.boundaries.pop()
+                self.state = 'skip'
+            else:
+                self.state = 'headers'
+            return
+        if self.state == 'body':
+            self.part.write(self.part.decoder.line(line)) # type: ignore[union-attr]
+
+    def _start_part(self):
+        raw = b'\r\n'.join(self.header_lines) + b'\r\n\r\n'
+        self.header_lines = []
+        self.header_size = 0
+        if self.raw_header is None:
+            self.raw_header = raw
+        headers = email.parser.BytesHeaderParser(policy=email.policy.compat32).parsebytes(raw)
+        part = _Part(headers, self.spool_threshold)
+        if part.boundary:
+            self.boundaries.append(part.boundary.encode('utf8', 'replace'))
+            self.state = 'skip'
+            return
+        self.part = part
+        self.state = 'body'
+
+    def _end_part(self):
+        if self.part is not None:
+            self.part.write(self.part.decoder.end())
+            self.leaves.append(self.part)
+            self.part = None
+
+    def _finish(self) -> tuple[str | None, str | None, list[_Part]]:
+        # -> (text body, html body, the other parts)
+        self._flush_lines()
+        if self.buffer:
+            self._line(self.buffer.rstrip(b'\r'))
+            self.buffer = b''
+        if self.state == 'headers' and self.raw_header is None:
+            self._start_part() # headers only, e.g. a TOP with 0 lines
+        self._end_part()
+        text = html = None
+        others = []
+        for part in self.leaves:
+            if part.is_body and (text is None if part.type == 'text/plain' else html is None):
+                content, _ = decode_text(part.file.getvalue(), part.charset, None) # type: ignore[attr-defined]
+                content = content.replace('\r\n', '\n')
+                if part.type == 'text/plain':
+                    text = content
+                else:
+                    html = content
+                continue
+            part.file.seek(0)
+            others.append(part)
+        return text, html, others
+
+    def close(self) -> Email:
+        started = time.perf_counter()
+        text, html, others = self._finish()
+        additional_parts = [SpooledPart(part.filename, part.type, part.size, part.charset, part.file) for part in others]
+        mail = Email.from_structure(self.raw_header or b'', text, html, [], additional_parts=additional_parts)
+        mail.parse_time = self.elapsed + time.perf_counter() - started
+        return mail
+
+    async def parse(self) -> Email:
+        # same as close(), for callers which may also hold an OffloadedMailParser
+        return self.close()
+
+def parse_file(path: str, spool_threshold: int) -> tuple:
+    # cpu pool side of OffloadedMailParser. parts too large to pipe back are left in temporary files,
+    # whoever gets their path removes them
+    parser = StreamingMailParser(spool_threshold)
+    with open(path, 'rb') as f:
+        while data := f.read(BLOCK_SIZE):
+            parser.feed(data)
+    text, html, others = parser._finish()
+    parts = []
+    for part in others:
+        if part.size <= spool_threshold:
+            parts.append((part.filename, part.type, part.size, part.charset, part.file.read(), None))
+            continue
+        with tempfile.NamedTemporaryFile(prefix='mailpart-', delete=False) as out:
+            shutil.copyfileobj(part.file, out)
+        parts.append((part.filename, part.type, part.size, part.charset, None, out.name))
+        part.file.close()
+    return parser.raw_header or b'', text, html, parts
+
+class OffloadedMailParser(object):
+    # stands in for StreamingMailParser on large mails: while the mail is received it is only written to
+    # a temporary file, parse() runs StreamingMailParser on that in the cpu pool
+    def __init__(self, pool: CpuPool, spool_threshold=SPOOL_THRESHOLD):
+        self.pool = pool
+        self.spool_threshold = spool_threshold
+        self.file = tempfile.NamedTemporaryFile(prefix='mail-') # removed when closed or collected
+
+    def feed(self, data: bytes):
+        self.file.write(data)
+
+    def feed_line(self, line: bytes):
+        self.file.write(line + b'\r\n')
+
+    async def parse(self) -> Email:
+        self.file.flush()
+        try:
+            (raw_header, text, html, parts), elapsed = await self.pool.run(parse_file, self.file.name, self.spool_threshold)
+        except (asyncio.TimeoutError, CpuPoolError):
+            logger.warning('cannot parse %s in the cpu pool, parsing it in place instead', self.file.name, exc_info=True)
+            parser = StreamingMailParser(self.spool_threshold)
+            self.file.seek(0)
+            while data := self.file.read(BLOCK_SIZE):
+                parser.feed(data)
+            return parser.close()
+        finally:
+            self.file.close()
+        additional_parts = []
+        for filename, type, size, charset, payload, path in parts:
+            if path is None:
+                file: typing.BinaryIO = io.BytesIO(payload)
+            else:
+                file = open(path, 'rb')
+                os.unlink(path) # gone with the handle
+            additional_parts.append(SpooledPart(filename, type, size, charset, file))
+        mail = Email.from_structure(raw_header, text, html, [], additional_parts=additional_parts)
+        mail.parse_time += elapsed
+        return mail
+
+def mail_parser(size: int | None, pool: CpuPool | None = None) -> StreamingMailParser | OffloadedMailParser:
+    # size: of the whole mail if known. large ones are parsed in the cpu pool when there is one
+    if pool is not None and size is not None and size >= PARSE_OFFLOAD_MIN_SIZE:
+        return OffloadedMailParser(pool)
+    return StreamingMailParser()
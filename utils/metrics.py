@@ -0,0 +1,181 @@
+import bisect
+import http.server
+import logging
+import threading
+import typing
+
+logger = logging.getLogger(__name__)
+
+# prometheus text exposition (format 0.0.4) without the client library. metrics labeled by account
+# get the account's protocol as second label, known once set_protocol() was called for it
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra='') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class _Metric(object):
+    type = ''
+
+    def __init__(self, registry: 'Registry', name: str, help: str, labels: tuple[str, ...]):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.label_names = labels
+        self.lock = threading.Lock()
+
+    def _key(self, labels: tuple) -> tuple:
+        if self.label_names[:2] == ('account', 'protocol'):
+            # callers pass the account only
+            return (labels[0], self.registry.protocols.get(labels[0], 'unknown')) + tuple(labels[1:])
+        return tuple(labels)
+
+    def header(self) -> list[str]:
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = list(self.values.items())
+        return self.header() + [f'{self.name}{_format_labels(self.label_names, key)} {_format_value(v)}' for key, v in values]
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS):
+        super().__init__(*args)
+        self.buckets = tuple(buckets)
+        self.values: dict[tuple, list] = {} # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        lines = self.header()
+        for key, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}')
+            inf = 'le="+Inf"'
+            lines.append(f'{self.name}_bucket{_format_labels(self.label_names, key, inf)} {counts[-1]}')
+            lines.append(f'{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(counts[-2])}')
+            lines.append(f'{self.name}_count{_format_labels(self.label_names, key)} {counts[-1]}')
+        return lines
+
+class Gauge(_Metric):
+    # read when scraped: fn() returns {label values tuple: value}
+    type = 'gauge'
+
+    def __init__(self, *args, fn: typing.Callable[[], dict[tuple, float]]):
+        super().__init__(*args)
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        try:
+            values = self.fn()
+        except Exception:
+            logger.warning('cannot collect %s', self.name, exc_info=True)
+            return []
+        return self.header() + [f'{self.name}{_format_labels(self.label_names, key)} {_format_value(v)}' for key, v in values.items()]
+
+class Registry(object):
+    def __init__(self):
+        self.metrics: list[_Metric] = []
+        self.protocols: dict[str, str] = {} # account -> imap / pop3
+
+    def set_protocol(self, account: str, protocol: str):
+        self.protocols[account] = protocol
+
+    def counter(self, name: str, help: str, labels=('account', 'protocol')) -> Counter:
+        metric = Counter(self, name, help, tuple(labels))
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help: str, labels=('account', 'protocol'), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(self, name, help, tuple(labels), buckets=buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str, fn: typing.Callable[[], dict[tuple, float]], labels=()) -> Gauge:
+        metric = Gauge(self, name, help, tuple(labels), fn=fn)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+    def serve(self, port: int, addr='127.0.0.1') -> http.server.ThreadingHTTPServer:
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass # scraped every few seconds
+
+        server = http.server.ThreadingHTTPServer((addr, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logger.info('serving metrics on http://%s:%d/metrics', addr, port)
+        return server
+
+registry = Registry()
+
+poll_duration = registry.histogram('mailbot_poll_duration_seconds', 'Time one poll of an account took')
+polls = registry.counter('mailbot_polls_total', 'Polls by result (ok, error, skipped)', ('account', 'protocol', 'result'))
+poll_lag = registry.histogram('mailbot_poll_lag_seconds', 'How late a poll started: timer overshoot plus waiting for a concurrency slot')
+fetched_bytes = registry.counter('mailbot_fetched_bytes_total', 'Bytes received from the mail server')
+delivered_mails = registry.counter('mailbot_delivered_mails_total', 'Mails sent to telegram')
+parse_duration = registry.histogram('mailbot_parse_duration_seconds', 'Time spent parsing one mail (MIME, decoding, html conversion), not waiting for it')
+render_duration = registry.histogram('mailbot_render_duration_seconds', 'Time formatting and splitting one mail into messages')
+delivery_duration = registry.histogram('mailbot_telegram_delivery_seconds', 'From queueing a mail to telegram accepting its last message')
+client_cache = registry.counter('mailbot_client_cache_total', 'Connection pool events (hits, connects, health_check_failures, replaced, evicted, idle_closed, dropped)',
+                                ('account', 'protocol', 'outcome'))
+token_refreshes = registry.counter('mailbot_token_refreshes_total', 'OAuth2 access token refreshes by result', ('account', 'protocol', 'result'))
+telegram_send_duration = registry.histogram('mailbot_telegram_send_duration_seconds', 'Duration of single bot api calls by priority', ('priority',))
+telegram_send_results = registry.counter('mailbot_telegram_sends_total', 'Bot api calls by priority and outcome (sent, retried, retry_after, failed)',
+                                         ('priority', 'outcome'))
+smtp_pool = registry.counter('mailbot_smtp_total', 'SMTP sends and pool events (sent, failed, hits, connects, noop_failures, reconnects, idle_closed)',
+                              ('account', 'outcome'))
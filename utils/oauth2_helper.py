@@ -1,40 +1,153 @@
+import base64
+import hashlib
 import logging
+import os
+import threading
 import time
 import re
 import requests
+import requests.adapters
 from base64 import b64encode
+from cryptography.fernet import Fernet
+from . import metrics
 logger = logging.getLogger(__name__)
 
+# access tokens expiring within this many seconds are refreshed in the background
+_token_refresh_ahead = os.getenv('TOKEN_REFRESH_AHEAD')
+TOKEN_REFRESH_AHEAD = int(_token_refresh_ahead) if _token_refresh_ahead else 900
+_token_request_timeout = os.getenv('TOKEN_REQUEST_TIMEOUT')
+TOKEN_REQUEST_TIMEOUT = int(_token_request_timeout) if _token_request_timeout else 30
+
+# one keep-alive connection pool for all token endpoint requests
+session = requests.Session()
+session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+def _token_key(refresh_token: str) -> str:
+    # refresh tokens are secrets, the state store only sees their hash
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
 class Token():
     def __init__(self, refresh_token, refresher):
         self.refresh_token = refresh_token
         self.refresher = refresher
-        
+        self.key = _token_key(refresh_token)
+        self.lock = threading.Lock() # one refresh at a time, the others wait for its result
+        self.account = None # for metrics, known after the first getSasl
+
         self.access_token = None
         self.access_token_expire = 0
-        if not self.access_token_expire:
-            self.access_token_expire = 0
     
+    def valid(self, ttl=600) -> bool:
+        return self.access_token is not None and time.time() + ttl < self.access_token_expire
+
+    def set(self, access_token, access_token_expire):
+        self.access_token, self.access_token_expire = access_token, access_token_expire
+        TokenStore.save(self)
+
+    def refresh(self, ttl=600):
+        # single-flight: whoever waited on the lock finds the token refreshed and returns
+        with self.lock:
+            if self.valid(ttl):
+                return
+            try:
+                new_token, new_token_expire = self.refresher(self.refresh_token)
+            except Exception:
+                if self.account:
+                    metrics.token_refreshes.inc(self.account, 'error')
+                raise
+            if self.account:
+                metrics.token_refreshes.inc(self.account, 'ok')
+            logger.info('refreshed token of %s, next expiration %s', self.account or self.key[:12], new_token_expire)
+            self.set(new_token, new_token_expire)
+
     def getToken(self):
-        if time.time() - 600 > self.access_token_expire: # TTL less than 10min
-            new_token, new_token_expire = self.refresher(self.refresh_token)
-            logger.info('refreshed token %s, next expiration %s' % (self.refresh_token, new_token_expire))
-            self.access_token, self.access_token_expire = new_token, new_token_expire
+        if not self.valid(): # TTL less than 10min
+            self.refresh()
         return self.access_token
     
     def getSasl(self, username):
-        saslBody = f"user={username}".encode() + b"\x01" + f"auth=Bearer {self.getToken()}".encode() +  b"\x01\x01"
+        self.account = username
+        token = self.getToken()
+        saslBody = f"user={username}".encode() + b"\x01" + f"auth=Bearer {token}".encode() +  b"\x01\x01"
         return b64encode(saslBody).decode()
 
 
 class TokenStore():
     store: dict[str, Token] = {}
+    lock = threading.Lock()
+    # access tokens are persisted (encrypted) here once configure() was called
+    backend = None
+    cipher = None
+    refresher_thread: threading.Thread | None = None
     
+    @classmethod
+    def configure(self, backend, secret: str):
+        # backend has get_token(key) and set_token(key, blob, expire), secret derives the encryption key
+        self.cipher = Fernet(base64.urlsafe_b64encode(hashlib.sha256(secret.encode()).digest()))
+        self.backend = backend
+
+    @classmethod
+    def _load(self, token: Token):
+        if self.backend is None:
+            return
+        try:
+            row = self.backend.get_token(token.key)
+            if row:
+                blob, expire = row
+                token.access_token, token.access_token_expire = self.cipher.decrypt(blob).decode(), expire
+        except Exception:
+            # other key or corrupted, it is refreshed as if it was never saved
+            logger.warning('cannot load persisted access token %s', token.key[:12], exc_info=True)
+
+    @classmethod
+    def save(self, token: Token):
+        if self.backend is None or token.access_token is None:
+            return
+        try:
+            self.backend.set_token(token.key, self.cipher.encrypt(token.access_token.encode()), token.access_token_expire)
+        except Exception:
+            logger.warning('cannot persist access token %s', token.key[:12], exc_info=True)
+
     @classmethod
     def get(self, refresh_token: str, refresher) -> Token:
-        if refresh_token not in self.store:
-            self.store[refresh_token] = Token(refresh_token, refresher)
-        return self.store[refresh_token]    
+        with self.lock:
+            if refresh_token not in self.store:
+                token = Token(refresh_token, refresher)
+                self._load(token)
+                self.store[refresh_token] = token
+            return self.store[refresh_token]
+
+    @classmethod
+    def retain(self, refresh_tokens: set[str]):
+        # the others belong to removed accounts or were replaced, the refresher stops renewing them
+        with self.lock:
+            for refresh_token in set(self.store) - refresh_tokens:
+                del self.store[refresh_token]
+
+    @classmethod
+    def refresh_expiring(self, ahead=TOKEN_REFRESH_AHEAD):
+        # one after another, a burst of parallel refreshes is what gets throttled
+        with self.lock:
+            tokens = list(self.store.values())
+        for token in tokens:
+            if token.valid(ahead):
+                continue
+            try:
+                token.refresh(ahead)
+            except Exception:
+                logger.warning('cannot refresh token of %s ahead of time', token.account or token.key[:12], exc_info=True)
+
+    @classmethod
+    def start_refresher(self, interval=60, ahead=TOKEN_REFRESH_AHEAD):
+        # tokens in use are refreshed before they expire, polls do not wait for the token endpoint
+        if self.refresher_thread is not None:
+            return
+        def run():
+            while True:
+                time.sleep(interval)
+                self.refresh_expiring(ahead)
+        self.refresher_thread = threading.Thread(target=run, name='token-refresher', daemon=True)
+        self.refresher_thread.start()
 
 class OAuth2_Base():
     name: str
@@ -54,7 +167,7 @@ class OAuth2_Base():
         if hasattr(self, 'client_secret'):
             data['client_secret'] = self.client_secret
 
-        response = requests.post(self.token_uri, data=data)
+        response = session.post(self.token_uri, data=data, timeout=TOKEN_REQUEST_TIMEOUT)
         if response.status_code != 200:
             raise RuntimeError("server returned invalid status %d, body: %s" % (response.status_code, response.text))
 
@@ -85,7 +198,7 @@ class OAuth2_Base():
         if hasattr(self, 'client_secret'):
             data['client_secret'] = self.client_secret
 
-        response = requests.post(self.token_uri, data=data)
+        response = session.post(self.token_uri, data=data, timeout=TOKEN_REQUEST_TIMEOUT)
         if response.status_code != 200:
             raise RuntimeError("server returned invalid status %d, body: %s" % (response.status_code, response.text))
 
@@ -119,14 +232,26 @@ class OAuth2Factory():
         return self.PROVIDERS_DICT[name]
 
     @classmethod
-    def token_from_string(self, s) -> Token | None:
+    def _parse_token_string(self, s) -> tuple[str, str] | None:
         # s should have format token:{provider}:{refresh_token}
         if not s.startswith('token:'):
             return None
         m = re.match(r'^token:(?P<provider_name>.*?):(?P<refresh_token>.*)$', s)
         if not m:
             raise ValueError('invalid token string: %s, should have format token:{provider}:{refresh_token}' % s)
-        provider_name, refresh_token = m.groups()
+        return m.group('provider_name'), m.group('refresh_token')
+
+    @classmethod
+    def refresh_token_from_string(self, s) -> str | None:
+        parsed = self._parse_token_string(s)
+        return parsed[1] if parsed else None
+
+    @classmethod
+    def token_from_string(self, s) -> Token | None:
+        parsed = self._parse_token_string(s)
+        if not parsed:
+            return None
+        provider_name, refresh_token = parsed
         
         provider = self.get_provider(provider_name)
         return TokenStore.get(refresh_token, provider.access_token_from_refresh_token)
@@ -144,8 +269,7 @@ class OAuth2Factory():
         provider = self.get_provider(provider_name)
         refresh_token, token, token_expire = provider.refresh_token_from_code(code)
         t = TokenStore.get(refresh_token, provider.access_token_from_refresh_token)
-        t.access_token = token
-        t.access_token_expire = token_expire
+        t.set(token, token_expire)
         return f'token:{provider_name}:{refresh_token}'
 
 class OAuth2_MS(OAuth2_Base):
@@ -0,0 +1,35 @@
+import random
+import time
+
+class AdaptiveInterval(object):
+    # per-account poll interval following the observed arrival rate of the mailbox:
+    # busy inboxes are polled more often, dormant ones back off up to max_interval
+    def __init__(self, base: float, min_interval: float, max_interval: float,
+                 jitter=0.2, smoothing=0.3, mails_per_poll=1.0):
+        self.min_interval = min(min_interval, base)
+        self.max_interval = max(max_interval, base)
+        self.jitter = jitter
+        self.smoothing = smoothing
+        self.mails_per_poll = mails_per_poll
+        self.rate = mails_per_poll / base # EWMA of mails per second, starts at the configured interval
+        self.interval = base
+        self.last_poll: float | None = None
+
+    def first_delay(self) -> float:
+        # spread the first polls of all accounts over one interval instead of bursting at startup
+        return random.uniform(0, self.interval)
+
+    def observe(self, new_mails: int | None, now: float | None = None):
+        # called at the start of the next poll with the result of the previous one, None if it was skipped
+        now = time.monotonic() if now is None else now
+        if new_mails is not None and self.last_poll is not None:
+            elapsed = max(now - self.last_poll, 1e-3)
+            self.rate = (1 - self.smoothing) * self.rate + self.smoothing * (new_mails / elapsed)
+            if self.rate > 0:
+                self.interval = min(max(self.mails_per_poll / self.rate, self.min_interval), self.max_interval)
+            else:
+                self.interval = self.max_interval
+        self.last_poll = now
+
+    def next_delay(self) -> float:
+        return self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
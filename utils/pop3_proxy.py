@@ -0,0 +1,26 @@
+import os
+from urllib.parse import urlparse
+import socks # type: ignore
+
+def create_proxy_connection(host, port, timeout):
+    import socket
+    # use pysocks to connect through socks5://1.2.3.4:3333
+    POP3_PROXY = os.getenv('POP3_PROXY')
+    if POP3_PROXY:
+        pop3Proxy = urlparse(POP3_PROXY)
+        proxyType = {
+            "socks5": socks.PROXY_TYPE_SOCKS5,
+            "socks4": socks.PROXY_TYPE_SOCKS4,
+            "http": socks.PROXY_TYPE_HTTP,
+        }[pop3Proxy.scheme]
+        s = socks.create_connection(
+            (host, port), timeout,
+            proxy_type=proxyType,
+            proxy_addr=pop3Proxy.hostname,
+            proxy_port=pop3Proxy.port,
+            proxy_username=pop3Proxy.username,
+            proxy_password=pop3Proxy.password,
+        )
+    else:
+        s = socket.create_connection((host, port), timeout)
+    return s
@@ -0,0 +1,101 @@
+import asyncio
+import cProfile
+import collections
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+# on-demand diagnostics for a running bot, each returns a plain text report
+
+# python frames threads sit in while blocked, they would otherwise top every sample
+_IDLE_LEAVES = {
+    ('threading.py', 'wait'), ('threading.py', '_wait_for_tstate_lock'), ('selectors.py', 'select'),
+    ('thread.py', '_worker'), ('queue.py', 'get'), ('socketserver.py', 'serve_forever'),
+}
+
+def _where(code) -> str:
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+def profile_loop(loop: asyncio.AbstractEventLoop, seconds: float, limit=30) -> str:
+    # deterministic cProfile of everything running on an event loop (polls, parsing) for a while.
+    # cProfile hooks the thread it is enabled in, so it is switched on and off from inside the loop
+    profiler = cProfile.Profile()
+    async def call(fn):
+        fn()
+    asyncio.run_coroutine_threadsafe(call(profiler.enable), loop).result()
+    try:
+        time.sleep(seconds)
+    finally:
+        asyncio.run_coroutine_threadsafe(call(profiler.disable), loop).result()
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    out.write(f'cProfile of the poll engine loop for {seconds:.0f}s\n\n== by own time ==\n')
+    stats.sort_stats('tottime').print_stats(limit)
+    out.write('\n== by cumulative time ==\n')
+    stats.sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
+
+def sample_threads(seconds: float, interval=0.005, limit=30) -> str:
+    # statistical profile of all threads (engine loop, executors, telegram senders) from their stacks
+    me = threading.get_ident()
+    own: collections.Counter = collections.Counter()
+    total: collections.Counter = collections.Counter()
+    byThread: collections.Counter = collections.Counter()
+    samples = idle = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            samples += 1
+            leaf = frame.f_code
+            if (os.path.basename(leaf.co_filename), leaf.co_name) in _IDLE_LEAVES:
+                idle += 1
+                continue
+            own[_where(leaf)] += 1
+            byThread[names.get(ident, str(ident)).rstrip('_0123456789')] += 1
+            seen = set()
+            while frame is not None:
+                where = _where(frame.f_code)
+                if where not in seen:
+                    seen.add(where)
+                    total[where] += 1
+                frame = frame.f_back
+        time.sleep(interval)
+    busy = samples - idle
+    lines = [f'{samples} thread samples over {seconds:.0f}s, {busy} busy ({busy / max(samples, 1):.0%}), idle waits left out', '']
+    for title, counter in (('busy samples by thread', byThread), ('by own samples', own), ('by cumulative samples', total)):
+        lines.append(f'== {title} ==')
+        lines += [f'{count:7d} {count / max(busy, 1):6.1%}  {where}' for where, count in counter.most_common(limit)]
+        lines.append('')
+    return '\n'.join(lines)
+
+def trace_allocations(seconds: float, limit=30) -> str:
+    # tracemalloc snapshots at both ends of a window: what grew is where memory leaks to
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen importlib._bootstrap>')]
+        before = tracemalloc.take_snapshot().filter_traces(filters)
+        time.sleep(seconds)
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        if started:
+            tracemalloc.stop()
+    lines = [f'traced python memory: {current / 1024 / 1024:.1f} MiB now, {peak / 1024 / 1024:.1f} MiB peak '
+             f'(only allocations made while tracing{" for " + format(seconds, ".0f") + "s" if started else ""})', '']
+    lines.append('== growth by allocation site ==')
+    lines += [str(stat) for stat in after.compare_to(before, 'lineno')[:limit]]
+    lines += ['', '== largest allocation sites ==']
+    lines += [str(stat) for stat in after.statistics('lineno')[:limit]]
+    threads = collections.Counter(thread.name.rstrip('_0123456789') for thread in threading.enumerate())
+    lines += ['', f'== threads ({threading.active_count()}) ==']
+    lines += [f'{count:5d}  {name}' for name, count in threads.most_common()]
+    return '\n'.join(lines)
@@ -0,0 +1,121 @@
+import html as htmllib
+import re
+
+from telegram.constants import MAX_MESSAGE_LENGTH
+
+# html parse mode: tags, character references and plain text runs
+_HTML_TOKEN_RE = re.compile(r'<[^<>]*>|&#?\w+;|[^<&]+|[<&]')
+_TAG_RE = re.compile(r'<(/?)(\w+)')
+
+def escape(s) -> str:
+    return htmllib.escape(str(s), quote=False)
+
+def utf16_len(s: str) -> int:
+    # telegram measures message length in utf-16 code units, emoji and other astral chars count twice
+    return len(s.encode('utf-16-le')) // 2
+
+def _take(s: str, room: int) -> tuple[str, str]:
+    # longest prefix of s within room utf-16 units, cut at whitespace in its second half if possible
+    piece = s[:room]
+    excess = utf16_len(piece) - room
+    while excess > 0:
+        piece = piece[:len(piece) - max(excess // 2, 1)]
+        excess = utf16_len(piece) - room
+    if len(piece) < len(s):
+        space = piece.rfind(' ', len(piece) // 2)
+        if space > 0:
+            piece = piece[:space + 1]
+    return piece, s[len(piece):]
+
+def _split_line(line: str, limit: int, html: bool) -> list[str]:
+    # a single line longer than a message: cut between tokens, html tags open at the cut are closed
+    # at the end of the piece and reopened at the start of the next one
+    pieces: list[str] = []
+    current: list[str] = []
+    size = 0
+    stack: list[tuple[str, str]] = [] # (tag name, opening tag)
+    closersSize = 0
+
+    def cut():
+        nonlocal current, size
+        pieces.append(''.join(current) + ''.join(f'</{name}>' for name, _ in reversed(stack)))
+        current = [tag for _, tag in stack]
+        size = sum(utf16_len(tag) for tag in current)
+
+    for token in (_HTML_TOKEN_RE.findall(line) if html else [line]):
+        if html and token[0] in '<&' and len(token) > 1:
+            n = utf16_len(token)
+            m = _TAG_RE.match(token)
+            opening = bool(m) and not m.group(1) and not token.endswith('/>') # type: ignore[union-attr]
+            closerSize = len(m.group(2)) + 3 if opening else 0 # type: ignore[union-attr]
+            if current and size + n + closersSize + closerSize > limit:
+                cut()
+            current.append(token)
+            size += n
+            if opening:
+                stack.append((m.group(2), token)) # type: ignore[union-attr]
+                closersSize += closerSize
+            elif m and m.group(1) and stack and stack[-1][0] == m.group(2):
+                closersSize -= len(stack.pop()[0]) + 3
+            continue
+        while token:
+            room = limit - size - closersSize
+            if room <= 0 and current:
+                cut()
+                room = limit - size - closersSize
+            piece, token = _take(token, max(room, 1))
+            current.append(piece)
+            size += utf16_len(piece)
+            if token:
+                cut()
+    if current:
+        pieces.append(''.join(current) + ''.join(f'</{name}>' for name, _ in reversed(stack)))
+    return pieces
+
+def split_message(text: str, limit=MAX_MESSAGE_LENGTH, html=False, max_chunks: int | None = None) -> list[str]:
+    # splits text into telegram sized messages in a single pass over its lines. whole lines are packed,
+    # a cut prefers the last paragraph break (blank line) in the second half of a message.
+    # tags never span lines in what render produces, so only over-long lines need entity care
+    chunks: list[str] = []
+    parts: list[str] = []
+    sizes: list[int] = []
+    size = 0
+    paragraph = 0 # parts up to here end with a blank line
+    paragraphSize = 0
+
+    def flush(upto):
+        nonlocal parts, sizes, size, paragraph, paragraphSize
+        chunk = ''.join(parts[:upto]).strip('\n')
+        if chunk.strip():
+            chunks.append(chunk)
+        # the rest is carried into the next message, each line at most once
+        parts, sizes = parts[upto:], sizes[upto:]
+        size = sum(sizes)
+        paragraph = paragraphSize = 0
+
+    for line in text.splitlines(keepends=True):
+        n = utf16_len(line)
+        if n > limit:
+            flush(len(parts))
+            pieces = _split_line(line, limit, html)
+            chunks.extend(pieces[:-1])
+            line, n = pieces[-1], utf16_len(pieces[-1])
+        elif size + n > limit:
+            flush(paragraph if paragraphSize >= limit // 2 else len(parts))
+            if size + n > limit:
+                flush(len(parts)) # the carried lines and this one do not fit together
+        parts.append(line)
+        sizes.append(n)
+        size += n
+        if not line.strip():
+            paragraph, paragraphSize = len(parts), size
+    flush(len(parts))
+
+    if max_chunks and len(chunks) > max_chunks:
+        notice = f'\n\n(truncated, {len(chunks) - max_chunks} more messages)'
+        chunks = chunks[:max_chunks]
+        if utf16_len(chunks[-1]) + utf16_len(notice) <= limit:
+            chunks[-1] += notice
+        else:
+            chunks[-1] = notice.strip()
+    return chunks
@@ -0,0 +1,117 @@
+import bisect
+import hashlib
+import logging
+import os
+import socket
+import threading
+import time
+import typing
+
+logger = logging.getLogger(__name__)
+
+# seconds between heartbeats of a worker, and without one before it counts as dead and its accounts move
+_worker_heartbeat_interval = os.getenv('WORKER_HEARTBEAT_INTERVAL')
+WORKER_HEARTBEAT_INTERVAL = float(_worker_heartbeat_interval) if _worker_heartbeat_interval else 10.0
+_worker_timeout = os.getenv('WORKER_TIMEOUT')
+WORKER_TIMEOUT = float(_worker_timeout) if _worker_timeout else 30.0
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big')
+
+class HashRing(object):
+    # consistent hashing: every worker has vnodes points on the ring, an account belongs to the first point
+    # at or after its hash. a worker joining or leaving only moves the accounts next to its own points
+    def __init__(self, workers: typing.Iterable[str], vnodes=64):
+        self.points = sorted((_hash(f'{worker}#{i}'), worker) for worker in workers for i in range(vnodes))
+        self.hashes = [h for h, _ in self.points]
+
+    def owner(self, key: str) -> str | None:
+        if not self.points:
+            return None
+        return self.points[bisect.bisect_left(self.hashes, _hash(key)) % len(self.points)][1]
+
+class ShardCoordinator(object):
+    # splits the accounts between poller processes sharing one store. every heartbeat a worker renews its
+    # row, builds the ring of live workers and holds leases on the accounts the ring gives it. a lease
+    # still held by another worker is waited for (released on rebalance, or expired when that worker
+    # died), so an account is never polled by two workers at once. a worker that cannot renew its leases
+    # stops polling each account when its lease runs out, others may take it over from then on
+    #   list_accounts() -> all account addresses
+    #   on_release(addrs): stop polling them and commit their state, called before their leases go
+    #   on_change(): owned changed, start or stop polling
+    def __init__(self, store, list_accounts: typing.Callable[[], list[str]], on_release: typing.Callable[[set[str]], None],
+                 on_change: typing.Callable[[], None], worker_id: str | None = None,
+                 heartbeat_interval=WORKER_HEARTBEAT_INTERVAL, timeout=WORKER_TIMEOUT):
+        self.store = store
+        self.list_accounts = list_accounts
+        self.on_release = on_release
+        self.on_change = on_change
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self.heartbeat_interval = heartbeat_interval
+        self.timeout = timeout
+        self.owned: set[str] = set()
+        self.expires: dict[str, float] = {} # lease expiry of every owned account, as last renewed
+        self.live_workers: list[str] = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='shard-heartbeat', daemon=True)
+
+    def beat(self):
+        now = time.time()
+        self.live_workers = self.store.heartbeat(self.worker_id, now, now - self.timeout)
+        ring = HashRing(self.live_workers)
+        accounts = self.list_accounts()
+        mine = {addr for addr in accounts if ring.owner(addr) == self.worker_id}
+        lost = self.owned - mine
+        if lost:
+            logger.info('worker %s hands over %d accounts', self.worker_id, len(lost))
+            self.owned -= lost
+            self.on_release(lost)
+        owned = self.store.sync_leases(self.worker_id, mine, now, now + self.timeout)
+        self.expires = {addr: now + self.timeout for addr in owned}
+        if owned != self.owned or lost:
+            logger.info('worker %s polls %d of %d accounts (%d workers, %d leases pending)',
+                        self.worker_id, len(owned), len(accounts), len(self.live_workers), len(mine - owned))
+            self.owned = owned
+            self.on_change()
+
+    def expire(self):
+        # the leases not renewed in time are gone, another worker may be polling those accounts already.
+        # the next beat that gets through takes them again
+        now = time.time()
+        expired = {addr for addr in self.owned if self.expires.get(addr, 0) <= now}
+        if not expired:
+            return
+        logger.warning('worker %s lost the leases of %d accounts, stops polling them', self.worker_id, len(expired))
+        self.owned -= expired
+        for callback in (lambda: self.on_release(expired), self.on_change):
+            try:
+                callback()
+            except Exception:
+                # the store may be what fails, polling them is stopped all the same
+                logger.warning('worker %s cannot release %d accounts', self.worker_id, len(expired), exc_info=True)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            wait = self.heartbeat_interval
+            try:
+                self.beat()
+            except Exception:
+                # missed beats only matter after timeout, leases run out then and others take over
+                logger.warning('worker %s cannot heartbeat', self.worker_id, exc_info=True)
+                self.expire()
+                if self.owned:
+                    # wake up right when the next lease runs out
+                    wait = min(wait, max(min(self.expires[addr] for addr in self.owned) - time.time(), 0))
+            self.stopped.wait(wait)
+
+    def start(self):
+        self.beat() # owned is known before the first poll
+        self.thread.start()
+
+    def stop(self):
+        # graceful: the others take over right away instead of after timeout
+        self.stopped.set()
+        self.thread.join()
+        owned, self.owned, self.expires = self.owned, set(), {}
+        self.on_release(owned)
+        self.store.remove_worker(self.worker_id)
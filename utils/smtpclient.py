@@ -1,32 +1,54 @@
+import dataclasses
 import logging
+import os
 import smtplib
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from urllib.parse import urlparse
 
+from . import metrics
 from .oauth2_helper import OAuth2Factory
 
 logger = logging.getLogger(__name__)
 
-def send_email(smtp_server_uri, sender_email, password, receiver_email, subject, body):
+# seconds an unused connection is kept open, NOOPed every SMTP_KEEPALIVE meanwhile
+_smtp_idle_timeout = os.getenv('SMTP_IDLE_TIMEOUT')
+SMTP_IDLE_TIMEOUT = int(_smtp_idle_timeout) if _smtp_idle_timeout else 300
+_smtp_keepalive = os.getenv('SMTP_KEEPALIVE')
+SMTP_KEEPALIVE = int(_smtp_keepalive) if _smtp_keepalive else 60
+# mails sent at the same time (different accounts, one account sends one after another)
+_smtp_workers = os.getenv('SMTP_WORKERS')
+SMTP_WORKERS = int(_smtp_workers) if _smtp_workers else 4
 
+def build_message(sender_email, receiver_email, subject, body, in_reply_to=None, references=None) -> MIMEMultipart:
     # 创建一个多部分的邮件容器
     msg = MIMEMultipart()
     msg['From'] = sender_email
     msg['To'] = receiver_email
     msg['Subject'] = subject
+    # threads the reply under the original mail (RFC 5322 3.6.4)
+    if in_reply_to:
+        msg['In-Reply-To'] = in_reply_to
+    if references:
+        msg['References'] = references
 
     # 添加邮件正文
     msg.attach(MIMEText(body, 'plain'))
-    
+    return msg
+
+def connect(smtp_server_uri, sender_email, password, timeout=60) -> smtplib.SMTP:
     # 解析URI
     smtp_server_uri = urlparse(smtp_server_uri)
     if smtp_server_uri.scheme == 'smtp':
-        server = smtplib.SMTP(smtp_server_uri.hostname, smtp_server_uri.port or smtplib.SMTP_PORT)
+        server = smtplib.SMTP(smtp_server_uri.hostname, smtp_server_uri.port or smtplib.SMTP_PORT, timeout=timeout)
     elif smtp_server_uri.scheme == 'smtps':
-        server = smtplib.SMTP_SSL(smtp_server_uri.hostname, smtp_server_uri.port or smtplib.SMTP_SSL_PORT)
+        server = smtplib.SMTP_SSL(smtp_server_uri.hostname, smtp_server_uri.port or smtplib.SMTP_SSL_PORT, timeout=timeout)
     elif smtp_server_uri.scheme == 'smtp+starttls':
-        server = smtplib.SMTP(smtp_server_uri.hostname, smtp_server_uri.port or 587)
+        server = smtplib.SMTP(smtp_server_uri.hostname, smtp_server_uri.port or 587, timeout=timeout)
         server.starttls()
     else:
         raise NotImplementedError(f"Unsupported protocol: {smtp_server_uri.scheme}")
@@ -40,12 +62,177 @@ def send_email(smtp_server_uri, sender_email, password, receiver_email, subject,
         else:
             server.ehlo_or_helo_if_needed()
             server.auth('XOAUTH2', lambda: token.getSasl(sender_email))
+    except BaseException:
+        server.close()
+        raise
+    return server
+
+def send_email(smtp_server_uri, sender_email, password, receiver_email, subject, body):
+    # one-shot, on a connection of its own
+    msg = build_message(sender_email, receiver_email, subject, body)
+    server = connect(smtp_server_uri, sender_email, password)
+    try:
         text = msg.as_string()  # 转换为字符串
         ret = server.sendmail(sender_email, receiver_email, text)  # 发送邮件
         logger.info("successfully sent email with return info: %s", ret)
     finally:
         server.quit()
 
+@dataclasses.dataclass
+class PooledSmtp():
+    server: smtplib.SMTP
+    identity: typing.Hashable
+    last_used: float
+    last_noop: float
+
+class SmtpPool(object):
+    # one authenticated connection per account, reused for the next mail after a NOOP, sends run on
+    # background workers so a slow server never blocks telegram handlers. idle connections are NOOPed
+    # every keepalive seconds and closed after idle_timeout
+    def __init__(self, idle_timeout=SMTP_IDLE_TIMEOUT, keepalive=SMTP_KEEPALIVE, workers=SMTP_WORKERS, timeout=60):
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.timeout = timeout
+        self.connections: dict[str, PooledSmtp] = {}
+        self.accountLocks: dict[str, threading.Lock] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='smtp')
+        self.reaper: threading.Thread | None = None
+        self.counters = {
+            'sent': 0,
+            'failed': 0,
+            'hits': 0,
+            'connects': 0,
+            'noop_failures': 0,
+            'reconnects': 0, # dropped between the NOOP and the mail
+            'idle_closed': 0,
+        }
+
+    def _count(self, name: str, email_addr: str):
+        with self.lock:
+            self.counters[name] += 1
+        metrics.smtp_pool.inc(email_addr, name)
+
+    def _account_lock(self, email_addr: str) -> threading.Lock:
+        with self.lock:
+            return self.accountLocks.setdefault(email_addr, threading.Lock())
+
+    def _close(self, server: smtplib.SMTP):
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _connect(self, smtp_server_uri, sender_email, password) -> smtplib.SMTP:
+        server = connect(smtp_server_uri, sender_email, password, self.timeout)
+        self._count('connects', sender_email)
+        return server
+
+    def _noop(self, entry: PooledSmtp) -> bool:
+        try:
+            code, _ = entry.server.noop()
+        except Exception:
+            code = 0
+        entry.last_noop = time.monotonic()
+        return code == 250
+
+    def send(self, smtp_server_uri, sender_email, password, receiver_email, subject, body, in_reply_to=None, references=None):
+        # blocking, mails of one account are sent one after another on its connection
+        text = build_message(sender_email, receiver_email, subject, body, in_reply_to, references).as_string()
+        identity = (smtp_server_uri, password)
+        with self._account_lock(sender_email):
+            with self.lock:
+                entry = self.connections.pop(sender_email, None)
+            if entry and entry.identity != identity:
+                self._close(entry.server)
+                entry = None
+            if entry and not self._noop(entry):
+                logger.info('smtp connection of %s is gone, reconnecting...', sender_email)
+                self._count('noop_failures', sender_email)
+                entry.server.close()
+                entry = None
+            if entry:
+                self._count('hits', sender_email)
+            server = entry.server if entry else None
+            try:
+                if server is None:
+                    server = self._connect(smtp_server_uri, sender_email, password)
+                try:
+                    ret = server.sendmail(sender_email, receiver_email, text)
+                except smtplib.SMTPServerDisconnected:
+                    self._count('reconnects', sender_email)
+                    server.close()
+                    server = self._connect(smtp_server_uri, sender_email, password)
+                    ret = server.sendmail(sender_email, receiver_email, text)
+            except BaseException:
+                self._count('failed', sender_email)
+                if server is not None:
+                    self._close(server)
+                raise
+            self._count('sent', sender_email)
+            logger.info("successfully sent email with return info: %s", ret)
+            now = time.monotonic()
+            with self.lock:
+                self.connections[sender_email] = PooledSmtp(server, identity, now, now)
+        return ret
+
+    def submit(self, smtp_server_uri, sender_email, password, receiver_email, subject, body, in_reply_to=None, references=None) -> Future:
+        self.start()
+        return self.executor.submit(self.send, smtp_server_uri, sender_email, password, receiver_email, subject, body,
+                                    in_reply_to, references)
+
+    def maintain(self):
+        now = time.monotonic()
+        with self.lock:
+            emailAddrs = list(self.connections)
+        for email_addr in emailAddrs:
+            lock = self._account_lock(email_addr)
+            if not lock.acquire(blocking=False):
+                continue # sending right now
+            try:
+                with self.lock:
+                    entry = self.connections.pop(email_addr, None)
+                if entry is None:
+                    continue
+                if now - entry.last_used > self.idle_timeout:
+                    logger.info('closing idle smtp connection of %s', email_addr)
+                    self._count('idle_closed', email_addr)
+                    self._close(entry.server)
+                    continue
+                if now - entry.last_noop > self.keepalive and not self._noop(entry):
+                    entry.server.close() # reconnected on the next mail
+                    continue
+                with self.lock:
+                    self.connections[email_addr] = entry
+            finally:
+                lock.release()
+
+    def start(self):
+        with self.lock:
+            if self.reaper is not None:
+                return
+            self.reaper = threading.Thread(target=self._run_reaper, name='smtp-keepalive', daemon=True)
+        self.reaper.start()
+
+    def _run_reaper(self):
+        while True:
+            time.sleep(min(self.keepalive, self.idle_timeout) / 2)
+            try:
+                self.maintain()
+            except Exception:
+                logger.warning('cannot maintain smtp connections', exc_info=True)
+
+    def close_all(self):
+        self.executor.shutdown(wait=True)
+        with self.lock:
+            entries, self.connections = list(self.connections.values()), {}
+        for entry in entries:
+            self._close(entry.server)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {'connections': len(self.connections), **self.counters}
+
 if __name__ == '__main__':
     import sys
     smtp_server_uri = sys.argv[1]
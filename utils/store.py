@@ -0,0 +1,299 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FIELDS = ('email_addr', 'email_passwd', 'server_uri', 'smtp_server_uri', 'chat_id', 'folders')
+CURSOR_FIELDS = ('inbox_num', 'uid_validity', 'last_uid', 'highest_modseq', 'seen_uidls', 'folder_cursors', 'backlogs', 'skip_backlog')
+JSON_FIELDS = ('seen_uidls', 'folders', 'folder_cursors', 'backlogs')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS accounts (
+    email_addr TEXT PRIMARY KEY,
+    email_passwd TEXT NOT NULL,
+    server_uri TEXT NOT NULL,
+    smtp_server_uri TEXT,
+    chat_id INTEGER NOT NULL,
+    folders TEXT -- json list of IMAP folders besides INBOX, NULL for INBOX only
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    email_addr TEXT PRIMARY KEY REFERENCES accounts(email_addr) ON DELETE CASCADE,
+    inbox_num INTEGER NOT NULL DEFAULT -1,
+    uid_validity INTEGER NOT NULL DEFAULT 0,
+    last_uid INTEGER NOT NULL DEFAULT 0,
+    highest_modseq INTEGER NOT NULL DEFAULT 0,
+    seen_uidls TEXT, -- json list, NULL if not initialized
+    folder_cursors TEXT, -- json {folder: {uid_validity, last_uid, highest_modseq}} of the extra folders
+    backlogs TEXT, -- json {folder: [[after_uid, last_uid], ...]}, uid ranges still to deliver oldest first
+    skip_backlog INTEGER NOT NULL DEFAULT 0 -- set by the owner, the next poll marks everything as delivered
+);
+CREATE TABLE IF NOT EXISTS delivered_messages (
+    message_id TEXT NOT NULL,
+    chat_id INTEGER NOT NULL,
+    email_addr TEXT NOT NULL, -- account which delivered it
+    tg_message_id INTEGER, -- set once telegram got it
+    PRIMARY KEY (message_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS oauth_tokens (
+    token_key TEXT PRIMARY KEY, -- sha256 of the refresh token
+    access_token BLOB NOT NULL, -- encrypted
+    expire REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reply_context (
+    chat_id INTEGER NOT NULL,
+    tg_message_id INTEGER NOT NULL, -- every message a mail was sent as
+    email_addr TEXT NOT NULL,
+    mail_ref TEXT NOT NULL, -- uid, uidl or index of the mail on the server
+    message_id TEXT NOT NULL,
+    mail_references TEXT NOT NULL,
+    from_addr TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    PRIMARY KEY (chat_id, tg_message_id)
+);
+CREATE TABLE IF NOT EXISTS workers (
+    worker_id TEXT PRIMARY KEY,
+    heartbeat REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS account_leases (
+    email_addr TEXT PRIMARY KEY,
+    worker_id TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+'''
+
+# columns added after the first release, created on older databases
+ADDED_COLUMNS = {
+    'accounts': (('folders', 'TEXT'),),
+    'cursors': (('folder_cursors', 'TEXT'), ('backlogs', 'TEXT'), ('skip_backlog', 'INTEGER NOT NULL DEFAULT 0')),
+}
+
+def _encode_json(fields: dict) -> dict:
+    return {k: json.dumps(v) if k in JSON_FIELDS and v is not None else v for k, v in fields.items()}
+
+def _encode_cursor(fields: dict) -> dict:
+    return _encode_json({k: v for k, v in fields.items() if k in CURSOR_FIELDS})
+
+class AccountStore(object):
+    # account config and sync cursors in SQLite (WAL), replaces the pysondb json file.
+    # cursor updates are merged in memory and committed together at most commit_interval later,
+    # a crash loses at most that window (those mails are delivered again), the file is never corrupted.
+    def __init__(self, path: str, legacy_json_path: str | None = None, commit_interval=1.0, dedup_size=10000,
+                 reply_index_size=50000):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.commit_interval = commit_interval
+        self.dedup_size = dedup_size
+        self.reply_index_size = reply_index_size
+        self.lock = threading.RLock()
+        self.pending: dict[str, dict] = {}
+        self.timer: threading.Timer | None = None
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL') # durable enough with WAL, crash safe either way
+        self.db.execute('PRAGMA foreign_keys=ON')
+        self.db.executescript(SCHEMA)
+        self._add_columns()
+        if legacy_json_path and os.path.exists(legacy_json_path):
+            self._migrate_json(legacy_json_path)
+
+    def _add_columns(self):
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row['name'] for row in self.db.execute(f'PRAGMA table_info({table})')}
+            for name, type in columns:
+                if name not in existing:
+                    self.db.execute(f'ALTER TABLE {table} ADD COLUMN {name} {type}')
+
+    def _migrate_json(self, json_path: str):
+        # one-shot import of conf/email_accounts.json ({"data": [...]} written by pysondb)
+        with self.lock:
+            if self.db.execute('SELECT 1 FROM accounts LIMIT 1').fetchone():
+                logger.warning('%s exists but the store is not empty, not migrating it', json_path)
+                return
+            with open(json_path, encoding='utf-8') as f:
+                accounts = json.load(f).get('data', [])
+            with self.db:
+                self.db.execute('BEGIN')
+                for account in accounts:
+                    self._upsert(account)
+        os.replace(json_path, json_path + '.migrated')
+        logger.info('migrated %d accounts from %s', len(accounts), json_path)
+
+    def _row_to_dict(self, row: sqlite3.Row) -> dict:
+        account = dict(row)
+        for k in JSON_FIELDS:
+            if account[k] is not None:
+                account[k] = json.loads(account[k])
+        account.update(self.pending.get(account['email_addr'], {}))
+        return account
+
+    def get_all(self) -> list[dict]:
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM accounts JOIN cursors USING (email_addr) ORDER BY accounts.rowid').fetchall()
+            return [self._row_to_dict(row) for row in rows]
+
+    def get(self, email_addr: str) -> dict | None:
+        with self.lock:
+            row = self.db.execute('SELECT * FROM accounts JOIN cursors USING (email_addr) WHERE email_addr = ?', (email_addr,)).fetchone()
+            return self._row_to_dict(row) if row else None
+
+    def _upsert(self, account: dict):
+        config = _encode_json({k: account.get(k) for k in CONFIG_FIELDS})
+        self.db.execute(f'INSERT INTO accounts ({", ".join(CONFIG_FIELDS)}) VALUES ({", ".join("?" * len(CONFIG_FIELDS))}) '
+                        f'ON CONFLICT (email_addr) DO UPDATE SET {", ".join(f"{k} = excluded.{k}" for k in CONFIG_FIELDS[1:])}',
+                        tuple(config.values()))
+        cursor = _encode_cursor(account)
+        cursor['email_addr'] = account['email_addr']
+        self.db.execute(f'INSERT OR REPLACE INTO cursors ({", ".join(cursor)}) VALUES ({", ".join("?" * len(cursor))})',
+                        tuple(cursor.values()))
+
+    def upsert(self, account: dict):
+        # config and cursor, committed right away, drops pending cursor updates of the account
+        with self.lock, self.db:
+            self.pending.pop(account['email_addr'], None)
+            self.db.execute('BEGIN')
+            self._upsert(account)
+
+    def update_config(self, email_addr: str, fields: dict) -> bool:
+        # config fields only, committed right away. the cursors stay with whichever worker polls the account
+        config = _encode_json({k: v for k, v in fields.items() if k in CONFIG_FIELDS[1:]})
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            return self.db.execute(f'UPDATE accounts SET {", ".join(f"{k} = ?" for k in config)} WHERE email_addr = ?',
+                                   (*config.values(), email_addr)).rowcount > 0
+
+    def delete(self, email_addr: str) -> bool:
+        with self.lock, self.db:
+            self.pending.pop(email_addr, None)
+            self.db.execute('BEGIN')
+            return self.db.execute('DELETE FROM accounts WHERE email_addr = ?', (email_addr,)).rowcount > 0
+
+    def update_cursor(self, email_addr: str, fields: dict):
+        with self.lock:
+            self.pending.setdefault(email_addr, {}).update(fields)
+            if self.commit_interval <= 0:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.commit_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            pending, self.pending = self.pending, {}
+            if not pending:
+                return
+            try:
+                with self.db:
+                    self.db.execute('BEGIN')
+                    for email_addr, fields in pending.items():
+                        cursor = _encode_cursor(fields)
+                        if cursor:
+                            self.db.execute(f'UPDATE cursors SET {", ".join(f"{k} = ?" for k in cursor)} WHERE email_addr = ?',
+                                            (*cursor.values(), email_addr))
+            except Exception:
+                # keep them for the next flush, newer updates win
+                for email_addr, fields in pending.items():
+                    self.pending[email_addr] = {**fields, **self.pending.get(email_addr, {})}
+                raise
+
+    def claim_messages(self, chat_id: int, email_addr: str, message_ids: list[str]) -> dict[str, dict]:
+        # claims the delivery of message_ids to chat_id for email_addr, returns {message_id: claim} for the ones
+        # another account claimed before. claims of email_addr itself do not count, its cursor did not move past them
+        duplicates = {}
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            for message_id in message_ids:
+                if self.db.execute('INSERT OR IGNORE INTO delivered_messages (message_id, chat_id, email_addr) VALUES (?, ?, ?)',
+                                   (message_id, chat_id, email_addr)).rowcount:
+                    continue
+                row = self.db.execute('SELECT email_addr, tg_message_id FROM delivered_messages WHERE message_id = ? AND chat_id = ?',
+                                      (message_id, chat_id)).fetchone()
+                if row['email_addr'] != email_addr:
+                    duplicates[message_id] = dict(row)
+            # rowids grow with every insert, only the newest dedup_size claims are kept
+            self.db.execute('DELETE FROM delivered_messages WHERE rowid <= (SELECT MAX(rowid) FROM delivered_messages) - ?',
+                            (self.dedup_size,))
+        return duplicates
+
+    def set_message_ref(self, message_id: str, chat_id: int, email_addr: str, tg_message_id: int | None):
+        with self.lock, self.db:
+            self.db.execute('UPDATE delivered_messages SET tg_message_id = ? WHERE message_id = ? AND chat_id = ? AND email_addr = ?',
+                            (tg_message_id, message_id, chat_id, email_addr))
+
+    def release_message(self, message_id: str, chat_id: int, email_addr: str):
+        # delivery failed, the next copy may claim it
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM delivered_messages WHERE message_id = ? AND chat_id = ? AND email_addr = ?',
+                            (message_id, chat_id, email_addr))
+
+    def add_reply_context(self, chat_id: int, tg_message_ids: list[int], context: dict):
+        # context: email_addr, mail_ref, message_id, mail_references, from_addr, subject of the mail the messages show
+        with self.lock, self.db:
+            self.db.execute('BEGIN')
+            self.db.executemany('INSERT OR REPLACE INTO reply_context (chat_id, tg_message_id, email_addr, mail_ref, message_id, '
+                                'mail_references, from_addr, subject) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(chat_id, tg_message_id, context['email_addr'], context['mail_ref'], context['message_id'],
+                                  context['mail_references'], context['from_addr'], context['subject']) for tg_message_id in tg_message_ids])
+            # same pruning as delivered_messages, only the newest reply_index_size messages can be replied to
+            self.db.execute('DELETE FROM reply_context WHERE rowid <= (SELECT MAX(rowid) FROM reply_context) - ?',
+                            (self.reply_index_size,))
+
+    def get_reply_context(self, chat_id: int, tg_message_id: int) -> dict | None:
+        with self.lock:
+            row = self.db.execute('SELECT * FROM reply_context WHERE chat_id = ? AND tg_message_id = ?', (chat_id, tg_message_id)).fetchone()
+            return dict(row) if row else None
+
+    def heartbeat(self, worker_id: str, now: float, dead_before: float) -> list[str]:
+        # renews the worker's row, drops dead ones, returns the live workers
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('INSERT OR REPLACE INTO workers (worker_id, heartbeat) VALUES (?, ?)', (worker_id, now))
+            self.db.execute('DELETE FROM workers WHERE heartbeat < ?', (dead_before,))
+            return [row['worker_id'] for row in self.db.execute('SELECT worker_id FROM workers ORDER BY worker_id')]
+
+    def sync_leases(self, worker_id: str, email_addrs: set[str], now: float, expires: float) -> set[str]:
+        # releases the worker's leases on other accounts, takes or renews the ones on email_addrs unless
+        # another worker holds them unexpired. returns the accounts the worker holds now
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            held = {row['email_addr'] for row in self.db.execute('SELECT email_addr FROM account_leases WHERE worker_id = ?', (worker_id,))}
+            self.db.executemany('DELETE FROM account_leases WHERE email_addr = ? AND worker_id = ?',
+                                [(email_addr, worker_id) for email_addr in held - email_addrs])
+            self.db.executemany('INSERT INTO account_leases (email_addr, worker_id, expires) VALUES (?, ?, ?) '
+                                'ON CONFLICT (email_addr) DO UPDATE SET worker_id = excluded.worker_id, expires = excluded.expires '
+                                'WHERE account_leases.worker_id = excluded.worker_id OR account_leases.expires < ?',
+                                [(email_addr, worker_id, expires, now) for email_addr in email_addrs])
+            return {row['email_addr'] for row in self.db.execute('SELECT email_addr FROM account_leases WHERE worker_id = ?', (worker_id,))}
+
+    def remove_worker(self, worker_id: str):
+        with self.lock, self.db:
+            self.db.execute('BEGIN IMMEDIATE')
+            self.db.execute('DELETE FROM account_leases WHERE worker_id = ?', (worker_id,))
+            self.db.execute('DELETE FROM workers WHERE worker_id = ?', (worker_id,))
+
+    def get_workers(self) -> list[dict]:
+        with self.lock:
+            return [dict(row) for row in self.db.execute(
+                'SELECT workers.worker_id, heartbeat, COUNT(email_addr) AS leases FROM workers '
+                'LEFT JOIN account_leases USING (worker_id) GROUP BY workers.worker_id ORDER BY workers.worker_id')]
+
+    def get_token(self, token_key: str) -> tuple[bytes, float] | None:
+        with self.lock:
+            row = self.db.execute('SELECT access_token, expire FROM oauth_tokens WHERE token_key = ?', (token_key,)).fetchone()
+            return (row['access_token'], row['expire']) if row else None
+
+    def set_token(self, token_key: str, access_token: bytes, expire: float):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO oauth_tokens (token_key, access_token, expire) VALUES (?, ?, ?)',
+                            (token_key, access_token, expire))
+
+    def close(self):
+        self.flush()
+        self.db.close()
@@ -0,0 +1,186 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+import typing
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from telegram.error import BadRequest, ChatMigrated, NetworkError, RetryAfter, Unauthorized
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0 # answers to something the user just did
+PRIORITY_NOTIFY = 1 # fresh mail
+PRIORITY_BULK = 2 # catch-up after a backlog
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_NOTIFY: 'notify', PRIORITY_BULK: 'bulk'}
+
+class TokenBucket(object):
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        # seconds until a token is available
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+class SendJob(object):
+    def __init__(self, chat_id: int, fn: typing.Callable[[], typing.Any], priority: int, seq: int):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.priority = priority
+        self.seq = seq
+        self.attempts = 0
+        self.future: Future = Future()
+
+    def __lt__(self, other: 'SendJob'):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class TelegramDispatcher(object):
+    # all outgoing bot api calls go through here: token buckets per chat and for the whole bot,
+    # RetryAfter is waited out exactly (without blocking anyone), and lower priority values go first.
+    # within a chat, jobs of the same priority keep their order and only one is in flight at a time.
+    def __init__(self, global_rate=30.0, chat_rate=1.0, group_rate=20 / 60, chat_burst=3,
+                 workers=4, max_retries=10, retry_interval=5):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.cond = threading.Condition()
+        self.queues: dict[int, list[SendJob]] = {} # chat_id -> heap
+        self.buckets: dict[int, TokenBucket] = {}
+        self.blocked_until: dict[int, float] = {}
+        self.busy_chats: set[int] = set()
+        self.seq = itertools.count()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='tg-send')
+        self.thread = threading.Thread(target=self._run, name='tg-dispatcher', daemon=True)
+        self.counters = {'sent': 0, 'failed': 0, 'retry_after': 0, 'retried': 0}
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, chat_id: int, fn: typing.Callable[[], typing.Any], priority=PRIORITY_NOTIFY) -> Future:
+        # fn() does the actual (blocking) bot api call, the future resolves to its result
+        with self.cond:
+            job = SendJob(chat_id, fn, priority, next(self.seq))
+            heapq.heappush(self.queues.setdefault(chat_id, []), job)
+            self.cond.notify()
+        return job.future
+
+    def set_global_rate(self, rate: float):
+        # processes sharing the bot token split its global limit
+        with self.cond:
+            self.global_bucket.rate = self.global_bucket.capacity = rate
+            self.global_bucket.tokens = min(self.global_bucket.tokens, rate)
+            self.cond.notify()
+
+    def queue_depth(self) -> dict:
+        with self.cond:
+            byPriority = {name: 0 for name in PRIORITY_NAMES.values()}
+            for queue in self.queues.values():
+                for job in queue:
+                    byPriority[PRIORITY_NAMES.get(job.priority, str(job.priority))] += 1
+            return {'queued': sum(byPriority.values()), 'in_flight': len(self.busy_chats), 'chats': len(self.queues),
+                    **{f'queued_{name}': n for name, n in byPriority.items()}}
+
+    def stats(self) -> dict:
+        return {**self.queue_depth(), **self.counters}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.buckets:
+            # negative ids are groups and channels, telegram allows them about 20 messages a minute
+            self.buckets[chat_id] = TokenBucket(self.group_rate if chat_id < 0 else self.chat_rate, self.chat_burst)
+        return self.buckets[chat_id]
+
+    def _next_job(self) -> tuple[SendJob | None, float | None]:
+        # called with the lock held, returns the job to send now or how long to wait for one
+        now = time.monotonic()
+        best: SendJob | None = None
+        wait: float | None = None
+        for chat_id, queue in self.queues.items():
+            if chat_id in self.busy_chats:
+                continue # woken up when the call returns
+            chatWait = max(self._chat_bucket(chat_id).delay(now), self.blocked_until.get(chat_id, 0) - now)
+            if chatWait > 0:
+                wait = chatWait if wait is None else min(wait, chatWait)
+                continue
+            if best is None or queue[0] < best:
+                best = queue[0]
+        if best is None:
+            return None, wait
+        globalWait = self.global_bucket.delay(now)
+        if globalWait > 0:
+            return None, globalWait
+        heapq.heappop(self.queues[best.chat_id])
+        if not self.queues[best.chat_id]:
+            del self.queues[best.chat_id]
+        self.global_bucket.take(now)
+        self._chat_bucket(best.chat_id).take(now)
+        self.busy_chats.add(best.chat_id)
+        return best, None
+
+    def _run(self):
+        while True:
+            with self.cond:
+                job, wait = self._next_job()
+                if job is None:
+                    self.cond.wait(wait)
+                    continue
+            self.executor.submit(self._execute, job)
+
+    def _requeue(self, job: SendJob, delay: float):
+        # keeps its sequence number, so it is sent before anything queued after it
+        self.blocked_until[job.chat_id] = time.monotonic() + delay
+        heapq.heappush(self.queues.setdefault(job.chat_id, []), job)
+
+    def _execute(self, job: SendJob):
+        outcome = 'sent'
+        started = time.monotonic()
+        try:
+            result = job.fn()
+        except RetryAfter as e:
+            logger.warning('telegram flood limit hit in chat %d, retry after %ss', job.chat_id, e.retry_after)
+            outcome = 'retry_after'
+            with self.cond:
+                self._requeue(job, e.retry_after)
+        except (BadRequest, Unauthorized, ChatMigrated) as e:
+            # retrying would not change anything
+            logger.warning('cannot send tg msg to %d', job.chat_id, exc_info=True)
+            outcome = 'failed'
+            job.future.set_exception(e)
+        except Exception as e:
+            job.attempts += 1
+            if job.attempts >= self.max_retries or not isinstance(e, NetworkError):
+                logger.warning('cannot send tg msg to %d, giving up after %d attempts', job.chat_id, job.attempts, exc_info=True)
+                outcome = 'failed'
+                job.future.set_exception(e)
+            else:
+                logger.warning('cannot send tg msg to %d (retry %d)', job.chat_id, job.attempts, exc_info=True)
+                outcome = 'retried'
+                with self.cond:
+                    self._requeue(job, self.retry_interval * job.attempts)
+        else:
+            job.future.set_result(result)
+        finally:
+            priority = PRIORITY_NAMES.get(job.priority, str(job.priority))
+            metrics.telegram_send_duration.observe(time.monotonic() - started, priority)
+            metrics.telegram_send_results.inc(priority, outcome)
+            with self.cond:
+                self.counters[outcome] += 1
+                self.busy_chats.discard(job.chat_id)
+                self.cond.notify()